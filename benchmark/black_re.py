@@ -0,0 +1,51 @@
+# Per-scrape cost of the blacklist check: python -m benchmark.black_re
+import re
+import timeit
+from typing import Any, Dict, List, Set
+
+from elasticsearch_exporter.collector.base import BaseEsCollector
+
+
+class LegacyBlock(object):
+    # blacklist check before the combined matcher: only blocked metric were cached
+    def __init__(self, black_re_list: List[str]):
+        self._black_re_list: List[re.Pattern[str]] = [re.compile(i) for i in black_re_list]
+        self._black_metric_set: Set[str] = set()
+
+    def _is_block(self, metric: str) -> bool:
+        is_block: bool = False
+        if metric in self._black_metric_set:
+            return True
+
+        for pattern in self._black_re_list:
+            if pattern.match(metric):
+                is_block = True
+                self._black_metric_set.add(metric)
+                break
+        return is_block
+
+
+class BenchCollector(BaseEsCollector):
+    key: str = 'bench'
+
+
+def main(metric_size: int = 2000, pattern_size: int = 20, scrape_size: int = 20) -> None:
+    black_re_list: List[str] = [f'es_node_section{i}_.*_blocked' for i in range(pattern_size)]
+    metric_list: List[str] = [
+        f'es_node_section{i % pattern_size}_metric{i}' + ('_blocked' if i % 10 == 0 else '')
+        for i in range(metric_size)
+    ]
+    config: Dict[str, Any] = {'global': {'black_re': black_re_list}, 'bench': {}}
+    for name, instance in (('before', LegacyBlock(black_re_list)), ('after', BenchCollector(None, config))):
+        is_block = instance._is_block
+
+        def scrape() -> None:
+            for metric in metric_list:
+                is_block(metric)
+
+        cost: float = timeit.timeit(scrape, number=scrape_size) / scrape_size
+        print(f'{name:<6} {metric_size} metric x {pattern_size} pattern: {cost * 1000:.3f} ms/scrape')
+
+
+if __name__ == '__main__':
+    main()
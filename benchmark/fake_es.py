@@ -0,0 +1,165 @@
+# A local stand-in of es that replays recorded or synthetic responses over http, filter_path is applied like es does.
+# Used by benchmark.suite, can also be started alone and scraped by the exporter:
+# python -m benchmark.fake_es [--port 9200] [--node-size 100] [--index-size 5000] [--bucket-size 1000]
+import argparse
+import json
+import multiprocessing
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from benchmark import fixture
+from benchmark.filter_path import apply_filter_path
+
+info_response: Dict[str, Any] = {
+    'name': 'fake-es',
+    'cluster_name': 'benchmark',
+    'version': {'number': '7.17.0', 'build_flavor': 'default', 'lucene_version': '8.11.1'},
+    'tagline': 'You Know, for Search'
+}
+
+
+def get_route(path: str) -> str:
+    segment_list: Tuple[str, ...] = tuple(path.strip('/').split('/'))
+    if segment_list == ('',):
+        return 'info'
+    if '_nodes' in segment_list and 'stats' in segment_list:
+        return 'nodes_stats'
+    if segment_list[-1] == '_stats':
+        return 'indices_stats'
+    if segment_list[:2] == ('_cluster', 'health'):
+        return 'cluster_health'
+    if segment_list[:2] == ('_cat', 'indices'):
+        return 'cat_indices'
+    if segment_list[:2] == ('_cat', 'shards'):
+        return 'cat_shards'
+    if segment_list[-1] == '_search':
+        return 'search'
+    return ''
+
+
+class FakeEsHandler(BaseHTTPRequestHandler):
+    protocol_version: str = 'HTTP/1.1'
+    # header and body are written separately, with nagle every small response waits for the delayed ack(~40ms)
+    disable_nagle_algorithm: bool = True
+    # route -> response, set by `serve`
+    response_dict: Dict[str, Any] = {}
+    # (route, filter_path) -> encoded body
+    _body_cache_dict: Dict[Tuple[str, Optional[str]], bytes] = {}
+    _body_cache_lock: threading.Lock = threading.Lock()
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def get_body(self, route: str, filter_path: Optional[str]) -> bytes:
+        cache_key: Tuple[str, Optional[str]] = (route, filter_path)
+        with self._body_cache_lock:
+            body: Optional[bytes] = self._body_cache_dict.get(cache_key, None)
+            if body is None:
+                body = json.dumps(apply_filter_path(self.response_dict[route], filter_path)).encode()
+                self._body_cache_dict[cache_key] = body
+        return body
+
+    def do_GET(self) -> None:
+        content_length: int = int(self.headers.get('Content-Length', 0))
+        if content_length:
+            self.rfile.read(content_length)
+        split_result = urlsplit(self.path)
+        route: str = get_route(split_result.path)
+        if route not in self.response_dict:
+            status: int = 404
+            body: bytes = json.dumps({'error': f'no fake response of {split_result.path}', 'status': 404}).encode()
+        else:
+            status = 200
+            filter_path: Optional[str] = parse_qs(split_result.query).get('filter_path', [None])[0]
+            body = self.get_body(route, filter_path)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        # checked by elasticsearch-py >= 7.14
+        self.send_header('X-elastic-product', 'Elasticsearch')
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+def serve(
+        response_factory_dict: Dict[str, Callable[[], Any]],
+        port: int,
+        port_queue: 'Optional[multiprocessing.Queue]' = None
+) -> None:
+    FakeEsHandler.response_dict = dict({'info': info_response}, **{
+        route: factory() for route, factory in response_factory_dict.items()
+    })
+    server: ThreadingHTTPServer = ThreadingHTTPServer(('127.0.0.1', port), FakeEsHandler)
+    if port_queue is not None:
+        port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeEsServer(object):
+    # Run the fake es in a child process, so serving does not compete with the measured code for the GIL.
+    # The responses are built by the child, e.g. `FakeEsServer({'nodes_stats': partial(fixture.nodes_stats, 1000)})`
+    def __init__(self, response_factory_dict: Dict[str, Callable[[], Any]], port: int = 0):
+        self.response_factory_dict: Dict[str, Callable[[], Any]] = response_factory_dict
+        self.port: int = port
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def url(self) -> str:
+        return f'127.0.0.1:{self.port}'
+
+    def start(self) -> None:
+        port_queue: 'multiprocessing.Queue' = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=serve, args=(self.response_factory_dict, self.port, port_queue), daemon=True
+        )
+        self._process.start()
+        self.port = port_queue.get(timeout=300)
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> 'FakeEsServer':
+        self.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--nodes-stats', help='recorded _nodes/stats response, default use synthetic response')
+    parser.add_argument('--indices-stats', help='recorded _stats response, default use synthetic response')
+    parser.add_argument('--search', help='recorded _search response, default use synthetic response')
+    parser.add_argument('--node-size', type=int, default=100)
+    parser.add_argument('--index-size', type=int, default=5000)
+    parser.add_argument('--bucket-size', type=int, default=1000)
+    args: argparse.Namespace = parser.parse_args()
+
+    print(f'fake es listen on 127.0.0.1:{args.port}')
+    serve(
+        {
+            'nodes_stats': partial(fixture.load, args.nodes_stats, partial(fixture.nodes_stats, args.node_size)),
+            'indices_stats': partial(
+                fixture.load, args.indices_stats, partial(fixture.indices_stats, args.index_size)
+            ),
+            'cat_indices': partial(fixture.cat_indices, args.index_size),
+            'cat_shards': partial(fixture.cat_shards, args.index_size * 10, args.node_size),
+            'cluster_health': partial(fixture.cluster_health, args.node_size),
+            'search': partial(fixture.load, args.search, partial(fixture.search_aggregations, args.bucket_size)),
+        },
+        args.port
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Bytes transferred and decode time with and without the derived filter_path / _cat mode:
+# python -m benchmark.filter_path [--nodes-stats nodes_stats.json] [--indices-stats indices_stats.json]
+import argparse
+import fnmatch
+import json
+import timeit
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+from elasticsearch_exporter.collector import EsNodeCollector, IndicesStatsCollector
+from elasticsearch_exporter.collector.base import BaseEsCollector
+
+from benchmark import fixture
+
+
+def _filter(data: Any, pattern_list: List[Tuple[str, ...]]) -> Any:
+    # the subset of es filter_path semantics used by the exporter: `*` matches one key, `**` any number of keys
+    if isinstance(data, list):
+        item_list: List[Any] = [_filter(i, pattern_list) for i in data]
+        return [i for i in item_list if i is not None] or None
+    if not isinstance(data, dict):
+        return None
+    result: Dict[str, Any] = {}
+    for key, value in data.items():
+        sub_pattern_list: List[Tuple[str, ...]] = []
+        for pattern in pattern_list:
+            if pattern[0] == '**':
+                sub_pattern_list.append(pattern)
+                if len(pattern) > 1 and fnmatch.fnmatchcase(key, pattern[1]):
+                    sub_pattern_list.append(pattern[2:])
+                elif len(pattern) == 1:
+                    sub_pattern_list.append(())
+            elif fnmatch.fnmatchcase(key, pattern[0]):
+                sub_pattern_list.append(pattern[1:])
+        if not sub_pattern_list:
+            continue
+        if () in sub_pattern_list:
+            result[key] = value
+            continue
+        sub_value: Any = _filter(value, sub_pattern_list)
+        if sub_value is not None:
+            result[key] = sub_value
+    return result or None
+
+
+def apply_filter_path(data: Any, filter_path: Optional[str]) -> Any:
+    if not filter_path:
+        return data
+    return _filter(data, [tuple(path.split('.')) for path in filter_path.split(',')]) or {}
+
+
+class FakeEs(object):
+    def __init__(self, response: Any):
+        self.response: Any = response
+        self.nodes: FakeEs = self
+        self.indices: FakeEs = self
+
+    def stats(self, filter_path: Optional[str] = None, **kwargs: Any) -> Any:
+        return apply_filter_path(self.response, filter_path)
+
+
+def _report(name: str, raw: bytes, repeat: int) -> Tuple[int, float]:
+    cost: float = timeit.timeit(partial(json.loads, raw), number=repeat) / repeat
+    print(f'  {name:<12} {len(raw) / 1024 / 1024:9.2f} MB  decode {cost * 1000:9.2f} ms')
+    return len(raw), cost
+
+
+def bench_collector(collector: BaseEsCollector, response: Any, repeat: int) -> None:
+    # the first request is unfiltered and teaches the collector its filter_path
+    collector.es_client = FakeEs(response)
+    list(collector.get_metric())
+    print(f'{collector.key} filter_path: {len(collector.filter_path or "")} chars')
+    full_size, full_cost = _report('full', json.dumps(response).encode(), repeat)
+    filter_size, filter_cost = _report(
+        'filter_path', json.dumps(apply_filter_path(response, collector.filter_path)).encode(), repeat
+    )
+    print(f'  {"ratio":<12} {full_size / filter_size:9.1f} x  decode {full_cost / filter_cost:9.1f} x')
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument('--nodes-stats', help='recorded _nodes/stats response, default use synthetic response')
+    parser.add_argument('--indices-stats', help='recorded _stats response, default use synthetic response')
+    parser.add_argument('--node-size', type=int, default=100)
+    parser.add_argument('--index-size', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--black-re', action='append',
+        default=['.*_thread_pool_.*', '.*_fs_io_stats_.*', '.*_breakers_.*', '.*_ingest_pipelines_.*',
+                 '.*_(warmer|completion|recovery|translog)_.*', '.*_jvm_buffer_pools_.*'],
+        help='blacklist used to derive filter_path'
+    )
+    args: argparse.Namespace = parser.parse_args()
+
+    global_config: Dict[str, Any] = {'interval': 'disable', 'black_re': args.black_re}
+    bench_collector(
+        EsNodeCollector(None, {'global': global_config, 'es_node': {'filter_path': 'auto'}}),
+        fixture.load(args.nodes_stats, partial(fixture.nodes_stats, args.node_size)),
+        args.repeat
+    )
+    bench_collector(
+        IndicesStatsCollector(None, {'global': global_config, 'indices_stats': {'filter_path': 'auto'}}),
+        fixture.load(args.indices_stats, partial(fixture.indices_stats, args.index_size)),
+        args.repeat
+    )
+    print('indices_stats _cat/indices mode')
+    _report('cat', json.dumps(fixture.cat_indices(args.index_size)).encode(), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# Synthetic es 7.x responses with the shape of a large cluster, used when no recorded response is given
+import json
+import random
+from typing import Any, Callable, Dict, List, Optional
+
+
+def _index_section(rnd: random.Random) -> Dict[str, Any]:
+    def _n() -> int:
+        return rnd.randint(0, 10 ** 9)
+
+    return {
+        'docs': {'count': _n(), 'deleted': _n()},
+        'store': {'size_in_bytes': _n(), 'reserved_in_bytes': 0},
+        'indexing': {
+            'index_total': _n(), 'index_time_in_millis': _n(), 'index_current': 0, 'index_failed': 0,
+            'delete_total': _n(), 'delete_time_in_millis': _n(), 'delete_current': 0, 'noop_update_total': 0,
+            'is_throttled': False, 'throttle_time_in_millis': 0
+        },
+        'get': {
+            'total': _n(), 'time_in_millis': _n(), 'exists_total': _n(), 'exists_time_in_millis': _n(),
+            'missing_total': 0, 'missing_time_in_millis': 0, 'current': 0
+        },
+        'search': {
+            'open_contexts': 0, 'query_total': _n(), 'query_time_in_millis': _n(), 'query_current': 0,
+            'fetch_total': _n(), 'fetch_time_in_millis': _n(), 'fetch_current': 0, 'scroll_total': 0,
+            'scroll_time_in_millis': 0, 'scroll_current': 0, 'suggest_total': 0, 'suggest_time_in_millis': 0,
+            'suggest_current': 0
+        },
+        'merges': {
+            'current': 0, 'current_docs': 0, 'current_size_in_bytes': 0, 'total': _n(), 'total_time_in_millis': _n(),
+            'total_docs': _n(), 'total_size_in_bytes': _n(), 'total_stopped_time_in_millis': 0,
+            'total_throttled_time_in_millis': _n(), 'total_auto_throttle_in_bytes': _n()
+        },
+        'refresh': {
+            'total': _n(), 'total_time_in_millis': _n(), 'external_total': _n(),
+            'external_total_time_in_millis': _n(), 'listeners': 0
+        },
+        'flush': {'total': _n(), 'periodic': _n(), 'total_time_in_millis': _n()},
+        'warmer': {'current': 0, 'total': _n(), 'total_time_in_millis': _n()},
+        'query_cache': {
+            'memory_size_in_bytes': _n(), 'total_count': _n(), 'hit_count': _n(), 'miss_count': _n(),
+            'cache_size': _n(), 'cache_count': _n(), 'evictions': 0
+        },
+        'fielddata': {'memory_size_in_bytes': _n(), 'evictions': 0},
+        'completion': {'size_in_bytes': 0},
+        'segments': {
+            'count': _n(), 'memory_in_bytes': _n(), 'terms_memory_in_bytes': _n(),
+            'stored_fields_memory_in_bytes': _n(),
+            'term_vectors_memory_in_bytes': 0, 'norms_memory_in_bytes': _n(), 'points_memory_in_bytes': 0,
+            'doc_values_memory_in_bytes': _n(), 'index_writer_memory_in_bytes': _n(),
+            'version_map_memory_in_bytes': _n(), 'fixed_bit_set_memory_in_bytes': 0,
+            'max_unsafe_auto_id_timestamp': -1, 'file_sizes': {}
+        },
+        'translog': {
+            'operations': _n(), 'size_in_bytes': _n(), 'uncommitted_operations': 0, 'uncommitted_size_in_bytes': 55,
+            'earliest_last_modified_age': _n()
+        },
+        'request_cache': {'memory_size_in_bytes': _n(), 'evictions': 0, 'hit_count': _n(), 'miss_count': _n()},
+        'recovery': {'current_as_source': 0, 'current_as_target': 0, 'throttle_time_in_millis': _n()}
+    }
+
+
+def nodes_stats(node_size: int = 100, seed: int = 0) -> Dict[str, Any]:
+    rnd: random.Random = random.Random(seed)
+    node_dict: Dict[str, Any] = {}
+    thread_pool_name_list: List[str] = [
+        'analyze', 'ccr', 'fetch_shard_started', 'fetch_shard_store', 'flush', 'force_merge', 'generic', 'get',
+        'listener', 'management', 'ml_datafeed', 'ml_job_comms', 'ml_utility', 'refresh', 'rollup_indexing',
+        'search', 'search_throttled', 'security-token-key', 'snapshot', 'transform_indexing', 'warmer', 'watcher',
+        'write'
+    ]
+    for node_index in range(node_size):
+        def _n() -> int:
+            return rnd.randint(0, 10 ** 9)
+
+        node_dict[f'node_id_{node_index:05d}'] = {
+            'timestamp': 1600000000000,
+            'name': f'es-node-{node_index}',
+            'transport_address': f'10.0.{node_index // 250}.{node_index % 250}:9300',
+            'host': f'10.0.{node_index // 250}.{node_index % 250}',
+            'ip': f'10.0.{node_index // 250}.{node_index % 250}:9300',
+            'roles': ['data', 'ingest', 'master', 'ml'][:1 + node_index % 4],
+            'attributes': {'ml.machine_memory': str(_n()), 'xpack.installed': 'true'},
+            'indices': _index_section(rnd),
+            'os': {
+                'timestamp': 1600000000000,
+                'cpu': {'percent': rnd.randint(0, 100), 'load_average': {'1m': 1.5, '5m': 1.2, '15m': 1.0}},
+                'mem': {'total_in_bytes': _n(), 'free_in_bytes': _n(), 'used_in_bytes': _n(), 'free_percent': 10,
+                        'used_percent': 90},
+                'swap': {'total_in_bytes': 0, 'free_in_bytes': 0, 'used_in_bytes': 0},
+                'cgroup': {
+                    'cpuacct': {'control_group': '/', 'usage_nanos': _n()},
+                    'cpu': {'control_group': '/', 'cfs_period_micros': 100000, 'cfs_quota_micros': -1,
+                            'stat': {'number_of_elapsed_periods': 0, 'number_of_times_throttled': 0,
+                                     'time_throttled_nanos': 0}},
+                    'memory': {'control_group': '/', 'limit_in_bytes': '9223372036854771712',
+                               'usage_in_bytes': str(_n())}
+                }
+            },
+            'process': {
+                'timestamp': 1600000000000, 'open_file_descriptors': _n(), 'max_file_descriptors': 65535,
+                'cpu': {'percent': rnd.randint(0, 100), 'total_in_millis': _n()},
+                'mem': {'total_virtual_in_bytes': _n()}
+            },
+            'jvm': {
+                'timestamp': 1600000000000, 'uptime_in_millis': _n(),
+                'mem': {
+                    'heap_used_in_bytes': _n(), 'heap_used_percent': 50, 'heap_committed_in_bytes': _n(),
+                    'heap_max_in_bytes': _n(), 'non_heap_used_in_bytes': _n(), 'non_heap_committed_in_bytes': _n(),
+                    'pools': {
+                        pool: {'used_in_bytes': _n(), 'max_in_bytes': _n(), 'peak_used_in_bytes': _n(),
+                               'peak_max_in_bytes': _n()}
+                        for pool in ('young', 'survivor', 'old')
+                    }
+                },
+                'threads': {'count': 200, 'peak_count': 250},
+                'gc': {'collectors': {
+                    collector: {'collection_count': _n(), 'collection_time_in_millis': _n()}
+                    for collector in ('young', 'old')
+                }},
+                'buffer_pools': {
+                    pool: {'count': _n(), 'used_in_bytes': _n(), 'total_capacity_in_bytes': _n()}
+                    for pool in ('mapped', 'direct', 'mapped - \'non-volatile memory\'')
+                },
+                'classes': {'current_loaded_count': _n(), 'total_loaded_count': _n(), 'total_unloaded_count': 0}
+            },
+            'thread_pool': {
+                name: {'threads': 8, 'queue': 0, 'active': 0, 'rejected': _n() % 10, 'largest': 8, 'completed': _n()}
+                for name in thread_pool_name_list
+            },
+            'fs': {
+                'timestamp': 1600000000000,
+                'total': {'total_in_bytes': _n(), 'free_in_bytes': _n(), 'available_in_bytes': _n()},
+                'data': [
+                    {'path': f'/data/{i}', 'mount': f'/data/{i} (/dev/sd{i})', 'type': 'ext4',
+                     'total_in_bytes': _n(), 'free_in_bytes': _n(), 'available_in_bytes': _n()}
+                    for i in range(2)
+                ],
+                'io_stats': {
+                    'devices': [
+                        {'device_name': f'sd{i}', 'operations': _n(), 'read_operations': _n(),
+                         'write_operations': _n(), 'read_kilobytes': _n(), 'write_kilobytes': _n()}
+                        for i in range(2)
+                    ],
+                    'total': {'operations': _n(), 'read_operations': _n(), 'write_operations': _n(),
+                              'read_kilobytes': _n(), 'write_kilobytes': _n()}
+                }
+            },
+            'transport': {'server_open': 100, 'rx_count': _n(), 'rx_size_in_bytes': _n(), 'tx_count': _n(),
+                          'tx_size_in_bytes': _n()},
+            'http': {'current_open': 10, 'total_opened': _n()},
+            'breakers': {
+                name: {'limit_size_in_bytes': _n(), 'limit_size': '1gb', 'estimated_size_in_bytes': _n(),
+                       'estimated_size': '1mb', 'overhead': 1.0, 'tripped': 0}
+                for name in ('request', 'fielddata', 'in_flight_requests', 'model_inference', 'accounting', 'parent')
+            },
+            'script': {'compilations': _n(), 'cache_evictions': 0, 'compilation_limit_triggered': 0},
+            'discovery': {
+                'cluster_state_queue': {'total': 0, 'pending': 0, 'committed': 0},
+                'published_cluster_states': {'full_states': 2, 'incompatible_diffs': 0, 'compatible_diffs': _n()}
+            },
+            'ingest': {
+                'total': {'count': _n(), 'time_in_millis': _n(), 'current': 0, 'failed': 0},
+                'pipelines': {
+                    f'pipeline-{i}': {'count': _n(), 'time_in_millis': _n(), 'current': 0, 'failed': 0,
+                                      'processors': [{'set': {'type': 'set', 'stats': {
+                                          'count': _n(), 'time_in_millis': _n(), 'current': 0, 'failed': 0}}}]}
+                    for i in range(5)
+                }
+            }
+        }
+    return {
+        '_nodes': {'total': node_size, 'successful': node_size, 'failed': 0},
+        'cluster_name': 'benchmark',
+        'nodes': node_dict
+    }
+
+
+def indices_stats(index_size: int = 5000, seed: int = 0) -> Dict[str, Any]:
+    rnd: random.Random = random.Random(seed)
+    index_dict: Dict[str, Any] = {
+        f'logs-{index_index // 30:04d}.{index_index % 30:02d}': {
+            'uuid': f'{index_index:022d}',
+            'primaries': _index_section(rnd),
+            'total': _index_section(rnd)
+        }
+        for index_index in range(index_size)
+    }
+    return {
+        '_shards': {'total': index_size * 2, 'successful': index_size * 2, 'failed': 0},
+        '_all': {'primaries': _index_section(rnd), 'total': _index_section(rnd)},
+        'indices': index_dict
+    }
+
+
+def cat_indices(index_size: int = 5000, seed: int = 0) -> List[Dict[str, Any]]:
+    rnd: random.Random = random.Random(seed)
+    return [
+        {
+            'index': f'logs-{index_index // 30:04d}.{index_index % 30:02d}', 'health': 'green',
+            'pri': '1', 'rep': '1', 'docs.count': str(rnd.randint(0, 10 ** 9)),
+            'docs.deleted': str(rnd.randint(0, 10 ** 6)), 'store.size': str(rnd.randint(0, 10 ** 12)),
+            'pri.store.size': str(rnd.randint(0, 10 ** 12))
+        }
+        for index_index in range(index_size)
+    ]
+
+
+def cat_shards(shard_size: int = 50000, node_size: int = 100, seed: int = 0) -> List[Dict[str, Any]]:
+    # primaries and replicas of 5 shard indices spread over the nodes, a few replicas are unassigned
+    rnd: random.Random = random.Random(seed)
+    row_list: List[Dict[str, Any]] = []
+    for shard_index in range(shard_size):
+        index_index, prirep_index = divmod(shard_index, 2)
+        node: Optional[str] = f'es-node-{rnd.randrange(node_size)}'
+        if prirep_index and rnd.random() < 0.001:
+            node = None
+        row_list.append({
+            'index': f'logs-{index_index // 5 // 30:04d}.{index_index // 5 % 30:02d}', 'shard': str(index_index % 5),
+            'prirep': 'r' if prirep_index else 'p', 'state': 'STARTED' if node else 'UNASSIGNED', 'node': node,
+            'docs': str(rnd.randint(0, 10 ** 8)) if node else None,
+            'store': str(rnd.randint(0, 10 ** 11)) if node else None,
+            'indexing.index_total': str(rnd.randint(0, 10 ** 8)) if node else None
+        })
+    return row_list
+
+
+def cluster_health(node_size: int = 100) -> Dict[str, Any]:
+    return {
+        'cluster_name': 'benchmark', 'status': 'green', 'timed_out': False, 'number_of_nodes': node_size,
+        'number_of_data_nodes': node_size, 'active_primary_shards': node_size * 10,
+        'active_shards': node_size * 20, 'relocating_shards': 0, 'initializing_shards': 0, 'unassigned_shards': 0,
+        'delayed_unassigned_shards': 0, 'number_of_pending_tasks': 0, 'number_of_in_flight_fetch': 0,
+        'task_max_waiting_in_queue_millis': 0, 'active_shards_percent_as_number': 100.0
+    }
+
+
+# terms buckets by service with the doc count and some metric sub-aggregations of every bucket
+search_query_json: Dict[str, Any] = {
+    'size': 0,
+    'aggs': {
+        'service': {
+            'terms': {'field': 'service', 'size': 10000},
+            'aggs': {
+                'latency': {'avg': {'field': 'latency'}},
+                'bytes': {'sum': {'field': 'bytes'}},
+                'status': {'stats': {'field': 'status'}}
+            }
+        }
+    }
+}
+
+
+def search_aggregations(bucket_size: int = 1000, seed: int = 0) -> Dict[str, Any]:
+    rnd: random.Random = random.Random(seed)
+    return {
+        'took': 42, 'timed_out': False,
+        '_shards': {'total': 10, 'successful': 10, 'skipped': 0, 'failed': 0},
+        'hits': {'total': {'value': 10000, 'relation': 'gte'}, 'max_score': None, 'hits': []},
+        'aggregations': {
+            'service': {
+                'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0,
+                'buckets': [
+                    {
+                        'key': f'service-{bucket_index:05d}', 'doc_count': rnd.randint(0, 10 ** 6),
+                        'latency': {'value': rnd.random() * 1000},
+                        'bytes': {'value': float(rnd.randint(0, 10 ** 9))},
+                        'status': {'count': 100, 'min': 200.0, 'max': 503.0, 'avg': 230.5, 'sum': 23050.0}
+                    }
+                    for bucket_index in range(bucket_size)
+                ]
+            }
+        }
+    }
+
+
+def load(path: Optional[str], factory: Callable[[], Any]) -> Any:
+    # a recorded response(saved with `curl host:9200/_nodes/stats > nodes_stats.json`) takes precedence
+    if not path:
+        return factory()
+    with open(path, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,115 @@
+# RSS of the published snapshots of a synthetic(or recorded) cluster, with the compact families and with
+# the GaugeMetricFamily families used before:
+# python -m benchmark.memory [--node-size 100] [--index-size 5000]
+import argparse
+import gc
+import multiprocessing
+import resource
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from prometheus_client.core import GaugeMetricFamily
+
+from elasticsearch_exporter.collector import EsNodeCollector, IndicesStatsCollector
+from elasticsearch_exporter.collector.base import BaseEsCollector
+
+from benchmark import fixture
+
+
+class LegacyFamilyMixin(object):
+    def get_family(
+            self, family_dict: Dict[str, GaugeMetricFamily], metric_name: str, metric_doc: str, labels: List[str]
+    ) -> GaugeMetricFamily:
+        g: Optional[GaugeMetricFamily] = family_dict.get(metric_name, None)
+        if g is None:
+            g = GaugeMetricFamily(metric_name, metric_doc, labels=labels)
+            family_dict[metric_name] = g
+        return g
+
+
+class LegacyEsNodeCollector(LegacyFamilyMixin, EsNodeCollector):
+    pass
+
+
+class LegacyIndicesStatsCollector(LegacyFamilyMixin, IndicesStatsCollector):
+    pass
+
+
+def get_rss() -> int:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak rss, KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(
+        collector_class_list: List[Type[BaseEsCollector]],
+        response_list: List[Any],
+        result_queue: 'multiprocessing.Queue'
+) -> None:
+    config: Dict[str, Any] = {
+        'global': {'interval': '1m', 'jitter': 0, 'const_labels': {'cluster': 'benchmark'}},
+        'es_node': {'interval': '1m'},
+        'indices_stats': {'interval': '1m'},
+    }
+    gc.collect()
+    start_rss: int = get_rss()
+    start_time: float = time.perf_counter()
+    collector_list: List[BaseEsCollector] = []
+    sample_count: int = 0
+    exposition_size: int = 0
+    for collector_class, response in zip(collector_class_list, response_list):
+        collector: BaseEsCollector = collector_class(None, config)
+        collector.publish_snapshot(collector.fetch_metric(response), time.perf_counter())
+        collector_list.append(collector)
+        sample_count += sum(len(family.samples) for family in collector._snapshot.family_tuple)
+        exposition_size += sum(len(exposition.gzip_text) for exposition in collector.exposition_list())
+    cost: float = time.perf_counter() - start_time
+    gc.collect()
+    result_queue.put((get_rss() - start_rss, cost, sample_count, exposition_size))
+
+
+def bench(name: str, collector_class_list: List[Type[BaseEsCollector]], response_list: List[Any]) -> Tuple[int, float]:
+    # every variant runs in a new process(forked after the responses are built), so the memory released by
+    # one variant does not hide the growth of the next
+    result_queue: 'multiprocessing.Queue' = multiprocessing.Queue()
+    process: multiprocessing.Process = multiprocessing.Process(
+        target=_run, args=(collector_class_list, response_list, result_queue)
+    )
+    process.start()
+    rss, cost, sample_count, exposition_size = result_queue.get()
+    process.join()
+    print(
+        f'  {name:<8} rss +{rss / 1024 / 1024:8.1f} MB  build {cost:6.2f} s  '
+        f'samples {sample_count}  gzip exposition {exposition_size / 1024 / 1024:.1f} MB'
+    )
+    return rss, cost
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument('--nodes-stats', help='recorded _nodes/stats response, default use synthetic response')
+    parser.add_argument('--indices-stats', help='recorded _stats response, default use synthetic response')
+    parser.add_argument('--node-size', type=int, default=100)
+    parser.add_argument('--index-size', type=int, default=5000)
+    args: argparse.Namespace = parser.parse_args()
+
+    multiprocessing.set_start_method('fork')
+    response_list: List[Any] = [
+        fixture.load(args.nodes_stats, partial(fixture.nodes_stats, args.node_size)),
+        fixture.load(args.indices_stats, partial(fixture.indices_stats, args.index_size)),
+    ]
+    print(f'snapshot of {args.node_size} nodes x {args.index_size} indices')
+    legacy_rss, _ = bench('legacy', [LegacyEsNodeCollector, LegacyIndicesStatsCollector], response_list)
+    compact_rss, _ = bench('compact', [EsNodeCollector, IndicesStatsCollector], response_list)
+    print(f'  {"ratio":<8} {legacy_rss / compact_rss:8.1f} x')
+
+
+if __name__ == '__main__':
+    main()
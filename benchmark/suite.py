@@ -0,0 +1,295 @@
+# Replay synthetic(or recorded) responses through the fake es and measure every collector at several cluster sizes:
+# job latency(request, decode, build, render), scrape latency, peak traced memory during a job, memory retained by
+# the snapshot and exposition size. Results are compared with the stored baseline and the exit code is 1 when a
+# scenario regressed, re-record the baseline on the machine that runs the suite:
+# python -m benchmark.suite [--quick] [--only es_node] [--recorded <dir>] [--save-baseline]
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+from functools import partial
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from prometheus_client.registry import CollectorRegistry
+
+from elasticsearch_exporter.collector import (
+    EsClusterCollector, EsNodeCollector, IndicesStatsCollector, QueryMetricCollector, ShardStatsCollector
+)
+from elasticsearch_exporter.collector.offload import OffloadPool
+from elasticsearch_exporter.exposition import ExpositionRegistry
+from elasticsearch_exporter.transport import gen_es_client
+
+from benchmark import fixture
+from benchmark.fake_es import FakeEsServer
+
+default_baseline_path: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# used by the `/offload` scenarios, the memory of its workers is not traced
+offload_pool: OffloadPool = OffloadPool({})
+
+# metric -> (kind, unit), the kind selects the tolerance
+metric_dict: Dict[str, Tuple[str, str]] = {
+    'job_seconds': ('time', 's'),
+    'scrape_seconds': ('time', 's'),
+    'peak_bytes': ('memory', 'B'),
+    'retained_bytes': ('memory', 'B'),
+    'retained_blocks': ('memory', ''),
+    'sample_count': ('size', ''),
+    'exposition_bytes': ('size', 'B'),
+    'gzip_exposition_bytes': ('size', 'B'),
+}
+
+
+class Scenario(NamedTuple):
+    name: str
+    # route of fake es -> response factory
+    response_factory_dict: Dict[str, Callable[[], Any]]
+    # es client -> (collector, job)
+    build: Callable[['Elasticsearch'], Tuple[Any, Callable[[], None]]]
+
+
+def _collector_config(key: str) -> Dict[str, Any]:
+    return {'global': {'interval': '1m', 'jitter': 0}, key: {'interval': '1m'}}
+
+
+def _build_collector(collector_class: Any, es_client: 'Elasticsearch') -> Tuple[Any, Callable[[], None]]:
+    collector: Any = collector_class(es_client, _collector_config(collector_class.key))
+    job, _ = collector.gen_job()
+    return collector, job
+
+
+def _build_offload_collector(collector_class: Any, es_client: 'Elasticsearch') -> Tuple[Any, Callable[[], None]]:
+    collector, job = _build_collector(collector_class, es_client)
+    collector.join_offload_pool(offload_pool)
+    return collector, job
+
+
+def _build_query_metric(es_client: 'Elasticsearch') -> Tuple[Any, Callable[[], None]]:
+    collector: QueryMetricCollector = QueryMetricCollector(es_client)
+    config: Dict[str, Any] = {
+        'global': {'interval': '1m', 'jitter': 0},
+        'metrics': [{
+            'name': 'bench', 'metric': 'bench', 'doc': 'benchmark query', 'index': 'logs-*',
+            'interval': '1m', 'query_json': fixture.search_query_json
+        }]
+    }
+    job, _ = next(collector.gen_job(config))
+    return collector, job
+
+
+# route of fake es -> (file name of recorded response, build)
+recorded_dict: Dict[str, Tuple[str, Callable[['Elasticsearch'], Tuple[Any, Callable[[], None]]]]] = {
+    'cluster_health': ('cluster_health.json', partial(_build_collector, EsClusterCollector)),
+    'nodes_stats': ('nodes_stats.json', partial(_build_collector, EsNodeCollector)),
+    'indices_stats': ('indices_stats.json', partial(_build_collector, IndicesStatsCollector)),
+    'search': ('search.json', _build_query_metric),
+}
+
+
+def gen_recorded_scenario_list(recorded_dir: str) -> List[Scenario]:
+    # responses saved from a real cluster, e.g. `curl host:9200/_nodes/stats > nodes_stats.json`.
+    # search.json must be the response of `fixture.search_query_json`
+    scenario_list: List[Scenario] = []
+    for route, (file_name, build) in recorded_dict.items():
+        path: str = os.path.join(recorded_dir, file_name)
+        if os.path.exists(path):
+            scenario_list.append(
+                Scenario(f'{route}/recorded', {route: partial(fixture.load, path, dict)}, build)
+            )
+    return scenario_list
+
+
+def gen_scenario_list(quick: bool) -> List[Scenario]:
+    node_size_list: List[int] = [10, 100] if quick else [10, 100, 1000]
+    index_size_list: List[int] = [100, 1000] if quick else [100, 1000, 10000]
+    bucket_size_list: List[int] = [100, 1000] if quick else [100, 1000, 10000]
+    shard_size_list: List[int] = [1000, 10000] if quick else [1000, 10000, 50000]
+    scenario_list: List[Scenario] = [
+        Scenario(
+            'es_cluster',
+            {'cluster_health': partial(fixture.cluster_health, 100)},
+            partial(_build_collector, EsClusterCollector)
+        )
+    ]
+    for node_size in node_size_list:
+        scenario_list.append(Scenario(
+            f'es_node/{node_size}',
+            {'nodes_stats': partial(fixture.nodes_stats, node_size)},
+            partial(_build_collector, EsNodeCollector)
+        ))
+    for index_size in index_size_list:
+        scenario_list.append(Scenario(
+            f'indices_stats/{index_size}',
+            {'indices_stats': partial(fixture.indices_stats, index_size)},
+            partial(_build_collector, IndicesStatsCollector)
+        ))
+    # the largest responses decoded and flattened by the offload pool
+    scenario_list.append(Scenario(
+        f'es_node/{node_size_list[-1]}/offload',
+        {'nodes_stats': partial(fixture.nodes_stats, node_size_list[-1])},
+        partial(_build_offload_collector, EsNodeCollector)
+    ))
+    scenario_list.append(Scenario(
+        f'indices_stats/{index_size_list[-1]}/offload',
+        {'indices_stats': partial(fixture.indices_stats, index_size_list[-1])},
+        partial(_build_offload_collector, IndicesStatsCollector)
+    ))
+    for shard_size in shard_size_list:
+        scenario_list.append(Scenario(
+            f'shard_stats/{shard_size}',
+            {'cat_shards': partial(fixture.cat_shards, shard_size)},
+            partial(_build_collector, ShardStatsCollector)
+        ))
+    for bucket_size in bucket_size_list:
+        scenario_list.append(Scenario(
+            f'query_metric/{bucket_size}',
+            {'search': partial(fixture.search_aggregations, bucket_size)},
+            _build_query_metric
+        ))
+    return scenario_list
+
+
+def run_scenario(scenario: Scenario, repeat: int) -> Dict[str, float]:
+    result_dict: Dict[str, float] = {}
+    with FakeEsServer(scenario.response_factory_dict) as server:
+        es_client: 'Elasticsearch' = gen_es_client([server.url], {'timeout': '5m'}, {})
+
+        # memory of one job of a new collector: peak while it runs and what its snapshot keeps afterwards
+        gc.collect()
+        tracemalloc.start()
+        start_block_count: int = sys.getallocatedblocks()
+        start_bytes, _ = tracemalloc.get_traced_memory()
+        collector, job = scenario.build(es_client)
+        job()
+        gc.collect()
+        end_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        result_dict['retained_blocks'] = sys.getallocatedblocks() - start_block_count
+        tracemalloc.stop()
+        result_dict['peak_bytes'] = peak_bytes - start_bytes
+        result_dict['retained_bytes'] = end_bytes - start_bytes
+
+        exposition_registry: ExpositionRegistry = ExpositionRegistry(CollectorRegistry())
+        exposition_registry.register_cached(collector)
+        job_cost_list: List[float] = []
+        scrape_cost_list: List[float] = []
+        for _ in range(repeat):
+            start_time: float = time.perf_counter()
+            job()
+            job_cost_list.append(time.perf_counter() - start_time)
+            start_time = time.perf_counter()
+            _, text = exposition_registry.render(None, False)
+            scrape_cost_list.append(time.perf_counter() - start_time)
+        result_dict['job_seconds'] = round(statistics.median(job_cost_list), 6)
+        result_dict['scrape_seconds'] = round(statistics.median(scrape_cost_list), 6)
+
+        _, gzip_text = exposition_registry.render(None, True)
+        result_dict['exposition_bytes'] = len(text)
+        result_dict['gzip_exposition_bytes'] = len(gzip_text)
+        result_dict['sample_count'] = sum(
+            1 for line in text.split(b'\n') if line and not line.startswith(b'#')
+        )
+    return result_dict
+
+
+def _format(value: float, unit: str) -> str:
+    if unit == 's':
+        return f'{value * 1000:.2f}ms'
+    if unit == 'B':
+        return f'{value / 1024:.1f}KB'
+    return f'{value:.0f}'
+
+
+def compare(
+        name: str,
+        result_dict: Dict[str, float],
+        baseline_dict: Optional[Dict[str, float]],
+        tolerance_dict: Dict[str, float]
+) -> List[str]:
+    # return the regressed metrics
+    regression_list: List[str] = []
+    cell_list: List[str] = []
+    for metric, (kind, unit) in metric_dict.items():
+        value: float = result_dict[metric]
+        cell: str = f'{metric}={_format(value, unit)}'
+        baseline: Optional[float] = (baseline_dict or {}).get(metric, None)
+        if baseline is not None:
+            # a tiny baseline(e.g. the memory of a 100 sample scenario) is noise, at least 1ms / 64KB of slack
+            slack: float = {'time': 0.001, 'memory': 65536 if unit == 'B' else 1024, 'size': 0}[kind]
+            limit: float = baseline * (1 + tolerance_dict[kind]) + slack
+            if baseline:
+                cell += f'({(value - baseline) / baseline:+.0%})'
+            if value > limit:
+                cell += '!'
+                regression_list.append(f'{name} {metric}: {value:.6g} > {limit:.6g}(baseline {baseline:.6g})')
+        cell_list.append(cell)
+    print(f'{name:<20} ' + ' '.join(cell_list))
+    return regression_list
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true', help='skip the largest cluster of every collector')
+    parser.add_argument('--only', help='regex of the scenario names to run')
+    parser.add_argument('--recorded', help='dir of recorded responses, each one adds a `<route>/recorded` scenario')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=default_baseline_path)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.5)
+    parser.add_argument('--memory-tolerance', type=float, default=0.2)
+    parser.add_argument('--size-tolerance', type=float, default=0.02)
+    args: argparse.Namespace = parser.parse_args()
+
+    # the fake es and its responses are built in a forked child
+    multiprocessing.set_start_method('fork')
+    baseline_dict: Dict[str, Dict[str, float]] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline_dict = json.load(f)['scenario']
+    tolerance_dict: Dict[str, float] = {
+        'time': args.time_tolerance, 'memory': args.memory_tolerance, 'size': args.size_tolerance
+    }
+
+    result_dict: Dict[str, Dict[str, float]] = {}
+    regression_list: List[str] = []
+    scenario_list: List[Scenario] = gen_scenario_list(args.quick)
+    if args.recorded:
+        scenario_list.extend(gen_recorded_scenario_list(args.recorded))
+    for scenario in scenario_list:
+        if args.only and not re.search(args.only, scenario.name):
+            continue
+        result_dict[scenario.name] = run_scenario(scenario, args.repeat)
+        regression_list.extend(compare(
+            scenario.name, result_dict[scenario.name], baseline_dict.get(scenario.name, None), tolerance_dict
+        ))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'machine': platform.machine(),
+                    # scenarios that did not run keep their old baseline
+                    'scenario': dict(baseline_dict, **result_dict)
+                },
+                f,
+                indent=2,
+                sort_keys=True
+            )
+        print(f'baseline saved to {args.baseline}')
+        return
+    if regression_list:
+        print('regression:')
+        for regression in regression_list:
+            print(f'  {regression}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
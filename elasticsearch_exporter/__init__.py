@@ -5,16 +5,23 @@ import sys
 
 import yaml
 from logging.handlers import SysLogHandler
-from typing import Any, Dict, List, Type
+from typing import Any, Dict, List, Optional
 
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BaseScheduler, BackgroundScheduler
-from elasticsearch import Elasticsearch
-from prometheus_client.exposition import start_http_server
 from prometheus_client.core import REGISTRY
-
-from elasticsearch_exporter import collector
-from elasticsearch_exporter.collector.base import BaseEsCollector
-
+from prometheus_client.gc_collector import GC_COLLECTOR
+from prometheus_client.platform_collector import PLATFORM_COLLECTOR
+from prometheus_client.process_collector import PROCESS_COLLECTOR
+
+from elasticsearch_exporter.async_engine import AsyncEngine
+from elasticsearch_exporter.cluster_target import ClusterTarget, gen_cluster_config_list
+from elasticsearch_exporter.collector.offload import OffloadPool
+from elasticsearch_exporter.exposition import ExpositionRegistry
+from elasticsearch_exporter.http_server import start_http_server
+from elasticsearch_exporter.profiler import SamplingProfiler
+from elasticsearch_exporter.scheduler import JobScheduler, gen_job_default_dict
+from elasticsearch_exporter.self_metric import cluster_target_up_gauge
 from elasticsearch_exporter.utils import shutdown
 
 
@@ -22,9 +29,21 @@ from elasticsearch_exporter.utils import shutdown
 def main():
     parser: 'argparse.ArgumentParser' = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", default='./config.yaml', help='metric config; default use ./config.yml')
-    parser.add_argument("--es_cluster", help='es node host. eg 127.0.0.1:9200 or 127.0.0.1:9200,127.0.0.2:9200')
+    parser.add_argument("--es_cluster", help='es node host. eg 127.0.0.1:9200 or 127.0.0.1:9200,127.0.0.2:9200, '
+                                          'not used when `clusters` is in config')
     parser.add_argument("--listen_port", default=9206, help='server port that provide data to prometheus')
     parser.add_argument("--log_level", default='INFO', help='log level')
+    parser.add_argument(
+        "--disable_process_metric",
+        action='store_true',
+        help='not export the process/platform/gc metric of exporter, so the ETag of response only changes '
+             'when a scheduler job publish new data'
+    )
+    parser.add_argument(
+        "--enable_debug_profile",
+        action='store_true',
+        help='serve `/debug/profile?seconds=N`, which returns a sampling profile(collapsed stacks) of the exporter'
+    )
     parser.add_argument("--apscheduler_log_level", default='WARNING', help='scheduler log level(when scheduler enable)')
     parser.add_argument(
         "--syslog_address",
@@ -60,66 +79,73 @@ def main():
 
     logging.basicConfig(**basic_config)
 
-    if not args.es_cluster:
-        logging.error('not found es cluster. exit....')
-        sys.exit()
-
-    es_cluster_list: List[str] = args.es_cluster.split(',')
+    es_cluster_list: List[str] = args.es_cluster.split(',') if args.es_cluster else []
     listen_port: int = int(args.listen_port)
     config_filename_path: str = args.config
 
-    start_http_server(listen_port)
+    if not os.path.exists(config_filename_path):
+        logging.error("Can't found config path. exit ...")
+        sys.exit()
+    logging.info(f'reading custom metric from {config_filename_path}')
+    with open(config_filename_path, 'r') as config_file:
+        custom_metric_config: Dict[str, Any] = yaml.load(config_file, Loader=yaml.FullLoader)
+    if not es_cluster_list and not custom_metric_config.get('clusters', None):
+        logging.error('not found es cluster. exit....')
+        sys.exit()
+
+    if args.disable_process_metric:
+        for default_collector in (PROCESS_COLLECTOR, PLATFORM_COLLECTOR, GC_COLLECTOR):
+            REGISTRY.unregister(default_collector)
+    # the output of scheduler collector is rendered when it is published, others are rendered per scrape
+    exposition_registry: ExpositionRegistry = ExpositionRegistry(REGISTRY)
+
+    scheduler_config: Dict[str, Any] = custom_metric_config.get('global', {}).get('scheduler', None) or {}
+    job_default_dict: Dict[str, Any] = gen_job_default_dict(scheduler_config)
+    async_engine: Optional[AsyncEngine] = None
+    if 'async' in custom_metric_config.get('global', {}):
+        async_engine = AsyncEngine(custom_metric_config['global']['async'] or {}, job_default_dict)
+        scheduler: 'BaseScheduler' = async_engine.scheduler
+    else:
+        # a dedicated pool bounds the number of concurrently running collector jobs
+        scheduler = BackgroundScheduler(
+            executors={'default': ThreadPoolExecutor(int(scheduler_config.get('max_workers', 10)))},
+            job_defaults=job_default_dict
+        )
+    job_scheduler: JobScheduler = JobScheduler(scheduler, scheduler_config)
+    offload_pool: Optional[OffloadPool] = None
+    if 'offload' in custom_metric_config.get('global', {}):
+        offload_pool = OffloadPool(custom_metric_config['global']['offload'] or {})
+
+    # all clusters share the scheduler(and its worker pool), the async engine and the offload pool
+    target_dict: Dict[str, ExpositionRegistry] = {}
+    has_generator_metric: bool = False
+    for cluster_config in gen_cluster_config_list(custom_metric_config, es_cluster_list):
+        # a cluster that fails to start is reported and skipped, the other clusters are still served
+        try:
+            target: ClusterTarget = ClusterTarget(cluster_config)
+            target.add_job(job_scheduler, async_engine, offload_pool)
+        except Exception as e:
+            logging.exception(f'start cluster:{cluster_config.name or cluster_config.host_list} error:{e}')
+            cluster_target_up_gauge.labels(cluster_config.name or '').set(0)
+            continue
+        cluster_target_up_gauge.labels(cluster_config.name or '').set(1)
+        exposition_registry.register_cached(target.exposition_registry)
+        has_generator_metric = has_generator_metric or target.has_generator_metric
+        if target.name:
+            target_dict[target.name] = target.exposition_registry
+
+    profiler: Optional[SamplingProfiler] = SamplingProfiler() if args.enable_debug_profile else None
+    start_http_server(listen_port, exposition_registry, target_dict, profiler=profiler)
     logging.info(f'Server started on port {listen_port}')
 
-    es_client: 'Elasticsearch' = Elasticsearch(es_cluster_list, verify_certs=False)
-    if os.path.exists(config_filename_path):
-        logging.info(f'reading custom metric from {config_filename_path}')
-        with open(config_filename_path, 'r') as config_file:
-            custom_metric_config: Dict[str, Any] = yaml.load(config_file, Loader=yaml.FullLoader)
-
-        scheduler: 'BaseScheduler' = BackgroundScheduler()
-
-        # register custom metric
-        if 'metrics' in custom_metric_config:
-            query_metric_collector: 'collector.QueryMetricCollector' = collector.QueryMetricCollector(es_client)
-            REGISTRY.register(query_metric_collector)
-
-            for job, config in query_metric_collector.gen_job(custom_metric_config):
-                scheduler.add_job(
-                    job, 'interval', seconds=config['interval'], name=config['name'], jitter=config['jitter']
-                )
-
-        # register es self metric
-        has_generator_metric: bool = False
-        for es_system_class_name in dir(collector):
-            if not es_system_class_name.endswith('Collector') \
-                    or es_system_class_name == collector.QueryMetricCollector.__name__:
-                continue
-            collector_class: 'Type[BaseEsCollector]' = getattr(collector, es_system_class_name, ...)
-            if collector_class is ...:
-                continue
-            if collector_class.key not in custom_metric_config:
-                continue
-            collector_instance: BaseEsCollector = collector_class(es_client, custom_metric_config)
-            logging.info(f'enable {es_system_class_name}. enable_scheduler: {collector_instance.enable_scheduler}')
-            REGISTRY.register(collector_instance)
-            if collector_instance.enable_scheduler:
-                job, config = collector_instance.gen_job()
-                scheduler.add_job(
-                    job, 'interval', seconds=config['interval'], name=config['name'], jitter=config['jitter']
-                )
-            else:
-                has_generator_metric = True
-
-        logging.getLogger('apscheduler.executors.default').setLevel(getattr(logging, apscheduler_log_level))
-        if not scheduler.get_jobs():
-            if not has_generator_metric:
-                logging.error("not found scheduler job and generator metric job")
-                sys.exit()
-            else:
-                logging.info("not found scheduler job")
+    logging.getLogger('apscheduler.executors.default').setLevel(getattr(logging, apscheduler_log_level))
+    if not job_scheduler.schedule():
+        if not has_generator_metric:
+            logging.error("not found scheduler job and generator metric job")
+            sys.exit()
         else:
-            scheduler.start()
+            logging.info("not found scheduler job")
+    elif async_engine:
+        async_engine.start()
     else:
-        logging.error("Can't found config path. exit ...")
-        sys.exit()
+        scheduler.start()
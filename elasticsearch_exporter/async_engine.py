@@ -0,0 +1,90 @@
+import asyncio
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from elasticsearch_exporter.collector.base import interval_handle
+from elasticsearch_exporter.transport import gen_async_es_client
+
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+
+
+class AsyncEngine(object):
+    # Run scheduler job on an event loop in a background thread, so the request of all collector and
+    # custom query are send concurrently(limited by `concurrency`) and one slow request can not delay the others.
+    # The loop, scheduler and concurrency limit are shared by all clusters, see `bind`
+    def __init__(self, config: Dict[str, Any], job_default_dict: Dict[str, Any]):
+        try:
+            from elasticsearch import AsyncElasticsearch  # noqa: F401
+        except ImportError:
+            raise RuntimeError('async mode requires the async es client, please install `elasticsearch[async]`')
+
+        self.concurrency: int = int(config.get('concurrency', 10))
+        self.timeout: int = interval_handle(config.get('timeout', '30s'))
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.scheduler: AsyncIOScheduler = AsyncIOScheduler(event_loop=self.loop, job_defaults=job_default_dict)
+        # flatten, build, derive and render of the jobs run in this pool, only the requests run on the loop,
+        # so a large collector does not delay the requests of the others
+        self.build_worker_size: int = int(config.get('build_workers', 4))
+        self.build_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            self.build_worker_size, thread_name_prefix='es_exporter_build'
+        )
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def bind(
+            self,
+            es_cluster_list: List[str],
+            transport_config: Dict[str, Any],
+            auth_config: Dict[str, Any],
+            cluster: str = ''
+    ) -> 'ClusterAsyncEngine':
+        return ClusterAsyncEngine(self, gen_async_es_client(es_cluster_list, transport_config, auth_config, cluster))
+
+    async def request(
+            self, func: Callable[[Any], Union[Awaitable[Any], Any]], es_client: 'AsyncElasticsearch'
+    ) -> Any:
+        # always called in the event loop thread
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            response: Union[Awaitable[Any], Any] = func(es_client)
+            if not inspect.isawaitable(response):
+                # e.g. the collector can answer from its cache without sending a request
+                return response
+            return await asyncio.wait_for(response, self.timeout)
+
+    async def run_in_executor(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.build_executor, partial(func, *args))
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='es_exporter_async_engine', daemon=True)
+        self._thread.start()
+        self.scheduler.start()
+        logging.info(
+            f'async engine started. concurrency: {self.concurrency} timeout: {self.timeout}s'
+            f' build_workers: {self.build_worker_size}'
+        )
+
+
+class ClusterAsyncEngine(object):
+    # the engine seen by the collectors of one cluster
+    def __init__(self, engine: AsyncEngine, es_client: 'AsyncElasticsearch'):
+        self.engine: AsyncEngine = engine
+        self.es_client: 'AsyncElasticsearch' = es_client
+
+    async def request(self, func: Callable[[Any], Union[Awaitable[Any], Any]]) -> Any:
+        return await self.engine.request(func, self.es_client)
+
+    async def run_in_executor(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await self.engine.run_in_executor(func, *args)
@@ -0,0 +1,156 @@
+import copy
+import logging
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Type
+
+from elasticsearch import Elasticsearch
+from prometheus_client.registry import CollectorRegistry
+
+from elasticsearch_exporter import collector
+from elasticsearch_exporter.async_engine import AsyncEngine, ClusterAsyncEngine
+from elasticsearch_exporter.collector.base import BaseEsCollector
+from elasticsearch_exporter.collector.breaker import BreakerGroup
+from elasticsearch_exporter.collector.offload import OffloadPool
+from elasticsearch_exporter.exposition import ExpositionRegistry
+from elasticsearch_exporter.scheduler import JobScheduler
+from elasticsearch_exporter.transport import TransportCollector, gen_es_client
+
+auth_key_tuple: Tuple[str, ...] = (
+    'username', 'password', 'api_key', 'ca_certs', 'client_cert', 'client_key', 'verify_certs', 'use_ssl'
+)
+
+
+class ClusterConfig(NamedTuple):
+    name: Optional[str]
+    host_list: List[str]
+    auth_config: Dict[str, Any]
+    # the same layout as the config file without `clusters`
+    config: Dict[str, Any]
+
+
+def gen_cluster_config_list(config: Dict[str, Any], es_cluster_list: List[str]) -> List[ClusterConfig]:
+    # Without `clusters` the exporter serves the cluster of `--es_cluster` as before(no `cluster` label).
+    # A section of a cluster(e.g. `es_node`, `metrics`) replaces the top-level section with the same key,
+    # a section set to null disables it for that cluster, and `global` is merged key by key
+    base_config: Dict[str, Any] = {key: value for key, value in config.items() if key != 'clusters'}
+    base_config.setdefault('global', {})
+    cluster_list: Optional[List[Dict[str, Any]]] = config.get('clusters', None)
+    if not cluster_list:
+        return [ClusterConfig(None, es_cluster_list, {}, copy.deepcopy(base_config))]
+    if es_cluster_list:
+        logging.warning('found `clusters` in config, --es_cluster is ignored')
+
+    cluster_config_list: List[ClusterConfig] = []
+    name_set: set = set()
+    for cluster_dict in cluster_list:
+        name: str = cluster_dict.get('name', '')
+        if not name or name in name_set:
+            raise RuntimeError(f'cluster name must be unique and not empty, got:{name!r}')
+        name_set.add(name)
+        hosts: Any = cluster_dict.get('hosts', None)
+        if not hosts:
+            raise RuntimeError(f'not found hosts of cluster:{name}')
+        host_list: List[str] = hosts.split(',') if isinstance(hosts, str) else list(hosts)
+
+        cluster_config: Dict[str, Any] = copy.deepcopy(base_config)
+        for key, value in cluster_dict.items():
+            if key in ('name', 'hosts') or key in auth_key_tuple:
+                continue
+            if key == 'global':
+                cluster_config['global'].update(copy.deepcopy(value or {}))
+            elif value is None:
+                cluster_config.pop(key, None)
+            else:
+                cluster_config[key] = copy.deepcopy(value)
+        cluster_config['global']['const_labels'] = dict(
+            cluster_config['global'].get('const_labels', None) or {}, cluster=name
+        )
+        auth_config: Dict[str, Any] = {key: cluster_dict[key] for key in auth_key_tuple if key in cluster_dict}
+        cluster_config_list.append(ClusterConfig(name, host_list, auth_config, cluster_config))
+    return cluster_config_list
+
+
+class ClusterTarget(object):
+    # Collectors of one es cluster with their own es client. Failures stay inside the target: every collector
+    # keeps its own snapshot and the jobs of other clusters are independent of its requests
+    def __init__(self, cluster_config: ClusterConfig):
+        self.name: Optional[str] = cluster_config.name
+        self.host_list: List[str] = cluster_config.host_list
+        self.auth_config: Dict[str, Any] = cluster_config.auth_config
+        self.config: Dict[str, Any] = cluster_config.config
+        self.transport_config: Dict[str, Any] = self.config['global'].get('transport', None) or {}
+        self.const_label_dict: Dict[str, str] = self.config['global'].get('const_labels', None) or {}
+        self.es_client: 'Elasticsearch' = gen_es_client(
+            self.host_list, self.transport_config, self.auth_config, self.name or ''
+        )
+
+        # collectors fetched on scrape, scheduler collectors are rendered when they publish
+        self.registry: CollectorRegistry = CollectorRegistry()
+        self.exposition_registry: ExpositionRegistry = ExpositionRegistry(self.registry)
+        self.transport_collector: TransportCollector = TransportCollector(self.es_client, self.const_label_dict)
+        self.registry.register(self.transport_collector)
+        self.has_generator_metric: bool = False
+        # es under pressure is protected from all collectors of the cluster, not only the one that noticed
+        self.breaker_group: BreakerGroup = BreakerGroup(self.config['global'].get('breaker', None))
+
+    def add_job(
+            self,
+            job_scheduler: JobScheduler,
+            async_engine: Optional[AsyncEngine],
+            offload_pool: Optional[OffloadPool] = None
+    ) -> None:
+        cluster_engine: Optional[ClusterAsyncEngine] = None
+        if async_engine:
+            cluster_engine = async_engine.bind(
+                self.host_list, self.transport_config, self.auth_config, self.name or ''
+            )
+            self.transport_collector.async_es_client = cluster_engine.es_client
+        job_prefix: str = f'{self.name}/' if self.name else ''
+        # jobs are added to the scheduler when all collectors are created, so a cluster that fails to start
+        # leaves no job behind
+        job_list: List[Tuple[Callable, Dict[str, Any]]] = []
+
+        # register custom metric
+        if 'metrics' in self.config:
+            query_metric_collector: 'collector.QueryMetricCollector' = collector.QueryMetricCollector(
+                self.es_client, self.const_label_dict
+            )
+            query_metric_collector.join_breaker_group(self.breaker_group)
+            self.exposition_registry.register_cached(query_metric_collector)
+
+            if cluster_engine:
+                job_iterator: Iterator[Tuple[Callable, Dict[str, Any]]] = query_metric_collector.gen_async_job(
+                    self.config, cluster_engine
+                )
+            else:
+                job_iterator = query_metric_collector.gen_job(self.config)
+            job_list.extend(job_iterator)
+
+        # register es self metric
+        for es_system_class_name in dir(collector):
+            if not es_system_class_name.endswith('Collector') \
+                    or es_system_class_name == collector.QueryMetricCollector.__name__:
+                continue
+            collector_class: 'Type[BaseEsCollector]' = getattr(collector, es_system_class_name, ...)
+            if collector_class is ...:
+                continue
+            if collector_class.key not in self.config:
+                continue
+            collector_instance: BaseEsCollector = collector_class(self.es_client, self.config)
+            collector_instance.join_breaker_group(self.breaker_group)
+            if offload_pool is not None:
+                collector_instance.join_offload_pool(offload_pool)
+            logging.info(
+                f'{job_prefix}enable {es_system_class_name}. enable_scheduler: {collector_instance.enable_scheduler}'
+            )
+            if collector_instance.enable_scheduler:
+                self.exposition_registry.register_cached(collector_instance)
+                if cluster_engine:
+                    job, config = collector_instance.gen_async_job(cluster_engine)
+                else:
+                    job, config = collector_instance.gen_job()
+                job_list.append((job, config))
+            else:
+                self.registry.register(collector_instance)
+                self.has_generator_metric = True
+        for job, config in job_list:
+            job_scheduler.add_job(job, config, config['name'], self.name or '')
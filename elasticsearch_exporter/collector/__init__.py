@@ -2,3 +2,4 @@ from .cluster import EsClusterCollector
 from .es_node import EsNodeCollector
 from .indices import IndicesStatsCollector
 from .query_metric import QueryMetricCollector
+from .shard import ShardStatsCollector
@@ -0,0 +1,129 @@
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .compact import CompactGaugeFamily, LabelInterner
+from .flatten import invalid_metric_char_re
+from .limit import SeriesLimiter
+
+
+class AggregationsConverter(object):
+    # Convert the aggregations of a search response(page by page for composite aggregation) into families.
+    # Buckets are walked with an explicit stack and every leaf bucket writes its label tuple straight into
+    # the family, the doc_count of leaf bucket goes to `<metric>_aggregations` and every metric
+    # sub-aggregation(sum, avg, max, stats...) goes to `<metric>_aggregations_<name>[_<field>]`
+    def __init__(
+            self,
+            metric: str,
+            doc: str,
+            query_json: Dict[str, Any],
+            max_page: int = 100,
+            series_limiter: Optional[SeriesLimiter] = None,
+            mismatch_family_set: Optional[Set[str]] = None
+    ):
+        self.metric: str = metric
+        self.doc: str = doc
+        self.query_json: Dict[str, Any] = query_json
+        self.max_page: int = max_page
+        self.page: int = 0
+        # buckets are limited after every page, so a high cardinality composite aggregation never holds all buckets
+        self.series_limiter: Optional[SeriesLimiter] = series_limiter
+        self._label_interner: LabelInterner = LabelInterner()
+        self.family_dict: Dict[str, CompactGaugeFamily] = {}
+        self.label_key_dict: Dict[str, Tuple[str, ...]] = {}
+        # families whose mismatched labels were already warned, shared by the runs of a query so it is warned once
+        self.mismatch_family_set: Set[str] = mismatch_family_set if mismatch_family_set is not None else set()
+
+    def _add_sample(
+            self, name: str, label_key_tuple: Tuple[str, ...], label_value_tuple: Tuple[str, ...], value: Any
+    ) -> None:
+        family_name: str = self.metric + '_aggregations'
+        if name:
+            family_name = invalid_metric_char_re.sub('_', f'{family_name}_{name}')
+        g: Optional[CompactGaugeFamily] = self.family_dict.get(family_name, None)
+        if g is None:
+            g = CompactGaugeFamily(
+                family_name,
+                self.doc + f' custom query {name + " " if name else ""}{",".join(label_key_tuple)}'.rstrip(),
+                label_key_tuple,
+                self._label_interner
+            )
+            self.family_dict[family_name] = g
+            self.label_key_dict[family_name] = label_key_tuple
+        elif self.label_key_dict[family_name] != label_key_tuple:
+            # sibling bucket aggregations with the same sub-aggregation name but other labels
+            if family_name not in self.mismatch_family_set:
+                self.mismatch_family_set.add(family_name)
+                logging.warning(
+                    f'{family_name} labels:{self.label_key_dict[family_name]} not match {label_key_tuple}, '
+                    f'the buckets are dropped, rename the sub-aggregations of the sibling aggregations'
+                )
+            return
+        g.add_metric(label_value_tuple, value)
+
+    def _add_leaf(
+            self, bucket_dict: Dict[str, Any], label_key_tuple: Tuple[str, ...], label_value_tuple: Tuple[str, ...]
+    ) -> None:
+        if label_value_tuple and 'doc_count' in bucket_dict:
+            self._add_sample('', label_key_tuple, label_value_tuple, bucket_dict['doc_count'])
+        for name, value in bucket_dict.items():
+            if name == 'key' or type(value) is not dict:
+                continue
+            if 'value' in value:
+                if type(value['value']) in (int, float):
+                    self._add_sample(name, label_key_tuple, label_value_tuple, value['value'])
+                continue
+            # multi-value metric aggregation, e.g. stats
+            for field, field_value in value.items():
+                if type(field_value) in (int, float):
+                    self._add_sample(f'{name}_{field}', label_key_tuple, label_value_tuple, field_value)
+
+    def convert(self, aggregations_dict: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # return the query body of next page when the response has a composite aggregation with `after_key`
+        self.page += 1
+        stack: List[Tuple[Dict[str, Any], Tuple[str, ...], Tuple[str, ...]]] = [(aggregations_dict, (), ())]
+        while stack:
+            container_dict, label_key_tuple, label_value_tuple = stack.pop()
+            is_leaf: bool = True
+            for name, value in container_dict.items():
+                if type(value) is not dict or 'buckets' not in value:
+                    continue
+                is_leaf = False
+                buckets: Any = value['buckets']
+                bucket_iter = buckets.items() if isinstance(buckets, dict) else ((None, i) for i in buckets)
+                for bucket_key, bucket_dict in bucket_iter:
+                    if bucket_key is None:
+                        bucket_key = bucket_dict['key']
+                    if isinstance(bucket_key, dict):
+                        # composite aggregation
+                        stack.append((
+                            bucket_dict,
+                            label_key_tuple + tuple(bucket_key.keys()),
+                            label_value_tuple + tuple(str(i) for i in bucket_key.values())
+                        ))
+                    else:
+                        stack.append((bucket_dict, label_key_tuple + (name,), label_value_tuple + (str(bucket_key),)))
+            if is_leaf:
+                self._add_leaf(container_dict, label_key_tuple, label_value_tuple)
+        if self.series_limiter is not None:
+            self.series_limiter.limit(self.family_list, lazy=True)
+        return self._next_page_query(aggregations_dict)
+
+    def _next_page_query(self, aggregations_dict: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        for name, value in aggregations_dict.items():
+            if type(value) is not dict or not value.get('after_key') or not value.get('buckets'):
+                continue
+            if self.page >= self.max_page:
+                logging.warning(f'{self.metric} composite aggregation reach max page:{self.max_page}, stop paging')
+                return None
+            aggs_key: str = 'aggs' if 'aggs' in self.query_json else 'aggregations'
+            aggs_dict: Dict[str, Any] = self.query_json[aggs_key]
+            agg_dict: Dict[str, Any] = dict(
+                aggs_dict[name], composite=dict(aggs_dict[name]['composite'], after=value['after_key'])
+            )
+            # the sibling aggregations are converted with the first page, later pages only carry the composite one
+            return dict(self.query_json, **{aggs_key: {name: agg_dict}})
+        return None
+
+    @property
+    def family_list(self) -> List[CompactGaugeFamily]:
+        return list(self.family_dict.values())
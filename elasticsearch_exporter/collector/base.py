@@ -1,9 +1,25 @@
+import asyncio
 import logging
-import re
-from typing import Any, Callable, Dict, Generator, List, Tuple, Optional, Set, Union
+import time
+from typing import (
+    TYPE_CHECKING, Any, Awaitable, Callable, Dict, Generator, Iterable, List, NamedTuple, Tuple, Optional, Union
+)
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout
-from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.core import GaugeMetricFamily, Metric
+
+from elasticsearch_exporter.exposition import CachedExposition, render_exposition
+from elasticsearch_exporter.self_metric import StageTimer
+from elasticsearch_exporter.utils import BlockFilter, compile_black_re, interval_handle  # noqa: F401
+from .breaker import BreakerGroup, CircuitBreaker
+from .compact import CompactGaugeFamily, LabelInterner
+from .derive import DerivedMetric
+from .flatten import FlattenRow, FlattenSchema
+from .offload import FlattenFunc, Flattened, OffloadPool, RawResponse
+
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch_exporter.async_engine import ClusterAsyncEngine
 
 
 def collector_up_gauge(metric_name: str, succeeded: bool = True) -> GaugeMetricFamily:
@@ -11,32 +27,49 @@ def collector_up_gauge(metric_name: str, succeeded: bool = True) -> GaugeMetricF
     return GaugeMetricFamily(metric_name + '_up', description, value=int(succeeded))
 
 
-def interval_handle(_interval: str) -> int:
-    try:
-        try:
-            interval: int = int(_interval)
-        except ValueError:
-            interval: int = int(_interval[:-1])
-            unit: str = _interval[-1]
-            if unit == 's':
-                pass
-            elif unit == 'm':
-                interval = interval * 60
-            elif unit == 'h':
-                interval = interval * 60 * 60
-        return interval
-    except Exception:
-        raise RuntimeError('Not support interval:{}'.format(_interval))
+def add_const_label(family_iterable: Iterable[Metric], const_label_dict: Dict[str, str]) -> None:
+    # e.g. the `cluster` label in multi-cluster mode, families are only mutated before they are published
+    if not const_label_dict:
+        return
+    for family in family_iterable:
+        if isinstance(family, CompactGaugeFamily):
+            family.add_const_label(const_label_dict)
+            continue
+        family.samples = [
+            sample._replace(labels=dict(sample.labels, **const_label_dict)) for sample in family.samples
+        ]
+
+
+def series_count(family_iterable: Iterable[Metric]) -> int:
+    return sum(
+        len(family.label_value_list) if isinstance(family, CompactGaugeFamily) else len(family.samples)
+        for family in family_iterable
+    )
+
+
+class MetricSnapshot(NamedTuple):
+    family_tuple: Tuple[GaugeMetricFamily, ...]
+    create_timestamp: float
+    build_duration: float
+    # rendered once when published, scrape sends it without walking the families again
+    exposition: CachedExposition
 
 
 class BaseEsCollector(object):
     key: Optional[str] = None
+    # es rejects request line longer than 4kb by default
+    max_filter_path_length: int = 3000
+    # used by `derived: true`, see DerivedMetric
+    default_derived_config: Dict[str, Any] = {}
 
     def __init__(self, es_client, config: Dict[str, Any]):
         self.es_client: 'Elasticsearch' = es_client
-        self.custom_metric_value: Optional[GaugeMetricFamily] = None
+        # published by the scheduler job, replaced as a whole and never mutated after publish
+        self._snapshot: Optional[MetricSnapshot] = None
         self.config: Dict[str, Any] = config[self.key]
         self.global_config: Dict[str, Any] = config['global']
+        # labels added to every sample, e.g. {'cluster': <name>} in multi-cluster mode
+        self.const_label_dict: Dict[str, str] = self.global_config.get('const_labels', None) or {}
 
         self.config['name'] = self.key
         self.enable_scheduler: bool = False
@@ -47,6 +80,20 @@ class BaseEsCollector(object):
                 _interval: int = interval_handle(_interval)
             self.config['interval'] = _interval
 
+        # the last fetched data and when it was fetched, served while the breaker is open
+        self._good_family_tuple: Tuple[GaugeMetricFamily, ...] = ()
+        self._good_timestamp: float = 0.0
+        # the same as the job name, used by the breaker
+        self.name: str = '/'.join(filter(None, [self.const_label_dict.get('cluster', None), self.key]))
+        self.breaker: CircuitBreaker = CircuitBreaker(
+            self.name,
+            dict(self.global_config.get('breaker', None) or {}, **(self.config.get('breaker', None) or {})),
+            self.config['interval'] if self.enable_scheduler else 60
+        )
+        # replaced by the group of the cluster, see `join_breaker_group`
+        self.breaker_group: BreakerGroup = BreakerGroup(self.global_config.get('breaker', None))
+        self.breaker_group.add(self.breaker)
+
         if 'jitter' not in self.config:
             self.config['jitter'] = self.global_config.get('jitter', 0)
 
@@ -55,61 +102,263 @@ class BaseEsCollector(object):
         for black_re in global_config_black_re_list:
             if black_re not in black_re_list:
                 black_re_list.append(black_re)
-        self._black_re_list: List[re.Pattern[str]] = [re.compile(i) for i in black_re_list]
-        self._black_metric_set: Set[str] = set()
+        self.block_filter: BlockFilter = BlockFilter(
+            compile_black_re(black_re_list), int(self.global_config.get('black_cache_size', 65536))
+        )
+        self._flatten_schema_dict: Dict[str, FlattenSchema] = {}
+        # renewed for every fetch, so the label tuples are shared inside one snapshot and released with it
+        self._label_interner: LabelInterner = LabelInterner()
+        derived_config: Union[bool, Dict[str, Any], None] = self.config.get('derived', None)
+        self.derived_metric: Optional[DerivedMetric] = (
+            DerivedMetric(derived_config, self.default_derived_config) if derived_config else None
+        )
+
+        # `auto`: learn the filter_path from the first response and the blacklist, other value is sent as it is
+        filter_path: Union[str, List[str], None] = self.config.get('filter_path', None)
+        self.auto_filter_path: bool = filter_path == 'auto'
+        self.filter_path: Optional[str] = None
+        if not self.auto_filter_path and filter_path:
+            self.filter_path = ','.join(filter_path) if isinstance(filter_path, list) else filter_path
+
+        # set by the collector whose response is decoded and flattened by the offload pool, the result of
+        # `flatten_func(response, self.flatten_row)` is used by `_get_metric` instead of the response
+        self.flatten_func: Optional[FlattenFunc] = None
+        self.offload_pool: Optional[OffloadPool] = None
 
     def _is_block(self, metric: str) -> bool:
-        is_block: bool = False
-        if metric in self._black_metric_set:
-            return True
-
-        for pattern in self._black_re_list:
-            if pattern.match(metric):
-                is_block = True
-                self._black_metric_set.add(metric)
+        return self.block_filter(metric)
+
+    def flatten_row(self, prefix: str, data_dict: Dict[str, Any]) -> FlattenRow:
+        schema: Optional[FlattenSchema] = self._flatten_schema_dict.get(prefix, None)
+        if schema is None:
+            schema = FlattenSchema(prefix, self.block_filter)
+            self._flatten_schema_dict[prefix] = schema
+        return schema.flatten(data_dict)
+
+    def learn_filter_path(self, filter_prefix_dict: Dict[str, List[str]], extra_path_list: List[str]) -> None:
+        # filter_prefix_dict: flatten prefix -> filter_path prefix of the data flattened with that prefix
+        if not self.auto_filter_path or self.filter_path is not None:
+            return
+        filter_path: str = ''
+        for max_depth in (64, 3, 2, 1, 0):
+            filter_path_list: List[str] = list(extra_path_list)
+            for prefix, filter_prefix_list in filter_prefix_dict.items():
+                schema: Optional[FlattenSchema] = self._flatten_schema_dict.get(prefix, None)
+                if schema is None:
+                    continue
+                for path in schema.filter_path_list(max_depth):
+                    filter_path_list.extend(f'{filter_prefix}.{path}' for filter_prefix in filter_prefix_list)
+            filter_path = ','.join(filter_path_list)
+            if len(filter_path) <= self.max_filter_path_length:
                 break
-        return is_block
-
-    def auto_gen_metric(
-            self, metric_name: str, data_dict: Dict[str, Any], metric_doc: str = ''
-    ) -> Generator[Tuple[str, str, Any], None, None]:
-        for key, value in data_dict.items():
-            _metric_name = metric_name + f'{key}'
-            _metric_doc = metric_doc + f' {key}'
-            value_type = type(value)
-            if key == 'timestamp':
-                continue
-            if value_type in (int, float):
-                yield _metric_name, _metric_doc.strip(), value
-            elif value_type is list:
-                for i in value:
-                    yield from self.auto_gen_metric(metric_name, i)
-            elif value_type is dict:
-                yield from self.auto_gen_metric(metric_name, value)
-
-    def _get_metric(self):
+        self.filter_path = filter_path
+        # plans learned from the unfiltered response never match the filtered one
+        self._flatten_schema_dict = {}
+        logging.info(f'{self.key} filter_path: {filter_path}')
+
+    def get_family(
+            self, family_dict: Dict[str, CompactGaugeFamily], metric_name: str, metric_doc: str, labels: List[str]
+    ) -> CompactGaugeFamily:
+        g: Optional[CompactGaugeFamily] = family_dict.get(metric_name, None)
+        if g is None:
+            g = CompactGaugeFamily(metric_name, metric_doc, labels, self._label_interner)
+            family_dict[metric_name] = g
+        return g
+
+    def request(self, es_client: 'Union[Elasticsearch, AsyncElasticsearch]') -> Any:
+        # return the response, or an awaitable of the response when `es_client` is AsyncElasticsearch
         raise NotImplementedError
 
-    def get_metric(self) -> Generator[GaugeMetricFamily, None, None]:
+    def _get_metric(self, response: Dict[str, Any]) -> Generator[GaugeMetricFamily, None, None]:
+        raise NotImplementedError
+
+    def get_fetch_time_func(self) -> Optional[Callable[[Tuple[str, ...]], Optional[float]]]:
+        # label values of a row -> when the row was fetched, for the collectors that reuse cached rows.
+        # None means every row was fetched by this fetch
+        return None
+
+    def join_breaker_group(self, breaker_group: BreakerGroup) -> None:
+        self.breaker_group = breaker_group
+        breaker_group.add(self.breaker)
+
+    def join_offload_pool(self, offload_pool: OffloadPool) -> None:
+        if self.flatten_func is not None and self.config.get('offload', True):
+            self.offload_pool = offload_pool
+
+    def _request(self, es_client: 'Union[Elasticsearch, AsyncElasticsearch]') -> Any:
+        # the first response of `filter_path: auto` is flattened here, the filter_path is learned from its schemas
+        if self.offload_pool is None or (self.auto_filter_path and self.filter_path is None):
+            return self.request(es_client)
+        return self.offload_pool.request(self.request, es_client)
+
+    def flatten(self, response: Any, stage_timer: StageTimer) -> Any:
+        if self.flatten_func is None:
+            return response
+        if isinstance(response, Flattened):
+            return response.data
+        if isinstance(response, RawResponse):
+            return self.offload_pool.flatten(self.flatten_func, response, self.block_filter, stage_timer)
+        with stage_timer.stage('flatten'):
+            return self.flatten_func(response, self.flatten_row)
+
+    def get_pressure_reason(self, response: Any) -> Optional[str]:
+        # a collector can tell from its response that es is overloaded, e.g. thread pool rejections
+        return None
+
+    def fetch_error(self, e: Exception) -> None:
+        if isinstance(e, (ConnectionTimeout, asyncio.TimeoutError)):
+            logging.warning(f'fetching {self.key} timeout')
+        else:
+            logging.warning(f'fetching error: {self.key} error:{e}')
+        self.breaker.record_failure(e)
+
+    def fetch_metric(
+            self, response: Optional[Dict[str, Any]] = None, stage_timer: Optional[StageTimer] = None
+    ) -> Optional[Tuple[GaugeMetricFamily, ...]]:
+        # return None when it failed. The stages are observed by the caller that owns `stage_timer`
+        if stage_timer is None:
+            stage_timer = StageTimer(self.key, self.const_label_dict.get('cluster', ''))
         try:
-            yield from self._get_metric()
-        except ConnectionTimeout:
-            logging.warning(f'fetching{self.key} timeout')
-            yield collector_up_gauge(self.key, succeeded=False)
+            if response is None:
+                with stage_timer.request():
+                    response = self._request(self.es_client)
+            response = self.flatten(response, stage_timer)
+            self._label_interner = LabelInterner()
+            pressure_reason: Optional[str] = self.get_pressure_reason(response)
+            if pressure_reason is None:
+                self.breaker.record_success()
+            else:
+                self.breaker_group.trip(pressure_reason)
+            with stage_timer.stage('build'):
+                family_tuple: Tuple[GaugeMetricFamily, ...] = tuple(self._get_metric(response))
+            if self.derived_metric is not None:
+                with stage_timer.stage('derive'):
+                    family_tuple = tuple(
+                        self.derived_metric.derive(
+                            family_tuple, time.time(), self._label_interner, self.get_fetch_time_func()
+                        )
+                    )
         except Exception as e:
-            logging.warning(f'fetching error: {self.key} error:{e}')
-            yield collector_up_gauge(self.key, succeeded=False)
-        else:
-            yield collector_up_gauge(self.key)
+            self.fetch_error(e)
+            return None
+        add_const_label(family_tuple, self.const_label_dict)
+        stage_timer.series_count = series_count(family_tuple)
+        return family_tuple
+
+    def get_metric(self, response: Optional[Dict[str, Any]] = None) -> Generator[GaugeMetricFamily, None, None]:
+        stage_timer: StageTimer = StageTimer(self.key, self.const_label_dict.get('cluster', ''))
+        family_tuple: Optional[Tuple[GaugeMetricFamily, ...]] = self.fetch_metric(response, stage_timer)
+        stage_timer.observe()
+        up_g: GaugeMetricFamily = collector_up_gauge(self.key, succeeded=family_tuple is not None)
+        add_const_label((up_g,), self.const_label_dict)
+        yield from family_tuple or ()
+        yield up_g
+
+    def publish_snapshot(self, family_tuple: Optional[Tuple[GaugeMetricFamily, ...]], start_time: float) -> None:
+        # family_tuple is None when the fetch failed or was skipped by the breaker. The last good data is kept
+        # only while the breaker is open(es is shedding load) and until it is older than `max_stale`, any other
+        # failure only publishes `<key>_up 0`
+        create_timestamp: float = time.time()
+        build_duration: float = time.perf_counter() - start_time
+        if family_tuple is not None:
+            self._good_family_tuple = family_tuple
+            self._good_timestamp = create_timestamp
+        elif not self.breaker.is_open or create_timestamp - self._good_timestamp > self.breaker.max_stale:
+            self._good_family_tuple = ()
+        stale_duration: float = create_timestamp - self._good_timestamp if self._good_family_tuple else 0
+        meta_family_tuple: Tuple[GaugeMetricFamily, ...] = (
+            collector_up_gauge(self.key, succeeded=family_tuple is not None),
+            *self.snapshot_metric(create_timestamp, build_duration, stale_duration)
+        )
+        add_const_label(meta_family_tuple, self.const_label_dict)
+        published_family_tuple: Tuple[GaugeMetricFamily, ...] = self._good_family_tuple + meta_family_tuple
+        self._snapshot = MetricSnapshot(
+            published_family_tuple,
+            create_timestamp,
+            build_duration,
+            # in multi-cluster mode the families are shared by all clusters and merged on scrape
+            render_exposition(published_family_tuple, split_family='cluster' in self.const_label_dict)
+        )
+
+    def _publish(
+            self, family_tuple: Optional[Tuple[GaugeMetricFamily, ...]], start_time: float, stage_timer: StageTimer
+    ) -> None:
+        with stage_timer.stage('render'):
+            self.publish_snapshot(family_tuple, start_time)
+
+    def _build_publish(self, response: Optional[Any], start_time: float, stage_timer: StageTimer) -> None:
+        self._publish(self.fetch_metric(response, stage_timer), start_time, stage_timer)
 
     def gen_job(self) -> Tuple[Callable, Dict[str, Any]]:
         def _job():
-            self.custom_metric_value = self._get_metric()
+            start_time: float = time.perf_counter()
+            if not self.breaker.allow_request():
+                self.publish_snapshot(None, start_time)
+                return
+            stage_timer: StageTimer = StageTimer(self.key, self.const_label_dict.get('cluster', ''))
+            self._build_publish(None, start_time, stage_timer)
+            stage_timer.observe()
+        return _job, self.config
+
+    def gen_async_job(self, engine: 'ClusterAsyncEngine') -> Tuple[Callable[[], Awaitable[None]], Dict[str, Any]]:
+        # only the request runs on the event loop, the cpu bound work runs in the build pool of the engine
+        async def _job():
+            start_time: float = time.perf_counter()
+            if not self.breaker.allow_request():
+                await engine.run_in_executor(self.publish_snapshot, None, start_time)
+                return
+            stage_timer: StageTimer = StageTimer(self.key, self.const_label_dict.get('cluster', ''))
+            try:
+                with stage_timer.request():
+                    response: Any = await engine.request(self._request)
+                if isinstance(response, RawResponse):
+                    response = Flattened(await self.offload_pool.async_flatten(
+                        self.flatten_func, response, self.block_filter, stage_timer
+                    ))
+            except Exception as e:
+                self.fetch_error(e)
+                await engine.run_in_executor(self._publish, None, start_time, stage_timer)
+            else:
+                await engine.run_in_executor(self._build_publish, response, start_time, stage_timer)
+            stage_timer.observe()
         return _job, self.config
 
+    def snapshot_metric(
+            self, create_timestamp: float, build_duration: float, stale_duration: float
+    ) -> Generator[GaugeMetricFamily, None, None]:
+        # a timestamp instead of an age keeps the rendered snapshot unchanged until the next publish,
+        # the age is `time() - <key>_snapshot_timestamp_seconds`
+        yield GaugeMetricFamily(
+            self.key + '_snapshot_timestamp_seconds',
+            f'Unix timestamp when the {self.key} snapshot was published',
+            value=create_timestamp
+        )
+        yield GaugeMetricFamily(
+            self.key + '_snapshot_build_seconds',
+            f'Seconds spent fetching and building the {self.key} snapshot',
+            value=build_duration
+        )
+        yield GaugeMetricFamily(
+            self.key + '_snapshot_stale_seconds',
+            f'Age of the {self.key} data when the snapshot was published, not 0 when the last good data is served',
+            value=stale_duration
+        )
+        yield self.breaker.metric(self.key)
+
+    def exposition_list(self) -> List[CachedExposition]:
+        snapshot: Optional[MetricSnapshot] = self._snapshot
+        return [snapshot.exposition] if snapshot is not None else []
+
     def collect(self) -> Generator[GaugeMetricFamily, None, None]:
         if self.enable_scheduler:
-            if self.custom_metric_value is not None:
-                yield from self.custom_metric_value
-        else:
+            snapshot: Optional[MetricSnapshot] = self._snapshot
+            if snapshot is not None:
+                yield from snapshot.family_tuple
+        elif self.breaker.allow_request():
             yield from self.get_metric()
+        else:
+            family_tuple: Tuple[GaugeMetricFamily, ...] = (
+                collector_up_gauge(self.key, succeeded=False), self.breaker.metric(self.key)
+            )
+            add_const_label(family_tuple, self.const_label_dict)
+            yield from family_tuple
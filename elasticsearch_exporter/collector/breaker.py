@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from prometheus_client.core import GaugeMetricFamily
+
+from elasticsearch_exporter.self_metric import breaker_trip_counter
+from elasticsearch_exporter.utils import interval_handle
+
+
+def get_pressure_reason(e: Exception) -> Optional[str]:
+    # only the errors that mean es is overloaded open the breaker, other errors are retried every interval
+    if isinstance(e, (ConnectionTimeout, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(e, TransportError) and e.status_code == 429:
+        return 'too_many_requests'
+    return None
+
+
+class CircuitBreaker(object):
+    # Closed: every run sends its request. After `failure_threshold` pressure failures in a row(or a trip by
+    # the thread pool rejections of es) the breaker opens and runs are skipped for the backoff, which doubles
+    # every time it opens again before a request succeeds(capped by `max_backoff`). After the backoff one
+    # request is let through(half open), its success closes the breaker
+    def __init__(self, name: str, config: Dict[str, Any], interval: int):
+        self.name: str = name
+        self.enable: bool = bool(config.get('enable', True))
+        self.failure_threshold: int = int(config.get('failure_threshold', 1))
+        self.backoff: int = interval_handle(config['backoff']) if 'backoff' in config else interval
+        self.max_backoff: int = interval_handle(config.get('max_backoff', '10m'))
+        # the last good data is served at most this long after it was fetched
+        self.max_stale: int = interval_handle(config.get('max_stale', '30m'))
+
+        self.failure_count: int = 0
+        self.open_count: int = 0
+        self.open_until: float = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return time.time() < self.open_until
+
+    def allow_request(self) -> bool:
+        return not self.enable or not self.is_open
+
+    def record_success(self) -> None:
+        self.failure_count = 0
+        self.open_count = 0
+        self.open_until = 0.0
+
+    def record_failure(self, e: Exception) -> None:
+        reason: Optional[str] = get_pressure_reason(e)
+        if reason is not None:
+            self.record_pressure(reason)
+
+    def record_pressure(self, reason: str) -> None:
+        self.failure_count += 1
+        if self.failure_count >= self.failure_threshold:
+            self.trip(reason)
+
+    def trip(self, reason: str) -> None:
+        if not self.enable:
+            return
+        breaker_trip_counter.labels(self.name, reason).inc()
+        if self.is_open:
+            return
+        backoff: int = min(self.backoff * 2 ** self.open_count, self.max_backoff)
+        self.open_count += 1
+        self.failure_count = 0
+        self.open_until = time.time() + backoff
+        logging.warning(f'{self.name} breaker open for {backoff}s, reason:{reason}')
+
+    def metric(self, prefix: str) -> GaugeMetricFamily:
+        return GaugeMetricFamily(
+            prefix + '_breaker_open',
+            'Is the request skipped because es is under pressure, the last good data is served',
+            value=int(self.is_open)
+        )
+
+
+class BreakerGroup(object):
+    # the breakers of one cluster, they are tripped together when es rejects the requests of the exporter
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        config = config or {}
+        self.breaker_list: List[CircuitBreaker] = []
+        # thread pools used by the request of exporter, their rejections trip all breakers
+        self.rejection_thread_pool_list: List[str] = config.get('rejection_thread_pool', ['search', 'management'])
+
+    def add(self, breaker: CircuitBreaker) -> None:
+        self.breaker_list.append(breaker)
+
+    def trip(self, reason: str) -> None:
+        for breaker in self.breaker_list:
+            breaker.trip(reason)
@@ -17,8 +17,10 @@ class EsClusterCollector(BaseEsCollector):
             'red': 2
         }
 
-    def _get_metric(self):
-        response: Dict[str, Any] = self.es_client.cluster.health(params=self.config.get('request_param', {}))
+    def request(self, es_client: 'Elasticsearch') -> Dict[str, Any]:
+        return es_client.cluster.health(params=self.config.get('request_param', {}))
+
+    def _get_metric(self, response: Dict[str, Any]):
         cluster_name: str = response['cluster_name']
         del response['cluster_name']
         del response['timed_out']
@@ -0,0 +1,97 @@
+import sys
+from array import array
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+
+class LabelInterner(object):
+    # One per snapshot build, equal label key or value tuples of all families in the snapshot are the same object,
+    # e.g. the labels of a node are stored once and not once per node metric
+    def __init__(self):
+        self._label_tuple_dict: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+    def intern(self, label_iterable: Iterable[str]) -> Tuple[str, ...]:
+        label_tuple: Tuple[str, ...] = tuple(label_iterable)
+        return self._label_tuple_dict.setdefault(label_tuple, label_tuple)
+
+    def __len__(self) -> int:
+        return len(self._label_tuple_dict)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class CompactGaugeFamily(object):
+    # Used instead of GaugeMetricFamily for the families kept in a snapshot. GaugeMetricFamily keeps one Sample
+    # with its own label dict per value, here a family only holds a list of interned label value tuples and an
+    # array of double. `samples` is built on demand for prometheus_client, the exporter renders with `render_text`.
+    # A gauge by default, see `as_counter`
+    __slots__ = (
+        'name', 'documentation', 'type', 'unit', 'label_key_tuple', 'label_value_list', 'value_array', '_interner'
+    )
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str], interner: LabelInterner):
+        self.name: str = sys.intern(name)
+        self.documentation: str = documentation
+        self.type: str = 'gauge'
+        self.unit: str = ''
+        self._interner: LabelInterner = interner
+        self.label_key_tuple: Tuple[str, ...] = interner.intern(labels)
+        self.label_value_list: List[Tuple[str, ...]] = []
+        self.value_array: array = array('d')
+
+    def add_metric(self, labels: Sequence[str], value: float) -> None:
+        self.label_value_list.append(self._interner.intern(labels))
+        self.value_array.append(value)
+
+    def as_counter(self) -> None:
+        # export a cumulative stat as a counter, prometheus_client names a counter family without `_total`
+        # and its samples and text header with it, so `x_total` keeps its series name and `x` becomes `x_total`
+        self.type = 'counter'
+        if self.name.endswith('_total'):
+            self.name = sys.intern(self.name[:-6])
+
+    @property
+    def sample_name(self) -> str:
+        return self.name + '_total' if self.type == 'counter' else self.name
+
+    def add_const_label(self, const_label_dict: Dict[str, str]) -> None:
+        const_value_tuple: Tuple[str, ...] = tuple(const_label_dict.values())
+        self.label_key_tuple = self._interner.intern(self.label_key_tuple + tuple(const_label_dict))
+        self.label_value_list = [
+            self._interner.intern(label_value_tuple + const_value_tuple) for label_value_tuple in self.label_value_list
+        ]
+
+    @property
+    def samples(self) -> List[Sample]:
+        sample_name: str = self.sample_name
+        return [
+            Sample(sample_name, dict(zip(self.label_key_tuple, label_value_tuple)), value)
+            for label_value_tuple, value in zip(self.label_value_list, self.value_array)
+        ]
+
+    def render_text(self, label_text_cache: Dict[Tuple[int, int], str]) -> bytes:
+        # the same output as `generate_latest`(labels sorted by name), the label text of an interned tuple is
+        # rendered once per exposition and shared by all families through `label_text_cache`
+        sample_name: str = self.sample_name
+        line_list: List[str] = [
+            '# HELP {} {}\n'.format(sample_name, self.documentation.replace('\\', r'\\').replace('\n', r'\n')),
+            f'# TYPE {sample_name} {self.type}\n'
+        ]
+        key_tuple: Tuple[str, ...] = self.label_key_tuple
+        key_id: int = id(key_tuple)
+        sorted_index_list: List[int] = sorted(range(len(key_tuple)), key=key_tuple.__getitem__)
+        for label_value_tuple, value in zip(self.label_value_list, self.value_array):
+            cache_key: Tuple[int, int] = (key_id, id(label_value_tuple))
+            label_text: str = label_text_cache.get(cache_key, None)
+            if label_text is None:
+                label_text = ','.join(
+                    f'{key_tuple[i]}="{_escape_label_value(label_value_tuple[i])}"' for i in sorted_index_list
+                )
+                label_text = '{' + label_text + '}' if label_text else ''
+                label_text_cache[cache_key] = label_text
+            line_list.append(f'{sample_name}{label_text} {floatToGoString(value)}\n')
+        return ''.join(line_list).encode('utf-8')
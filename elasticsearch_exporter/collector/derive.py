@@ -0,0 +1,188 @@
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+
+from prometheus_client.core import Metric
+
+from elasticsearch_exporter.utils import compile_black_re
+from .compact import CompactGaugeFamily, LabelInterner
+
+
+class RatioRule(NamedTuple):
+    name: str
+    numerator: str
+    denominator: str
+
+
+def counter_delta(value: float, last_value: float) -> float:
+    # a counter smaller than its last value was reset(e.g. the node restarted), it counts from 0 since then
+    return value - last_value if value >= last_value else value
+
+
+class DerivedMetric(object):
+    # Cumulative stats that es returns as plain numbers:
+    #   counter: families exported as counters instead of gauges(`x` -> `x_total`, `x_total` keeps its name)
+    #   rate: adds `<metric without _total>_per_second`, the increase per second since the last fetch
+    #   ratio: adds `<name>`, increase of numerator / increase of denominator since the last fetch,
+    #     e.g. query latency = search_query_time_in_millis / search_query_total
+    # All regexes must match the whole metric name. Only the values of the rate and ratio metrics of the last fetch
+    # are kept, the first fetch after start has no rate and ratio.
+    # A collector that reuses cached rows(e.g. the cold indices of incremental indices_stats) passes the fetch time
+    # of every row: rates and ratios are only computed for the rows fetched again since the last derive, over the
+    # time since their own last fetch, a row that was not fetched again keeps its last rate and ratio
+    def __init__(self, config: Union[bool, Dict[str, Any]], default_config: Dict[str, Any]):
+        if not isinstance(config, dict):
+            config = {}
+        # a missing key uses the default of the collector, an empty list disables it
+        config = dict(default_config, **config)
+        self.counter_re: 'Optional[re.Pattern[str]]' = compile_black_re(config.get('counter', None) or [])
+        self.rate_re: 'Optional[re.Pattern[str]]' = compile_black_re(config.get('rate', None) or [])
+        self.ratio_rule_list: List[RatioRule] = [
+            RatioRule(rule['name'], rule['numerator'], rule['denominator']) for rule in config.get('ratio', None) or []
+        ]
+        self._ratio_metric_set: Set[str] = set()
+        for rule in self.ratio_rule_list:
+            self._ratio_metric_set.update((rule.numerator, rule.denominator))
+        # metric -> is counter, is rate
+        self._decision_dict: Dict[str, Tuple[bool, bool]] = {}
+
+        # metric -> label values -> value, and the fetch time of them
+        self._last_value_dict: Dict[str, Dict[Tuple[str, ...], float]] = {}
+        self._last_timestamp: Optional[float] = None
+        # label values -> fetch time of the row, only with the fetch time of every row
+        self._last_fetch_time_dict: Dict[Tuple[str, ...], float] = {}
+        # rate or ratio metric -> label values -> value of the last derive, reused by the rows not fetched again
+        self._last_derived_dict: Dict[str, Dict[Tuple[str, ...], float]] = {}
+
+    def _decide(self, metric: str) -> Tuple[bool, bool]:
+        decision: Optional[Tuple[bool, bool]] = self._decision_dict.get(metric, None)
+        if decision is None:
+            decision = (
+                self.counter_re is not None and self.counter_re.fullmatch(metric) is not None,
+                self.rate_re is not None and self.rate_re.fullmatch(metric) is not None
+            )
+            self._decision_dict[metric] = decision
+        return decision
+
+    def derive(
+            self,
+            family_list: Sequence[Metric],
+            timestamp: float,
+            interner: LabelInterner,
+            get_fetch_time: Optional[Callable[[Tuple[str, ...]], Optional[float]]] = None
+    ) -> List[Metric]:
+        # families other than CompactGaugeFamily are passed through. `get_fetch_time`: label values of a row -> when
+        # the row was fetched, None is `timestamp`
+        last_value_dict: Dict[str, Dict[Tuple[str, ...], float]] = self._last_value_dict
+        last_fetch_time_dict: Dict[Tuple[str, ...], float] = self._last_fetch_time_dict
+        last_derived_dict: Dict[str, Dict[Tuple[str, ...], float]] = self._last_derived_dict
+        fetch_time_dict: Dict[Tuple[str, ...], float] = {}
+
+        def get_row_fetch_time(label_value_tuple: Tuple[str, ...]) -> float:
+            fetch_time: Optional[float] = fetch_time_dict.get(label_value_tuple, None)
+            if fetch_time is None:
+                fetch_time = get_fetch_time(label_value_tuple) if get_fetch_time is not None else None
+                fetch_time = timestamp if fetch_time is None else fetch_time
+                fetch_time_dict[label_value_tuple] = fetch_time
+            return fetch_time
+
+        def get_duration(label_value_tuple: Tuple[str, ...]) -> float:
+            # seconds since the last fetch of the row, 0 when it was not fetched again or has no last fetch
+            if get_fetch_time is None:
+                return timestamp - self._last_timestamp if self._last_timestamp is not None else 0.0
+            last_fetch_time: Optional[float] = last_fetch_time_dict.get(label_value_tuple, None)
+            return get_row_fetch_time(label_value_tuple) - last_fetch_time if last_fetch_time is not None else 0.0
+
+        value_dict: Dict[str, Dict[Tuple[str, ...], float]] = {}
+        derived_dict: Dict[str, Dict[Tuple[str, ...], float]] = {}
+        family_dict: Dict[str, CompactGaugeFamily] = {}
+        counter_family_list: List[CompactGaugeFamily] = []
+        result_list: List[Metric] = []
+        for family in family_list:
+            result_list.append(family)
+            if not isinstance(family, CompactGaugeFamily):
+                continue
+            is_counter, is_rate = self._decide(family.name)
+            if is_counter:
+                counter_family_list.append(family)
+            if not is_rate and family.name not in self._ratio_metric_set:
+                continue
+            family_dict[family.name] = family
+            value_dict[family.name] = dict(zip(family.label_value_list, family.value_array))
+            last_value: Optional[Dict[Tuple[str, ...], float]] = last_value_dict.get(family.name, None)
+            if not is_rate or last_value is None:
+                continue
+            rate_name: str = (family.name[:-6] if family.name.endswith('_total') else family.name) + '_per_second'
+            last_rate_dict: Dict[Tuple[str, ...], float] = last_derived_dict.get(rate_name, {})
+            rate_dict: Dict[Tuple[str, ...], float] = {}
+            for label_value_tuple, value in zip(family.label_value_list, family.value_array):
+                last: Optional[float] = last_value.get(label_value_tuple, None)
+                if last is None:
+                    continue
+                duration: float = get_duration(label_value_tuple)
+                if duration > 0:
+                    rate_dict[label_value_tuple] = counter_delta(value, last) / duration
+                elif label_value_tuple in last_rate_dict:
+                    rate_dict[label_value_tuple] = last_rate_dict[label_value_tuple]
+            if not rate_dict:
+                continue
+            rate_g: CompactGaugeFamily = CompactGaugeFamily(
+                rate_name, f'{family.documentation} per second', family.label_key_tuple, interner
+            )
+            for label_value_tuple, rate in rate_dict.items():
+                rate_g.add_metric(label_value_tuple, rate)
+            derived_dict[rate_name] = rate_dict
+            result_list.append(rate_g)
+
+        for rule in self.ratio_rule_list:
+            numerator_family: Optional[CompactGaugeFamily] = family_dict.get(rule.numerator, None)
+            denominator_dict: Optional[Dict[Tuple[str, ...], float]] = value_dict.get(rule.denominator, None)
+            last_numerator_dict: Optional[Dict[Tuple[str, ...], float]] = last_value_dict.get(rule.numerator, None)
+            last_denominator_dict: Optional[Dict[Tuple[str, ...], float]] = last_value_dict.get(
+                rule.denominator, None
+            )
+            if numerator_family is None or denominator_dict is None \
+                    or last_numerator_dict is None or last_denominator_dict is None:
+                continue
+            last_ratio_dict: Dict[Tuple[str, ...], float] = last_derived_dict.get(rule.name, {})
+            ratio_dict: Dict[Tuple[str, ...], float] = {}
+            for label_value_tuple, numerator in zip(numerator_family.label_value_list, numerator_family.value_array):
+                denominator: Optional[float] = denominator_dict.get(label_value_tuple, None)
+                last_numerator: Optional[float] = last_numerator_dict.get(label_value_tuple, None)
+                last_denominator: Optional[float] = last_denominator_dict.get(label_value_tuple, None)
+                if denominator is None or last_numerator is None or last_denominator is None:
+                    continue
+                if get_duration(label_value_tuple) <= 0:
+                    if label_value_tuple in last_ratio_dict:
+                        ratio_dict[label_value_tuple] = last_ratio_dict[label_value_tuple]
+                    continue
+                if numerator < last_numerator or denominator < last_denominator:
+                    # both stats restart together
+                    last_numerator, last_denominator = 0.0, 0.0
+                denominator_delta: float = denominator - last_denominator
+                # nothing happened in the interval(e.g. no query), there is no ratio
+                if denominator_delta > 0:
+                    ratio_dict[label_value_tuple] = (numerator - last_numerator) / denominator_delta
+            ratio_g: CompactGaugeFamily = CompactGaugeFamily(
+                rule.name,
+                f'increase of {rule.numerator} / increase of {rule.denominator} since the last fetch',
+                numerator_family.label_key_tuple,
+                interner
+            )
+            for label_value_tuple, ratio in ratio_dict.items():
+                ratio_g.add_metric(label_value_tuple, ratio)
+            derived_dict[rule.name] = ratio_dict
+            result_list.append(ratio_g)
+
+        # after the rates, which are named after the gauge name
+        for family in counter_family_list:
+            family.as_counter()
+        self._last_value_dict = value_dict
+        self._last_timestamp = timestamp
+        self._last_derived_dict = derived_dict
+        if get_fetch_time is not None:
+            # the rows without a last value have no duration yet
+            for family_value_dict in value_dict.values():
+                for label_value_tuple in family_value_dict:
+                    get_row_fetch_time(label_value_tuple)
+            self._last_fetch_time_dict = fetch_time_dict
+        return result_list
@@ -1,12 +1,61 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from elasticsearch import Elasticsearch
-from prometheus_client.core import GaugeMetricFamily
 
 from .base import BaseEsCollector
+from .compact import CompactGaugeFamily
+from .flatten import FlattenRow
+from .offload import RowFlattener
+
+
+class FlattenedNode(NamedTuple):
+    node_id: str
+    name: str
+    transport_address: str
+    role_list: List[str]
+    # [(es system metric, flattened stats of it), ...]
+    row_list: List[Tuple[str, FlattenRow]]
+    # thread pool -> rejected count
+    rejected_dict: Dict[str, int]
 
 
 class EsNodeCollector(BaseEsCollector):
     key: str = 'es_node'
+    es_system_metric_list: List[str] = [
+        'indices', 'os', 'process', 'jvm', 'thread_pool', 'fs', 'transport', 'http', 'breakers', 'script',
+        'discovery', 'ingest'
+    ]
+    default_derived_config: Dict[str, Any] = {
+        'counter': [
+            'es_node_indices_(indexing_index|indexing_delete|get|search_query|search_fetch|search_scroll)'
+            '_(total|time_in_millis)',
+            'es_node_indices_(merges|refresh|flush)_total(_time_in_millis)?',
+            'es_node_jvm_gc_collectors_.+_collection_(count|time_in_millis)',
+            'es_node_thread_pool_.+_(rejected|completed)',
+            'es_node_transport_(rx|tx)_(count|size_in_bytes)',
+        ],
+        'rate': [
+            'es_node_indices_(indexing_index|search_query|search_fetch)_total',
+            'es_node_jvm_gc_collectors_.+_collection_(count|time_in_millis)',
+            'es_node_thread_pool_.+_rejected',
+        ],
+        'ratio': [
+            {
+                'name': 'es_node_indices_indexing_index_latency_milliseconds',
+                'numerator': 'es_node_indices_indexing_index_time_in_millis',
+                'denominator': 'es_node_indices_indexing_index_total'
+            },
+            {
+                'name': 'es_node_indices_search_query_latency_milliseconds',
+                'numerator': 'es_node_indices_search_query_time_in_millis',
+                'denominator': 'es_node_indices_search_query_total'
+            },
+            {
+                'name': 'es_node_indices_search_fetch_latency_milliseconds',
+                'numerator': 'es_node_indices_search_fetch_time_in_millis',
+                'denominator': 'es_node_indices_search_fetch_total'
+            },
+        ]
+    }
 
     def __init__(self, es_client: 'Elasticsearch', config: Dict[str, Any]):
         super().__init__(es_client, config)
@@ -20,46 +69,94 @@ class EsNodeCollector(BaseEsCollector):
             self.index_metric = None
         else:
             self.index_metric = request_param.get('index_metric')
+        # (node_id, thread pool) -> rejected count of the last response
+        self._rejected_dict: Dict[Tuple[str, str], int] = {}
+        self.flatten_func = flatten_nodes_stats
 
-    def _get_metric(self):
-        response: Dict[str, Any] = self.es_client.nodes.stats(
+    def request(self, es_client: 'Elasticsearch') -> Dict[str, Any]:
+        return es_client.nodes.stats(
             node_id=self.node_id,
             metric=self.metric,
             index_metric=self.index_metric,
+            filter_path=self.filter_path,
             params=self.config.get('request_param', {})
         )
-        all_node_dict: Dict[str, Any] = response['nodes']
-        for node_id in all_node_dict:
-            node_dict: Dict[str, Any] = all_node_dict[node_id]
-            node: str = node_dict['name']
-            instance: str = node_dict['transport_address']
-            labels_value_list: List[str] = [node, node_id, instance]
-            labels_key_list: List[str] = ['node', 'node_id', 'instance']
-
-            # node role
-            node_role_list: List[str] = node_dict['roles']
-            metric: str = f'{self.key}_role'
-            if not self._is_block(metric):
-                g: 'GaugeMetricFamily' = GaugeMetricFamily(
-                    metric,
-                    'node role',
-                    labels=labels_key_list
-                )
+
+    def get_pressure_reason(self, response: List[FlattenedNode]) -> Optional[str]:
+        # es rejects the requests when the queue of a thread pool is full, growing rejections of the pools
+        # used by the exporter means the requests of the next interval should be skipped
+        rejected_dict: Dict[Tuple[str, str], int] = {}
+        is_rejected: bool = False
+        for flattened_node in response:
+            for thread_pool in self.breaker_group.rejection_thread_pool_list:
+                rejected: Optional[int] = flattened_node.rejected_dict.get(thread_pool, None)
+                if rejected is None:
+                    continue
+                key: Tuple[str, str] = (flattened_node.node_id, thread_pool)
+                if rejected > self._rejected_dict.get(key, rejected):
+                    is_rejected = True
+                rejected_dict[key] = rejected
+        self._rejected_dict = rejected_dict
+        return 'thread_pool_rejected' if is_rejected else None
+
+    def _get_metric(self, response: List[FlattenedNode]):
+        labels_key_list: List[str] = ['node', 'node_id', 'instance']
+        family_dict: Dict[str, CompactGaugeFamily] = {}
+
+        # node role
+        role_metric: str = f'{self.key}_role'
+        role_g: Optional[CompactGaugeFamily] = None
+        if not self._is_block(role_metric):
+            role_g = self.get_family(family_dict, role_metric, 'node role', labels_key_list + ['role'])
+
+        for flattened_node in response:
+            labels_value_tuple: Tuple[str, ...] = (
+                flattened_node.name, flattened_node.node_id, flattened_node.transport_address
+            )
+
+            if role_g is not None:
                 for role in ['data', 'ingest', 'master', 'ml']:
-                    g.add_metric(labels_value_list, float(role in node_role_list))
-                yield g
-
-            for es_system_metric in [
-                'indices', 'os', 'process', 'jvm', 'thread_pool', 'fs', 'transport', 'http', 'breakers', 'script',
-                'discovery', 'ingest'
-            ]:
-                for metric_name, metric_doc, value in self.auto_gen_metric(self.key + '_', node_dict[es_system_metric]):
-                    if self._is_block(metric_name):
-                        continue
-                    g: 'GaugeMetricFamily' = GaugeMetricFamily(
-                        metric_name,
-                        metric_doc,
-                        labels=labels_key_list
-                    )
-                    g.add_metric(labels_value_list, value)
-                    yield g
+                    role_g.add_metric(labels_value_tuple + (role,), float(role in flattened_node.role_list))
+
+            for _, row in flattened_node.row_list:
+                for metric_name, metric_doc, value in zip(row.name_tuple, row.doc_tuple, row.value_array):
+                    g: CompactGaugeFamily = self.get_family(family_dict, metric_name, metric_doc, labels_key_list)
+                    g.add_metric(labels_value_tuple, value)
+
+        self.learn_filter_path(
+            {
+                f'{self.key}_{es_system_metric}_': [f'nodes.*.{es_system_metric}']
+                for es_system_metric in self.es_system_metric_list
+            },
+            # the breaker reads the rejections even when the thread pool metrics are blocked
+            ['nodes.*.name', 'nodes.*.transport_address', 'nodes.*.roles'] + [
+                f'nodes.*.thread_pool.{thread_pool}.rejected'
+                for thread_pool in self.breaker_group.rejection_thread_pool_list
+            ]
+        )
+        yield from family_dict.values()
+
+
+def flatten_nodes_stats(response: Dict[str, Any], flatten_row: RowFlattener) -> List[FlattenedNode]:
+    # may run in a worker process of the offload pool
+    flattened_node_list: List[FlattenedNode] = []
+    for node_id, node_dict in response.get('nodes', {}).items():
+        flattened_node_list.append(FlattenedNode(
+            node_id,
+            node_dict['name'],
+            node_dict['transport_address'],
+            node_dict.get('roles', []),
+            [
+                (
+                    es_system_metric,
+                    flatten_row(f'{EsNodeCollector.key}_{es_system_metric}_', node_dict[es_system_metric])
+                )
+                for es_system_metric in EsNodeCollector.es_system_metric_list if es_system_metric in node_dict
+            ],
+            {
+                thread_pool: thread_pool_dict['rejected']
+                for thread_pool, thread_pool_dict in node_dict.get('thread_pool', {}).items()
+                if 'rejected' in thread_pool_dict
+            }
+        ))
+    return flattened_node_list
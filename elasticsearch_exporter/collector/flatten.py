@@ -0,0 +1,158 @@
+import re
+from array import array
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+
+invalid_metric_char_re: 're.Pattern[str]' = re.compile(r'[^a-zA-Z0-9_]')
+invalid_filter_path_char_re: 're.Pattern[str]' = re.compile(r'[.,*]')
+
+# (parent container index, key in parent, container size, [(leaf key, metric name, metric doc), ...])
+PlanItem = Tuple[int, Union[str, int], int, List[Tuple[Union[str, int], str, str]]]
+
+
+class ShapeMismatch(Exception):
+    pass
+
+
+class FlattenRow(NamedTuple):
+    # the name and doc tuples are shared by all rows flattened by the same plan
+    name_tuple: Tuple[str, ...]
+    doc_tuple: Tuple[str, ...]
+    value_array: 'array[float]'
+
+
+# path -> metric name plan compiled from one response shape.
+# Containers are stored in pre-order, so each container is reached from its already visited parent
+# and a response is flattened by one flat loop instead of a recursive walk.
+class FlattenPlan(object):
+
+    def __init__(self, prefix: str, data: Union[Dict[str, Any], List[Any]], is_block: Callable[[str], bool]):
+        self.prefix: str = prefix
+        self.is_block: Callable[[str], bool] = is_block
+        self.plan_item_list: List[PlanItem] = []
+        self.block_count_list: List[int] = []
+        self.child_index_list: List[List[int]] = []
+        self._compile(-1, '', (), data)
+        self.name_tuple: Tuple[str, ...] = tuple(
+            metric_name for plan_item in self.plan_item_list for _, metric_name, _ in plan_item[3]
+        )
+        self.doc_tuple: Tuple[str, ...] = tuple(
+            metric_doc for plan_item in self.plan_item_list for _, _, metric_doc in plan_item[3]
+        )
+
+    def _compile(
+            self, parent_index: int, key: Union[str, int], path: Tuple[str, ...], data: Union[Dict[str, Any], List[Any]]
+    ) -> None:
+        if isinstance(data, dict):
+            item_iter = data.items()
+        else:
+            item_iter = enumerate(data)
+
+        leaf_list: List[Tuple[Union[str, int], str, str]] = []
+        child_list: List[Tuple[Union[str, int], Any]] = []
+        block_count: int = 0
+        for child_key, value in item_iter:
+            if child_key == 'timestamp':
+                continue
+            value_type = type(value)
+            if value_type in (int, float):
+                child_path: Tuple[str, ...] = path + (str(child_key),)
+                metric_name: str = invalid_metric_char_re.sub('_', self.prefix + '_'.join(child_path))
+                if not self.is_block(metric_name):
+                    leaf_list.append((child_key, metric_name, ' '.join(child_path)))
+                else:
+                    block_count += 1
+            elif value_type is dict:
+                child_list.append((child_key, value))
+            # a list(e.g. `fs.data`, one item per data path) is skipped, its positions would be part of the metric
+            # names, so the families would grow with the list and change with its order. es sums the items in
+            # a sibling(e.g. `fs.total`, `fs.io_stats.total`)
+
+        index: int = len(self.plan_item_list)
+        self.plan_item_list.append((parent_index, key, len(data), leaf_list))
+        self.block_count_list.append(block_count)
+        self.child_index_list.append([])
+        if parent_index >= 0:
+            self.child_index_list[parent_index].append(index)
+        for child_key, value in child_list:
+            self._compile(index, child_key, path + (str(child_key),), value)
+
+    def extract(self, data: Union[Dict[str, Any], List[Any]]) -> FlattenRow:
+        value_array: 'array[float]' = array('d')
+        container_list: List[Any] = []
+        try:
+            for parent_index, key, size, leaf_list in self.plan_item_list:
+                container: Any = data if parent_index < 0 else container_list[parent_index][key]
+                if len(container) != size:
+                    raise ShapeMismatch()
+                container_list.append(container)
+                for leaf_key, _, _ in leaf_list:
+                    value: Any = container[leaf_key]
+                    if type(value) not in (int, float):
+                        raise ShapeMismatch()
+                    value_array.append(value)
+        except (KeyError, IndexError, TypeError):
+            raise ShapeMismatch()
+        return FlattenRow(self.name_tuple, self.doc_tuple, value_array)
+
+    def filter_path_list(self, max_depth: int) -> List[str]:
+        # es filter_path(relative to the flattened data) that only keeps the allowed leaves.
+        # A subtree without blocked leaf, or deeper than `max_depth`, is matched by `**`
+        allow_count_list: List[int] = [len(plan_item[3]) for plan_item in self.plan_item_list]
+        block_count_list: List[int] = list(self.block_count_list)
+        # children are always after their parent, so the count of a subtree is complete before it is added to parent
+        for index in range(len(self.plan_item_list) - 1, 0, -1):
+            parent_index: int = self.plan_item_list[index][0]
+            allow_count_list[parent_index] += allow_count_list[index]
+            block_count_list[parent_index] += block_count_list[index]
+
+        def _to_filter_path(path: List[Union[str, int]]) -> str:
+            # list index is transparent in filter_path, and key with special char can only be matched by `*`
+            return '.'.join(
+                key if key == '**' else invalid_filter_path_char_re.sub('*', key)
+                for key in path if not isinstance(key, int)
+            )
+
+        filter_path_list: List[str] = []
+        stack: List[Tuple[int, List[Union[str, int]], int]] = [(0, [], 0)]
+        while stack:
+            index, path, depth = stack.pop()
+            if not allow_count_list[index]:
+                continue
+            if not block_count_list[index] or depth >= max_depth:
+                filter_path_list.append(_to_filter_path(path + ['**']))
+                continue
+            for leaf_key, _, _ in self.plan_item_list[index][3]:
+                filter_path_list.append(_to_filter_path(path + [leaf_key]))
+            for child_index in reversed(self.child_index_list[index]):
+                stack.append((child_index, path + [self.plan_item_list[child_index][1]], depth + 1))
+        return filter_path_list
+
+
+# Plans learned for one stats section, tried most recently used first.
+# A new plan is only compiled when no cached plan matches the response shape(e.g. after an ES upgrade).
+class FlattenSchema(object):
+
+    def __init__(self, prefix: str, is_block: Callable[[str], bool], max_plan_size: int = 8):
+        self.prefix: str = prefix
+        self.is_block: Callable[[str], bool] = is_block
+        self.max_plan_size: int = max_plan_size
+        self.plan_list: List[FlattenPlan] = []
+
+    def flatten(self, data: Union[Dict[str, Any], List[Any]]) -> FlattenRow:
+        for index, plan in enumerate(self.plan_list):
+            try:
+                result: FlattenRow = plan.extract(data)
+            except ShapeMismatch:
+                continue
+            if index:
+                self.plan_list.insert(0, self.plan_list.pop(index))
+            return result
+
+        plan: FlattenPlan = FlattenPlan(self.prefix, data, self.is_block)
+        self.plan_list.insert(0, plan)
+        del self.plan_list[self.max_plan_size:]
+        return plan.extract(data)
+
+    def filter_path_list(self, max_depth: int) -> List[str]:
+        return list(dict.fromkeys(path for plan in self.plan_list for path in plan.filter_path_list(max_depth)))
@@ -1,12 +1,97 @@
-from typing import Any, Dict
+import inspect
+import time
+from typing import (
+    TYPE_CHECKING, Any, Awaitable, Callable, Dict, Generator, List, NamedTuple, Optional, Set, Tuple
+)
 from elasticsearch import Elasticsearch
-from prometheus_client.core import GaugeMetricFamily
+from elasticsearch.exceptions import NotFoundError
+from prometheus_client.core import Metric
 
-from .base import BaseEsCollector
+from .base import BaseEsCollector, BlockFilter, compile_black_re, interval_handle
+from .compact import CompactGaugeFamily
+from .flatten import FlattenRow
+from .limit import SeriesLimiter
+from .offload import RawResponse, RowFlattener, json_loads
+
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+
+
+class IndexCache(NamedTuple):
+    signature: Tuple[Any, ...]
+    # [(context, flattened stats of the context), ...]
+    context_list: List[Tuple[str, FlattenRow]]
+
+
+class FlattenedIndicesStats(NamedTuple):
+    index_cache_dict: Dict[str, IndexCache]
+    all_index_cache: IndexCache
+
+
+def _index_signature(index_dict: Dict[str, Any]) -> Tuple[Any, ...]:
+    primaries: Dict[str, Any] = index_dict.get('primaries', {})
+    return (
+        primaries.get('indexing', {}).get('index_total', None),
+        primaries.get('docs', {}).get('count', None),
+        primaries.get('docs', {}).get('deleted', None),
+        primaries.get('store', {}).get('size_in_bytes', None),
+    )
+
+
+def _flatten_index(index_dict: Dict[str, Any], flatten_row: RowFlattener) -> IndexCache:
+    return IndexCache(
+        _index_signature(index_dict),
+        [
+            (key, flatten_row(IndicesStatsCollector.key + '_', index_dict.get(key, {})))
+            for key in ['primaries', 'total']
+        ]
+    )
+
+
+def flatten_indices_stats(response: Dict[str, Any], flatten_row: RowFlattener) -> FlattenedIndicesStats:
+    # may run in a worker process of the offload pool
+    # filter_path drops empty objects
+    return FlattenedIndicesStats(
+        {index: _flatten_index(index_dict, flatten_row) for index, index_dict in response.get('indices', {}).items()},
+        _flatten_index(response.get('_all', {}), flatten_row)
+    )
 
 
 class IndicesStatsCollector(BaseEsCollector):
     key: str = 'indices_stats'
+    default_derived_config: Dict[str, Any] = {
+        'counter': [
+            'indices_stats_(indexing_index|indexing_delete|get|search_query|search_fetch|search_scroll)'
+            '_(total|time_in_millis)',
+            'indices_stats_(merges|refresh|flush)_total(_time_in_millis)?',
+        ],
+        'rate': ['indices_stats_(indexing_index|search_query)_total'],
+        'ratio': [
+            {
+                'name': 'indices_stats_indexing_index_latency_milliseconds',
+                'numerator': 'indices_stats_indexing_index_time_in_millis',
+                'denominator': 'indices_stats_indexing_index_total'
+            },
+            {
+                'name': 'indices_stats_search_query_latency_milliseconds',
+                'numerator': 'indices_stats_search_query_time_in_millis',
+                'denominator': 'indices_stats_search_query_total'
+            },
+        ]
+    }
+    # url length limit for the hot index list, a full request is sent when it is exceeded
+    max_index_param_length: int = 4000
+    # the `metric` of the stats read by `_index_signature`
+    signature_metric_tuple: Tuple[str, ...] = ('indexing', 'docs', 'store')
+    # _cat/indices column -> (metric name, context)
+    cat_column_dict: Dict[str, Tuple[str, str]] = {
+        'docs.count': ('docs_count', 'primaries'),
+        'docs.deleted': ('docs_deleted', 'primaries'),
+        'pri.store.size': ('store_size_in_bytes', 'primaries'),
+        'store.size': ('store_size_in_bytes', 'total'),
+        'pri': ('number_of_shards', 'primaries'),
+        'rep': ('number_of_replicas', 'total'),
+    }
 
     def __init__(self, es_client: 'Elasticsearch', config: Dict[str, Any]):
         super().__init__(es_client, config)
@@ -17,22 +102,244 @@ class IndicesStatsCollector(BaseEsCollector):
             'red': 2
         }
 
-    def _get_metric(self):
-        response: Dict[str, Any] = self.es_client.indices.stats()
-        indices = response['indices']
-        indices['_all'] = response['_all']
-        labels_key_list = ['index', 'context']
-
-        for index, index_dict in indices.items():
-            for key in ['primaries', 'total']:
-                for metric_name, metric_doc, value in self.auto_gen_metric(self.key + '_', index_dict[key]):
-                    if self._is_block(metric_name):
-                        continue
-                    g: 'GaugeMetricFamily' = GaugeMetricFamily(
-                        metric_name,
-                        metric_doc,
-                        labels=labels_key_list
-                    )
-                    g.add_metric([index, key], value)
-                    yield g
+        # `stats`: indices.stats api, `cat`: compact _cat/indices api, only provides doc counts, sizes and health
+        self.mode: str = self.config.get('mode', 'stats')
+        if self.mode not in ('stats', 'cat'):
+            raise RuntimeError(f'Not support {self.key} mode:{self.mode}')
+        index: Any = self.config.get('index', None)
+        self.index: Optional[str] = ','.join(index) if isinstance(index, list) else index
+        metric: Any = self.config.get('metric', None)
+        self.metric: Optional[str] = ','.join(metric) if isinstance(metric, list) else metric
+
+        # incremental mode: indices whose stats changed since their last fetch(hot) are refreshed every interval,
+        # all indices are refreshed every `cold_interval` and the cached series of cold indices are reused between.
+        # A hot index turns cold after `cold_after` fetches in a row without change, new indices are found by
+        # listing the index names every interval
+        incremental_config: Any = self.config.get('incremental', None)
+        self.cold_interval: Optional[int] = None
+        self.cold_after: int = 1
+        if incremental_config:
+            if not isinstance(incremental_config, dict):
+                incremental_config = {}
+            self.cold_interval = interval_handle(incremental_config.get('cold_interval', '30m'))
+            self.cold_after = max(int(incremental_config.get('cold_after', 3)), 1)
+        if self.mode == 'stats':
+            self.flatten_func = flatten_indices_stats
+        if self.cold_interval is not None and self.metric and self.metric != '_all':
+            # the stats of the signature are always requested, the ones not in `metric` are not exported
+            metric_list: List[str] = self.metric.split(',')
+            signature_metric_list: List[str] = [i for i in self.signature_metric_tuple if i not in metric_list]
+            if signature_metric_list:
+                self.metric = ','.join(metric_list + signature_metric_list)
+                self.block_filter = BlockFilter(
+                    compile_black_re(
+                        ([self.block_filter.pattern] if self.block_filter.pattern else [])
+                        + [f'{self.key}_({"|".join(signature_metric_list)})_']
+                    ),
+                    self.block_filter.max_size
+                )
+        self._index_cache_dict: Dict[str, IndexCache] = {}
+        self._hot_index_set: Set[str] = set()
+        # index -> when its cached stats were fetched
+        self._fetch_time_dict: Dict[str, float] = {}
+        # hot index -> fetches in a row its signature did not change
+        self._unchanged_count_dict: Dict[str, int] = {}
+        self._next_full_request_time: float = 0.0
+        # None means the last request fetched all indices
+        self._request_index_list: Optional[List[str]] = None
+
+        # keep the series of the largest indices, e.g. {'top_n': 500, 'order_by': 'indices_stats_docs_count'}
+        series_limit_config: Optional[Dict[str, Any]] = self.config.get('series_limit', None)
+        self.series_limiter: Optional[SeriesLimiter] = None
+        if series_limit_config:
+            self.series_limiter = SeriesLimiter(
+                series_limit_config,
+                f'{self.key}_store_size_in_bytes',
+                order_label_dict={'context': 'total'},
+                key_label_tuple=('index',),
+                no_fold_family_set={f'{self.key}_health'},
+                pinned_key_set={('_all',)}
+            )
+
+    def request(self, es_client: 'Elasticsearch') -> Any:
+        if self.mode == 'cat':
+            return es_client.cat.indices(
+                index=self.index, format='json', bytes='b', h=','.join(['index', 'health'] + list(self.cat_column_dict))
+            )
+
+        self._request_index_list = None
+        if self.cold_interval is not None and time.time() < self._next_full_request_time:
+            # only the names, so a new index(e.g. the write index after a rollover) is hot from its first interval
+            cat_response: Any = es_client.cat.indices(index=self.index, format='json', h='index,status')
+            if inspect.isawaitable(cat_response):
+                return self._async_incremental_request(es_client, cat_response)
+            return self._incremental_request(es_client, cat_response)
+        return self._full_request(es_client)
+
+    def _incremental_request(self, es_client: 'Elasticsearch', cat_response: Any) -> Any:
+        if isinstance(cat_response, RawResponse):
+            # the body of many indices can be large enough to be returned undecoded in offload mode
+            cat_response = json_loads(cat_response.body)
+        # closed indices have no stats
+        index_set: Set[str] = {i['index'] for i in cat_response if i.get('status', None) != 'close'}
+        for index in set(self._index_cache_dict).difference(index_set, ('_all',)):
+            self._index_cache_dict.pop(index)
+            self._hot_index_set.discard(index)
+            self._unchanged_count_dict.pop(index, None)
+        self._hot_index_set.update(index_set.difference(self._index_cache_dict))
+
+        request_index_list: List[str] = sorted(self._hot_index_set)
+        if not request_index_list:
+            self._request_index_list = request_index_list
+            return {'indices': {}}
+        index_param: str = ','.join(request_index_list)
+        if len(index_param) > self.max_index_param_length:
+            return self._full_request(es_client)
+        self._request_index_list = request_index_list
+        return self._hot_request(es_client, index_param)
+
+    async def _async_incremental_request(self, es_client: 'AsyncElasticsearch', cat_response: Awaitable[Any]) -> Any:
+        response: Any = self._incremental_request(es_client, await cat_response)  # type: ignore
+        if inspect.isawaitable(response):
+            return await response
+        return response
+
+    def _full_request(self, es_client: 'Elasticsearch') -> Any:
+        return es_client.indices.stats(
+            index=self.index,
+            metric=self.metric,
+            filter_path=self.filter_path,
+            params=self.config.get('request_param', {})
+        )
+
+    def _hot_request(self, es_client: 'Elasticsearch', index_param: str) -> Any:
+        # a hot index can be deleted or closed since the last full request, the other hot indices are still
+        # fetched. A request that still fails with index_not_found falls back to a full request
+        try:
+            response: Any = es_client.indices.stats(
+                index=index_param,
+                metric=self.metric,
+                filter_path=self.filter_path,
+                params=dict(self.config.get('request_param', {}), ignore_unavailable='true', allow_no_indices='true')
+            )
+        except NotFoundError:
+            self._request_index_list = None
+            return self._full_request(es_client)
+        if inspect.isawaitable(response):
+            return self._async_hot_request(es_client, response)
+        return response
+
+    async def _async_hot_request(self, es_client: 'AsyncElasticsearch', response: Awaitable[Any]) -> Any:
+        try:
+            return await response
+        except NotFoundError:
+            self._request_index_list = None
+            return await self._full_request(es_client)  # type: ignore
+
+    def _get_cat_metric(self, response: List[Dict[str, Any]]):
+        labels_key_list: List[str] = ['index', 'context']
+        family_dict: Dict[str, CompactGaugeFamily] = {}
+        health_metric: str = f'{self.key}_health'
+        for index_dict in response:
+            index: str = index_dict['index']
+            if index_dict.get('health', None) and not self._is_block(health_metric):
+                g: CompactGaugeFamily = self.get_family(family_dict, health_metric, 'health', labels_key_list)
+                g.add_metric((index, 'total'), self.status_dict.get(index_dict['health'], 2))
+            for column, (metric, context) in self.cat_column_dict.items():
+                value: Optional[str] = index_dict.get(column, None)
+                metric_name: str = f'{self.key}_{metric}'
+                # closed index has no stats
+                if value is None or self._is_block(metric_name):
+                    continue
+                g = self.get_family(family_dict, metric_name, metric.replace('_', ' '), labels_key_list)
+                g.add_metric((index, context), float(value))
+        yield from self._limit(family_dict)
+
+    def _limit(self, family_dict: Dict[str, CompactGaugeFamily]) -> Generator[Metric, None, None]:
+        if self.series_limiter is None:
+            yield from family_dict.values()
+            return
+        family_list: List[CompactGaugeFamily] = list(family_dict.values())
+        self.series_limiter.reset()
+        self.series_limiter.limit(family_list)
+        yield from family_list
+        yield self.series_limiter.metric(self.key)
+
+    def get_fetch_time_func(self) -> Optional[Callable[[Tuple[str, ...]], Optional[float]]]:
+        if self.cold_interval is None or self.mode == 'cat':
+            return None
+        fetch_time_dict: Dict[str, float] = self._fetch_time_dict
+        return lambda label_value_tuple: fetch_time_dict.get(label_value_tuple[0], None)
+
+    def _get_metric(self, response: Any):
+        if self.mode == 'cat':
+            yield from self._get_cat_metric(response)
+            return
+
+        flattened: FlattenedIndicesStats = response
+        fetch_time: float = time.time()
+        if self._request_index_list is None:
+            # full request, indices that are not in the response have been deleted
+            index_cache_dict: Dict[str, IndexCache] = {}
+            hot_index_set: Set[str] = set()
+            unchanged_count_dict: Dict[str, int] = {}
+            for index, index_cache in flattened.index_cache_dict.items():
+                old_index_cache: Optional[IndexCache] = self._index_cache_dict.get(index, None)
+                if old_index_cache is None or old_index_cache.signature != index_cache.signature:
+                    hot_index_set.add(index)
+                    unchanged_count_dict[index] = 0
+                elif index in self._hot_index_set:
+                    unchanged_count: int = self._unchanged_count_dict.get(index, 0) + 1
+                    if unchanged_count < self.cold_after:
+                        hot_index_set.add(index)
+                        unchanged_count_dict[index] = unchanged_count
+                index_cache_dict[index] = index_cache
+            index_cache_dict['_all'] = flattened.all_index_cache
+            self._index_cache_dict = index_cache_dict
+            self._fetch_time_dict = dict.fromkeys(index_cache_dict, fetch_time)
+            self._hot_index_set = hot_index_set
+            self._unchanged_count_dict = unchanged_count_dict
+            if self.cold_interval is not None:
+                self._next_full_request_time = time.time() + self.cold_interval
+        else:
+            # `_all` of a hot request only sums the hot indices, so the cached one is kept until next full request.
+            # hot index that did not change in `cold_after` fetches turns cold, hot index that is not in the
+            # response was deleted or closed
+            for index in set(self._request_index_list).difference(flattened.index_cache_dict):
+                self._index_cache_dict.pop(index, None)
+                self._hot_index_set.discard(index)
+                self._unchanged_count_dict.pop(index, None)
+                self._fetch_time_dict.pop(index, None)
+            for index, index_cache in flattened.index_cache_dict.items():
+                old_index_cache = self._index_cache_dict.get(index, None)
+                if old_index_cache is None or old_index_cache.signature != index_cache.signature:
+                    self._unchanged_count_dict[index] = 0
+                else:
+                    unchanged_count = self._unchanged_count_dict.get(index, 0) + 1
+                    if unchanged_count >= self.cold_after:
+                        self._hot_index_set.discard(index)
+                        self._unchanged_count_dict.pop(index, None)
+                    else:
+                        self._unchanged_count_dict[index] = unchanged_count
+                self._index_cache_dict[index] = index_cache
+                self._fetch_time_dict[index] = fetch_time
+
+        extra_path_list: List[str] = []
+        if self.cold_interval is not None:
+            # the stats used by hot index detection
+            extra_path_list = [
+                'indices.*.primaries.indexing.index_total',
+                'indices.*.primaries.docs',
+                'indices.*.primaries.store.size_in_bytes'
+            ]
+        self.learn_filter_path({self.key + '_': ['indices.*.*', '_all.*']}, extra_path_list)
 
+        labels_key_list: List[str] = ['index', 'context']
+        family_dict: Dict[str, CompactGaugeFamily] = {}
+        for index, index_cache in self._index_cache_dict.items():
+            for key, row in index_cache.context_list:
+                labels_value_tuple: Tuple[str, str] = (index, key)
+                for metric_name, metric_doc, value in zip(row.name_tuple, row.doc_tuple, row.value_array):
+                    g: CompactGaugeFamily = self.get_family(family_dict, metric_name, metric_doc, labels_key_list)
+                    g.add_metric(labels_value_tuple, value)
+        yield from self._limit(family_dict)
@@ -0,0 +1,128 @@
+import heapq
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from prometheus_client.core import GaugeMetricFamily
+
+from .compact import CompactGaugeFamily
+
+other_label_value: str = '__other__'
+
+
+class SeriesLimiter(object):
+    # Bound the series of a collector by keeping the top `top_n` keys(e.g. an index, an aggregation bucket) ranked by
+    # the value of the family `order_by`(only its samples matching `order_label_dict` are used). The series of other
+    # keys are dropped, the series of the families in `fold_family_set`(None: all families) and not in
+    # `no_fold_family_set` are summed into one series whose key labels are `__other__`.
+    # With `max_series`, top_n shrinks so that about max_series series are kept
+    def __init__(
+            self,
+            config: Dict[str, Any],
+            order_by: str,
+            order_label_dict: Optional[Dict[str, str]] = None,
+            key_label_tuple: Optional[Tuple[str, ...]] = None,
+            fold_family_set: Optional[Set[str]] = None,
+            no_fold_family_set: Optional[Set[str]] = None,
+            pinned_key_set: Optional[Set[Tuple[str, ...]]] = None
+    ):
+        self.top_n: Optional[int] = int(config['top_n']) if config.get('top_n', None) is not None else None
+        self.max_series: Optional[int] = (
+            int(config['max_series']) if config.get('max_series', None) is not None else None
+        )
+        if self.top_n is None and self.max_series is None:
+            raise RuntimeError(f'series_limit of {order_by} needs top_n or max_series')
+        self.order_by: str = config.get('order_by', order_by)
+        self.order_label_dict: Dict[str, str] = config.get('order_labels', order_label_dict) or {}
+        # None: the key is all labels of the family
+        self.key_label_tuple: Optional[Tuple[str, ...]] = key_label_tuple
+        self.fold_family_set: Optional[Set[str]] = fold_family_set if config.get('other', True) else set()
+        # families whose values can not be summed, e.g. health
+        self.no_fold_family_set: Set[str] = no_fold_family_set or set()
+        # keys that are always kept and not counted by top_n, e.g. `_all` of indices stats
+        self.pinned_key_set: Set[Tuple[str, ...]] = pinned_key_set or set()
+        # series dropped since the last `reset`, the `__other__` series are not counted
+        self.dropped_count: int = 0
+
+    def reset(self) -> None:
+        self.dropped_count = 0
+
+    def _key_position_tuple(self, family: CompactGaugeFamily) -> Optional[Tuple[int, ...]]:
+        # None when the family does not have the key labels, its series are kept as they are
+        if self.key_label_tuple is None:
+            return tuple(range(len(family.label_key_tuple))) or None
+        if not all(key in family.label_key_tuple for key in self.key_label_tuple):
+            return None
+        return tuple(family.label_key_tuple.index(key) for key in self.key_label_tuple)
+
+    def limit(self, family_list: Sequence[CompactGaugeFamily], lazy: bool = False) -> None:
+        # mutate the families before they are published. `lazy` only limits when there are more than 2 * top_n keys,
+        # it is used while the families are still being filled(e.g. page by page), so the memory stays bounded and
+        # the result is the same as limiting once at the end
+        position_list: List[Optional[Tuple[int, ...]]] = [self._key_position_tuple(family) for family in family_list]
+        key_set: Set[Tuple[str, ...]] = set()
+        order_dict: Dict[Tuple[str, ...], float] = {}
+        series_count: int = 0
+        for family, position_tuple in zip(family_list, position_list):
+            if position_tuple is None:
+                continue
+            order_position_list: Optional[List[Tuple[int, str]]] = None
+            if family.name == self.order_by:
+                order_position_list = [
+                    (family.label_key_tuple.index(key), value) for key, value in self.order_label_dict.items()
+                    if key in family.label_key_tuple
+                ]
+            for label_value_tuple, value in zip(family.label_value_list, family.value_array):
+                key: Tuple[str, ...] = tuple(label_value_tuple[i] for i in position_tuple)
+                if key in self.pinned_key_set or all(i == other_label_value for i in key):
+                    continue
+                key_set.add(key)
+                series_count += 1
+                if order_position_list is not None and all(
+                    label_value_tuple[i] == order_label_value for i, order_label_value in order_position_list
+                ):
+                    order_dict[key] = max(value, order_dict.get(key, value))
+
+        top_n: int = self.top_n if self.top_n is not None else len(key_set)
+        if self.max_series is not None and series_count:
+            top_n = min(top_n, max(1, self.max_series * len(key_set) // series_count))
+        if len(key_set) <= (2 * top_n if lazy else top_n):
+            return
+        keep_key_set: Set[Tuple[str, ...]] = set(
+            heapq.nsmallest(top_n, key_set, key=lambda k: (-order_dict.get(k, 0.0), k))
+        )
+        keep_key_set.update(self.pinned_key_set)
+
+        for family, position_tuple in zip(family_list, position_list):
+            if position_tuple is None:
+                continue
+            fold: bool = (
+                self.fold_family_set is None or family.name in self.fold_family_set
+            ) and family.name not in self.no_fold_family_set
+            label_value_list: List[Tuple[str, ...]] = []
+            value_array: array = array('d')
+            other_dict: Dict[Tuple[str, ...], float] = {}
+            for label_value_tuple, value in zip(family.label_value_list, family.value_array):
+                key = tuple(label_value_tuple[i] for i in position_tuple)
+                if key in keep_key_set:
+                    label_value_list.append(label_value_tuple)
+                    value_array.append(value)
+                    continue
+                if not all(i == other_label_value for i in key):
+                    self.dropped_count += 1
+                if fold:
+                    other_label_value_list: List[str] = list(label_value_tuple)
+                    for i in position_tuple:
+                        other_label_value_list[i] = other_label_value
+                    other_tuple: Tuple[str, ...] = tuple(other_label_value_list)
+                    other_dict[other_tuple] = other_dict.get(other_tuple, 0.0) + value
+            family.label_value_list = label_value_list
+            family.value_array = value_array
+            for other_tuple, value in other_dict.items():
+                family.add_metric(other_tuple, value)
+
+    def metric(self, prefix: str) -> GaugeMetricFamily:
+        return GaugeMetricFamily(
+            prefix + '_series_dropped',
+            'Count of the series dropped by series_limit, the values of the dropped keys are summed into `__other__`',
+            value=self.dropped_count
+        )
@@ -0,0 +1,220 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple, Union
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+from elasticsearch_exporter.self_metric import StageTimer
+from elasticsearch_exporter.utils import BlockFilter
+from .flatten import FlattenRow, FlattenSchema
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# prefix, data -> flattened row
+RowFlattener = Callable[[str, Any], FlattenRow]
+# response, row flattener -> what `_get_metric` of the collector uses, must be a module level function
+FlattenFunc = Callable[[Any, RowFlattener], Any]
+
+# min body size of the responses that are returned undecoded, None decodes all responses
+_raw_min_size_context: 'contextvars.ContextVar[Optional[int]]' = contextvars.ContextVar('raw_min_size', default=None)
+
+
+def json_loads(s: Union[str, bytes, memoryview]) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # e.g. integer out of the 64 bit range, which is still valid json
+            pass
+    return json.loads(bytes(s) if isinstance(s, memoryview) else s)
+
+
+class RawResponse(NamedTuple):
+    # a large response body, decoded by the offload pool
+    body: str
+
+
+class Flattened(NamedTuple):
+    # result of the flatten func of a collector
+    data: Any
+
+
+class OffloadJSONSerializer(JSONSerializer):
+    # decode with orjson when it is installed. A large response of a request sent by `OffloadPool.request`
+    # is returned undecoded, small ones(e.g. the product check of the client) are always decoded
+    def loads(self, s: str) -> Any:
+        stage_timer: Optional[StageTimer] = StageTimer.current()
+        min_size: Optional[int] = _raw_min_size_context.get()
+        if min_size is not None and len(s) >= min_size:
+            if stage_timer is not None:
+                # decoded by the offload pool, which reports its decode time
+                stage_timer.add_response(len(s), 0.0)
+            return RawResponse(s)
+        start_time: float = time.perf_counter()
+        try:
+            response: Any = json_loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+        if stage_timer is not None:
+            stage_timer.add_response(len(s), time.perf_counter() - start_time)
+        return response
+
+
+class WorkerFlattener(object):
+    # BaseEsCollector.flatten_row in a worker process, the collectors with the same blacklist share the schemas
+    def __init__(self, black_re: Optional[str], block_cache_size: int):
+        self.block_filter: BlockFilter = BlockFilter(
+            re.compile(black_re) if black_re is not None else None, block_cache_size
+        )
+        self._flatten_schema_dict: Dict[str, FlattenSchema] = {}
+
+    def __call__(self, prefix: str, data: Any) -> FlattenRow:
+        schema: Optional[FlattenSchema] = self._flatten_schema_dict.get(prefix, None)
+        if schema is None:
+            schema = FlattenSchema(prefix, self.block_filter)
+            self._flatten_schema_dict[prefix] = schema
+        return schema.flatten(data)
+
+
+# (blacklist, block cache size) -> flattener, only used in the worker processes
+_worker_flattener_dict: Dict[Tuple[Optional[str], int], WorkerFlattener] = {}
+
+
+def _decode_flatten(
+        flatten_func: FlattenFunc, shm_name: str, size: int, black_re: Optional[str], block_cache_size: int
+) -> Tuple[Any, float, float]:
+    # return the flattened response, decode seconds and flatten seconds
+    flattener: Optional[WorkerFlattener] = _worker_flattener_dict.get((black_re, block_cache_size), None)
+    if flattener is None:
+        flattener = WorkerFlattener(black_re, block_cache_size)
+        _worker_flattener_dict[(black_re, block_cache_size)] = flattener
+    start_time: float = time.perf_counter()
+    shm: SharedMemory = SharedMemory(shm_name)
+    try:
+        with shm.buf[:size] as body:
+            response: Any = json_loads(body)
+    finally:
+        shm.close()
+    decode_time: float = time.perf_counter()
+    flattened: Any = flatten_func(response, flattener)
+    return flattened, decode_time - start_time, time.perf_counter() - decode_time
+
+
+class SharedBody(object):
+    # The body is passed to the worker in shared memory. A pickled argument is kept by the feeder thread of the
+    # call queue until the next call, which would hold a copy of the last large response between fetches
+    def __init__(self, response: RawResponse):
+        body: bytes = response.body.encode('utf-8', 'surrogatepass')
+        self.size: int = len(body)
+        self.shm: SharedMemory = SharedMemory(create=True, size=max(self.size, 1))
+        self.shm.buf[:self.size] = body
+
+    def __enter__(self) -> 'SharedBody':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+
+class OffloadPool(object):
+    # Decode and flatten the large responses of the collectors with a flatten func(`es_node`, `indices_stats` in
+    # stats mode) in worker processes. Only the compact rows(shared name tuples and value arrays) are sent back,
+    # so a huge response does not hold the GIL of the exporter for seconds, and the jobs of several large
+    # clusters use more than one core. Shared by all clusters, see BaseEsCollector.join_offload_pool
+    def __init__(self, config: Dict[str, Any]):
+        self.worker_size: int = int(config.get('workers', 2))
+        # a smaller response is decoded in the exporter, sending it to a worker costs more than decoding it
+        self.min_size: int = int(config.get('min_size', 1024 * 1024))
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # a child forked from the threaded exporter can hang on a lock held by another thread
+                method: str = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = ProcessPoolExecutor(self.worker_size, mp_context=multiprocessing.get_context(method))
+                logging.info(f'offload pool started. workers: {self.worker_size} min_size: {self.min_size}')
+            return self._executor
+
+    def _reset(self, executor: ProcessPoolExecutor) -> None:
+        # e.g. a worker was killed by the oom killer, the next call starts new workers
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def request(self, func: Callable[[Any], Any], es_client: Any) -> Any:
+        # return func(es_client), a large response is returned as RawResponse
+        token: contextvars.Token = _raw_min_size_context.set(self.min_size)
+        try:
+            response: Any = func(es_client)
+        finally:
+            _raw_min_size_context.reset(token)
+        if inspect.isawaitable(response):
+            return self._await_raw(response)
+        return response
+
+    async def _await_raw(self, awaitable: Awaitable[Any]) -> Any:
+        # the request of the async client is sent when it is awaited
+        token: contextvars.Token = _raw_min_size_context.set(self.min_size)
+        try:
+            return await awaitable
+        finally:
+            _raw_min_size_context.reset(token)
+
+    @staticmethod
+    def _record(stage_timer: StageTimer, start_time: float, result: Tuple[Any, float, float]) -> Any:
+        flattened, decode_seconds, flatten_seconds = result
+        stage_timer.add('decode', decode_seconds)
+        stage_timer.add('flatten', flatten_seconds)
+        stage_timer.add('offload', time.perf_counter() - start_time - decode_seconds - flatten_seconds)
+        return flattened
+
+    def flatten(
+            self, flatten_func: FlattenFunc, response: RawResponse, block_filter: BlockFilter, stage_timer: StageTimer
+    ) -> Any:
+        start_time: float = time.perf_counter()
+        executor: ProcessPoolExecutor = self._get_executor()
+        try:
+            with SharedBody(response) as shared_body:
+                result: Tuple[Any, float, float] = executor.submit(
+                    _decode_flatten, flatten_func, shared_body.shm.name, shared_body.size, block_filter.pattern,
+                    block_filter.max_size
+                ).result()
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise
+        return self._record(stage_timer, start_time, result)
+
+    async def async_flatten(
+            self, flatten_func: FlattenFunc, response: RawResponse, block_filter: BlockFilter, stage_timer: StageTimer
+    ) -> Any:
+        start_time: float = time.perf_counter()
+        executor: ProcessPoolExecutor = self._get_executor()
+        try:
+            with SharedBody(response) as shared_body:
+                future: Future = executor.submit(
+                    _decode_flatten, flatten_func, shared_body.shm.name, shared_body.size, block_filter.pattern,
+                    block_filter.max_size
+                )
+                result: Tuple[Any, float, float] = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise
+        return self._record(stage_timer, start_time, result)
@@ -1,17 +1,58 @@
-from collections import OrderedDict
+import asyncio
+import logging
+import time
 from functools import partial
-from typing import Any, Dict, Generator, List, Optional, Tuple, OrderedDict as OrderedDictType
+from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional, Set, Tuple, Union
 
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionTimeout
 from prometheus_client.core import GaugeMetricFamily
 
-from .base import interval_handle
+from elasticsearch_exporter.exposition import CachedExposition, render_exposition
+from elasticsearch_exporter.self_metric import StageTimer
+from .aggregation import AggregationsConverter
+from .base import add_const_label, interval_handle, series_count
+from .breaker import BreakerGroup, CircuitBreaker
+from .flatten import invalid_metric_char_re
+from .limit import SeriesLimiter
+
+if TYPE_CHECKING:
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch_exporter.async_engine import ClusterAsyncEngine
+
+# yields the body of the next request, is sent its response, returns the first response
+PageStep = Generator[Optional[Dict[str, Any]], Dict[str, Any], Optional[Dict[str, Any]]]
 
 
 class QueryMetricCollector(object):
-    def __init__(self, es_client: 'Elasticsearch'):
+    def __init__(self, es_client: 'Elasticsearch', const_label_dict: Optional[Dict[str, str]] = None):
         self.es_client: 'Elasticsearch' = es_client
-        self.custom_metric_dict: Dict[str, GaugeMetricFamily] = {}
+        self.const_label_dict: Dict[str, str] = const_label_dict or {}
+        # metric name -> families of the last run of that query. Keys are registered by `gen_job` before
+        # the scheduler starts, so each job only replaces its own value and the dict size never changes,
+        # which lets `collect` iterate it without copying
+        self._query_result_dict: Dict[str, Tuple[GaugeMetricFamily, ...]] = {}
+        # metric name -> rendered exposition of the families above, None until the query runs once
+        self._exposition_dict: Dict[str, Optional[CachedExposition]] = {}
+        # metric name -> (families of the last good response, when it was fetched), served while the breaker is open
+        self._good_result_dict: Dict[str, Tuple[Tuple[GaugeMetricFamily, ...], float]] = {}
+        self._breaker_dict: Dict[str, CircuitBreaker] = {}
+        # metric name -> limiter of the buckets, only the queries with `series_limit`
+        self._series_limiter_dict: Dict[str, SeriesLimiter] = {}
+        # families of all queries whose mismatched bucket labels were already warned
+        self._mismatch_family_set: Set[str] = set()
+        self.breaker_group: BreakerGroup = BreakerGroup()
+
+    def join_breaker_group(self, breaker_group: BreakerGroup) -> None:
+        # must be called before `gen_job`
+        self.breaker_group = breaker_group
+
+    @staticmethod
+    def get_metric_name(metric_config_dict: Dict[str, Any]) -> str:
+        return metric_config_dict["metric"].format(**metric_config_dict).replace("*", "")
+
+    def gen_stage_timer(self, metric_config_dict: Dict[str, Any]) -> StageTimer:
+        return StageTimer(metric_config_dict['name'], self.const_label_dict.get('cluster', ''))
 
     def gen_job(self, config: Dict[str, Any]) -> Generator[Tuple[partial, Dict[str, Any]], None, None]:
         global_c: Dict[str, Any] = config['global']
@@ -20,51 +61,209 @@ class QueryMetricCollector(object):
                 metric_config_dict['jitter'] = global_c['jitter']
             _interval: str = metric_config_dict.get('interval', global_c['interval'])
             metric_config_dict['interval'] = interval_handle(_interval)
+        # the results, breakers and limiters of a query are keyed by its metric name, so two queries with the same
+        # name would overwrite each other, reject the config before any job is scheduled
+        metric_name_set: set = set()
+        for metric_config_dict in config['metrics']:
+            metric: str = self.get_metric_name(metric_config_dict)
+            if metric in metric_name_set or metric in self._query_result_dict:
+                raise RuntimeError(f'metric:{metric} of query:{metric_config_dict["name"]} is used by another query')
+            metric_name_set.add(metric)
 
+        for metric_config_dict in config['metrics']:
+            metric = self.get_metric_name(metric_config_dict)
+            self._query_result_dict[metric] = ()
+            self._exposition_dict[metric] = None
+            breaker: CircuitBreaker = CircuitBreaker(
+                '/'.join(filter(None, [self.const_label_dict.get('cluster', None), metric])),
+                dict(global_c.get('breaker', None) or {}, **(metric_config_dict.get('breaker', None) or {})),
+                metric_config_dict['interval']
+            )
+            self._breaker_dict[metric] = breaker
+            self.breaker_group.add(breaker)
+            # keep the top buckets by doc_count or by a sub-aggregation(`order_by: <name>[_<field>]`),
+            # only doc_count of the other buckets is summed into the `__other__` bucket
+            series_limit_config: Optional[Dict[str, Any]] = metric_config_dict.get('series_limit', None)
+            if series_limit_config:
+                doc_count_family_name: str = metric + '_aggregations'
+                order_by: str = series_limit_config.get('order_by', '')
+                self._series_limiter_dict[metric] = SeriesLimiter(
+                    dict(
+                        series_limit_config,
+                        order_by=invalid_metric_char_re.sub('_', f'{doc_count_family_name}_{order_by}')
+                        if order_by else doc_count_family_name
+                    ),
+                    doc_count_family_name,
+                    fold_family_set={doc_count_family_name}
+                )
             yield (
                 partial(self.get_metric, metric_config_dict),
                 metric_config_dict
             )
 
-    def _aggregations_handle(
-            self, aggregations_dict: Dict[str, Dict[str, Any]], label_dict: Optional[OrderedDictType[str, str]] = None
-    ) -> Generator[Tuple[OrderedDictType[str, str], int], None, None]:
-        for metric_key, metric_dict in aggregations_dict.items():
-            if metric_key == 'key' or metric_key == 'doc_count':
-                continue
-            if label_dict is None:
-                label_dict: OrderedDict[str, str] = OrderedDict()
-            bucket_dict_list: List[Dict[str, Any]] = metric_dict["buckets"]
-            for bucket_dict in bucket_dict_list:
-                label_dict[metric_key] = bucket_dict['key']
-                if len(bucket_dict) > 2:
-                    yield from self._aggregations_handle(
-                        bucket_dict,
-                        label_dict=label_dict
-                    )
-                else:
-                    metric_value: int = bucket_dict['doc_count']
-                    yield label_dict, metric_value
+    def gen_async_job(
+            self, config: Dict[str, Any], engine: 'ClusterAsyncEngine'
+    ) -> Generator[Tuple[partial, Dict[str, Any]], None, None]:
+        for job, metric_config_dict in self.gen_job(config):
+            yield partial(self.async_get_metric, engine, metric_config_dict), metric_config_dict
 
-    def get_metric(self, metric_config_dict: Dict[str, Any]):
-        response: Dict[str, Any] = self.es_client.search(
+    @staticmethod
+    def request(
+            es_client: 'Union[Elasticsearch, AsyncElasticsearch]',
+            metric_config_dict: Dict[str, Any],
+            body: Optional[Dict[str, Any]] = None
+    ) -> Any:
+        return es_client.search(
             index=metric_config_dict['index'],
-            body=metric_config_dict['query_json'],
+            body=body or metric_config_dict['query_json'],
             params=metric_config_dict.get('request_param', {})
         )
-        metric: str = metric_config_dict["metric"].format(**metric_config_dict)
-        metric = metric.replace("*", "")
-        if response['timed_out']:
+
+    def gen_converter(self, metric_config_dict: Dict[str, Any]) -> AggregationsConverter:
+        metric: str = self.get_metric_name(metric_config_dict)
+        series_limiter: Optional[SeriesLimiter] = self._series_limiter_dict.get(metric, None)
+        if series_limiter is not None:
+            series_limiter.reset()
+        return AggregationsConverter(
+            metric,
+            metric_config_dict['doc'],
+            metric_config_dict['query_json'],
+            max_page=metric_config_dict.get('max_page', 100),
+            series_limiter=series_limiter,
+            mismatch_family_set=self._mismatch_family_set
+        )
+
+    async def async_get_metric(self, engine: 'ClusterAsyncEngine', metric_config_dict: Dict[str, Any]) -> None:
+        stage_timer: StageTimer = self.gen_stage_timer(metric_config_dict)
+        try:
+            await self._async_get_metric(engine, metric_config_dict, stage_timer)
+        finally:
+            stage_timer.observe()
+
+    def gen_page_step(
+            self, metric_config_dict: Dict[str, Any], converter: AggregationsConverter, stage_timer: StageTimer
+    ) -> PageStep:
+        # Paging state machine shared by the sync and the async job: it yields the body of the next request(None is
+        # the query itself) and is sent its response. It returns the first response when every page is converted,
+        # or None when the search timed out
+        response: Dict[str, Any] = yield None
+        if not self.check_response(metric_config_dict, response):
+            return None
+        # the first response only keeps `took` and `hits` after its aggregations is converted,
+        # so memory is bounded by one page
+        with stage_timer.stage('build'):
+            body: Optional[Dict[str, Any]] = converter.convert(response.pop('aggregations', {}))
+        while body is not None:
+            page_response: Dict[str, Any] = yield body
+            if not self.check_response(metric_config_dict, page_response):
+                return None
+            with stage_timer.stage('build'):
+                body = converter.convert(page_response['aggregations'])
+        self._breaker_dict[self.get_metric_name(metric_config_dict)].record_success()
+        return response
+
+    @staticmethod
+    def send_page(page_step: PageStep, page_response: Dict[str, Any]) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        # return (False, body of the next request) or (True, first response), a StopIteration can not pass a future
+        try:
+            return False, page_step.send(page_response)
+        except StopIteration as e:
+            return True, e.value
+
+    async def _async_get_metric(
+            self, engine: 'ClusterAsyncEngine', metric_config_dict: Dict[str, Any], stage_timer: StageTimer
+    ) -> None:
+        metric: str = self.get_metric_name(metric_config_dict)
+        breaker: CircuitBreaker = self._breaker_dict[metric]
+        if not breaker.allow_request():
+            await engine.run_in_executor(self.publish, metric_config_dict, None)
             return
+        converter: AggregationsConverter = self.gen_converter(metric_config_dict)
+        page_step: PageStep = self.gen_page_step(metric_config_dict, converter, stage_timer)
+        try:
+            done: bool = False
+            result: Optional[Dict[str, Any]] = next(page_step)
+            while not done:
+                with stage_timer.request():
+                    page_response: Dict[str, Any] = await engine.request(
+                        partial(self.request, metric_config_dict=metric_config_dict, body=result)
+                    )
+                done, result = await engine.run_in_executor(self.send_page, page_step, page_response)
+        except Exception as e:
+            await engine.run_in_executor(self.fetch_error, metric_config_dict, e)
+            return
+        if result is not None:
+            await engine.run_in_executor(self.handle_response, metric_config_dict, result, converter, stage_timer)
 
-        custom_metric_dict: Dict[str, GaugeMetricFamily] = {}
+    def get_metric(self, metric_config_dict: Dict[str, Any]):
+        stage_timer: StageTimer = self.gen_stage_timer(metric_config_dict)
+        try:
+            self._get_metric(metric_config_dict, stage_timer)
+        finally:
+            stage_timer.observe()
+
+    def _get_metric(self, metric_config_dict: Dict[str, Any], stage_timer: StageTimer) -> None:
+        metric: str = self.get_metric_name(metric_config_dict)
+        breaker: CircuitBreaker = self._breaker_dict[metric]
+        if not breaker.allow_request():
+            self.publish(metric_config_dict, None)
+            return
+        converter: AggregationsConverter = self.gen_converter(metric_config_dict)
+        page_step: PageStep = self.gen_page_step(metric_config_dict, converter, stage_timer)
+        try:
+            done: bool = False
+            result: Optional[Dict[str, Any]] = next(page_step)
+            while not done:
+                with stage_timer.request():
+                    page_response: Dict[str, Any] = self.request(self.es_client, metric_config_dict, result)
+                done, result = self.send_page(page_step, page_response)
+        except Exception as e:
+            self.fetch_error(metric_config_dict, e)
+            return
+        if result is not None:
+            self.handle_response(metric_config_dict, result, converter, stage_timer)
+
+    def fetch_error(self, metric_config_dict: Dict[str, Any], e: Exception) -> None:
+        if isinstance(e, (ConnectionTimeout, asyncio.TimeoutError)):
+            logging.warning(f'fetching {metric_config_dict["name"]} timeout')
+        else:
+            logging.warning(f'fetching error: {metric_config_dict["name"]} error:{e}')
+        self._breaker_dict[self.get_metric_name(metric_config_dict)].record_failure(e)
+        self.publish(metric_config_dict, None)
+
+    def check_response(self, metric_config_dict: Dict[str, Any], response: Dict[str, Any]) -> bool:
+        if response['timed_out']:
+            # the search(any page of it) hit its timeout on es side, the partial result is dropped
+            self._breaker_dict[self.get_metric_name(metric_config_dict)].record_pressure('timeout')
+            self.publish(metric_config_dict, None)
+            return False
+        return True
+
+    def handle_response(
+            self,
+            metric_config_dict: Dict[str, Any],
+            response: Dict[str, Any],
+            converter: AggregationsConverter,
+            stage_timer: StageTimer
+    ) -> None:
+        with stage_timer.stage('build'):
+            family_tuple: Tuple[GaugeMetricFamily, ...] = self.gen_family_tuple(metric_config_dict, response, converter)
+        stage_timer.series_count = series_count(family_tuple)
+        with stage_timer.stage('render'):
+            self.publish(metric_config_dict, family_tuple)
+
+    def gen_family_tuple(
+            self, metric_config_dict: Dict[str, Any], response: Dict[str, Any], converter: AggregationsConverter
+    ) -> Tuple[GaugeMetricFamily, ...]:
+        metric: str = self.get_metric_name(metric_config_dict)
+        family_list: List[GaugeMetricFamily] = []
         key: str = metric + '_total_milliseconds'
         g: 'GaugeMetricFamily' = GaugeMetricFamily(
             key,
             metric_config_dict['doc'] + ' total_milliseconds',
             value=response['took']
         )
-        custom_metric_dict[key] = g
+        family_list.append(g)
 
         total = response['hits']['total']
         if isinstance(total, dict):
@@ -76,24 +275,48 @@ class QueryMetricCollector(object):
             metric_config_dict['doc'] + ' hits_total',
             total
         )
-        custom_metric_dict[key] = g
-
-        if 'aggregations' in response:
-            key: str = metric + '_aggregations'
-            g: 'Optional[GaugeMetricFamily]' = None
-            for label_dict, metric_value in self._aggregations_handle(response['aggregations']):
-                if not g:
-                    label_key_list = label_dict.keys()
-                    g = GaugeMetricFamily(
-                        key,
-                        metric_config_dict['doc'] + f' custom query {",".join(label_key_list)}',
-                        labels=label_key_list
-                    )
-                g.add_metric(label_dict.values(), metric_value)
-            custom_metric_dict[key] = g
-        self.custom_metric_dict = custom_metric_dict
+        family_list.append(g)
+
+        if converter.series_limiter is not None:
+            converter.series_limiter.limit(converter.family_list)
+            family_list.append(converter.series_limiter.metric(metric))
+        family_list.extend(converter.family_list)
+        return tuple(family_list)
+
+    def publish(self, metric_config_dict: Dict[str, Any], family_tuple: Optional[Tuple[GaugeMetricFamily, ...]]):
+        # family_tuple is None when the query failed or was skipped by the breaker. The last good result is kept
+        # only while the breaker is open and until it is older than `max_stale`
+        metric: str = self.get_metric_name(metric_config_dict)
+        breaker: CircuitBreaker = self._breaker_dict[metric]
+        now: float = time.time()
+        if family_tuple is not None:
+            add_const_label(family_tuple, self.const_label_dict)
+            self._good_result_dict[metric] = (family_tuple, now)
+        elif not breaker.is_open:
+            self._good_result_dict.pop(metric, None)
+        good_family_tuple, good_timestamp = self._good_result_dict.get(metric, ((), now))
+        if now - good_timestamp > breaker.max_stale:
+            good_family_tuple, good_timestamp = (), now
+        meta_family_tuple: Tuple[GaugeMetricFamily, ...] = (
+            GaugeMetricFamily(
+                metric + '_stale_seconds',
+                metric_config_dict['doc'] + ' age of the result when it was published, not 0 when the last good '
+                                            'result is served',
+                value=now - good_timestamp
+            ),
+            breaker.metric(metric)
+        )
+        add_const_label(meta_family_tuple, self.const_label_dict)
+        published_family_tuple: Tuple[GaugeMetricFamily, ...] = good_family_tuple + meta_family_tuple
+        self._query_result_dict[metric] = published_family_tuple
+        # in multi-cluster mode the families are shared by all clusters and merged on scrape
+        self._exposition_dict[metric] = render_exposition(
+            published_family_tuple, split_family='cluster' in self.const_label_dict
+        )
+
+    def exposition_list(self) -> List[CachedExposition]:
+        return [exposition for exposition in self._exposition_dict.values() if exposition is not None]
 
     def collect(self) -> Generator[GaugeMetricFamily, None, None]:
-        custom_metric_dict: Dict[str, GaugeMetricFamily] = self.custom_metric_dict.copy()
-        for metric in custom_metric_dict.values():
-            yield metric
+        for family_tuple in self._query_result_dict.values():
+            yield from family_tuple
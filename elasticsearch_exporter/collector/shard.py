@@ -0,0 +1,182 @@
+import heapq
+import time
+from typing import Any, Dict, Generator, Iterator, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+
+from .base import BaseEsCollector
+from .compact import CompactGaugeFamily
+from .derive import counter_delta
+
+# index, shard, prirep, state, node, docs count, store size, index total
+ShardRow = Tuple[str, str, str, str, Optional[str], Optional[float], Optional[float], Optional[float]]
+# index, shard, prirep, node, docs count, store size, indexing rate
+ShardRecord = Tuple[str, str, str, str, float, float, Optional[float]]
+
+
+def _to_float(value: Any) -> Optional[float]:
+    return float(value) if value is not None else None
+
+
+class ShardStatsCollector(BaseEsCollector):
+    # Shard level view of a cluster without one series per shard: every fetch diffs the index_total of each shard
+    # against the last fetch, only the top `top_k` shards of every `order_by` get per shard series, the other
+    # shards are only counted in the per node totals and skew(node value / mean of the nodes with shards).
+    # The work is one pass over the shards with bounded heaps, the state kept between fetches is one float per shard
+    key: str = 'shard_stats'
+    cat_column_list: List[str] = ['index', 'shard', 'prirep', 'state', 'node', 'docs', 'store', 'indexing.index_total']
+    stats_filter_path: str = ','.join(
+        f'indices.*.shards.*.{path}' for path in [
+            'routing.state', 'routing.primary', 'routing.node', 'docs.count', 'store.size_in_bytes',
+            'indexing.index_total'
+        ]
+    )
+    # order_by -> index in ShardRecord
+    order_by_dict: Dict[str, int] = {'docs_count': 4, 'store_size': 5, 'indexing_rate': 6}
+
+    def __init__(self, es_client: 'Elasticsearch', config: Dict[str, Any]):
+        super().__init__(es_client, config)
+
+        # `cat`: _cat/shards, node label is the node name. `stats`: indices.stats(level=shards), node label is node id
+        self.mode: str = self.config.get('mode', 'cat')
+        if self.mode not in ('cat', 'stats'):
+            raise RuntimeError(f'Not support {self.key} mode:{self.mode}')
+        index: Any = self.config.get('index', None)
+        self.index: Optional[str] = ','.join(index) if isinstance(index, list) else index
+        self.top_k: int = int(self.config.get('top_k', 20))
+        order_by: Any = self.config.get('order_by', ['indexing_rate', 'store_size'])
+        self.order_by_list: List[str] = [order_by] if isinstance(order_by, str) else list(order_by)
+        for order_by in self.order_by_list:
+            if order_by not in self.order_by_dict:
+                raise RuntimeError(f'Not support {self.key} order_by:{order_by}, use one of {list(self.order_by_dict)}')
+
+        # shard copy(`index/shard/prirep/node`) -> index_total of the last fetch, and when it was fetched
+        self._last_index_total_dict: Dict[str, float] = {}
+        self._last_timestamp: Optional[float] = None
+
+    def request(self, es_client: 'Elasticsearch') -> Any:
+        if self.mode == 'cat':
+            return es_client.cat.shards(
+                index=self.index, format='json', bytes='b', h=','.join(self.cat_column_list),
+                params=self.config.get('request_param', {})
+            )
+        return es_client.indices.stats(
+            index=self.index, metric='docs,store,indexing', level='shards', filter_path=self.stats_filter_path,
+            params=self.config.get('request_param', {})
+        )
+
+    def _iter_shard_row(self, response: Any) -> Iterator[ShardRow]:
+        if self.mode == 'cat':
+            for row_dict in response:
+                yield (
+                    row_dict['index'], row_dict['shard'], row_dict['prirep'], row_dict['state'], row_dict.get('node'),
+                    _to_float(row_dict.get('docs')), _to_float(row_dict.get('store')),
+                    _to_float(row_dict.get('indexing.index_total'))
+                )
+            return
+        for index, index_dict in response.get('indices', {}).items():
+            for shard, copy_list in index_dict.get('shards', {}).items():
+                for copy_dict in copy_list:
+                    routing_dict: Dict[str, Any] = copy_dict.get('routing', {})
+                    yield (
+                        index, shard, 'p' if routing_dict.get('primary', False) else 'r',
+                        routing_dict.get('state', 'UNASSIGNED'), routing_dict.get('node'),
+                        _to_float(copy_dict.get('docs', {}).get('count')),
+                        _to_float(copy_dict.get('store', {}).get('size_in_bytes')),
+                        _to_float(copy_dict.get('indexing', {}).get('index_total'))
+                    )
+
+    def _get_metric(self, response: Any) -> Generator[CompactGaugeFamily, None, None]:
+        now: float = time.time()
+        duration: float = now - self._last_timestamp if self._last_timestamp is not None else 0.0
+        last_index_total_dict: Dict[str, float] = self._last_index_total_dict
+        index_total_dict: Dict[str, float] = {}
+        state_count_dict: Dict[str, int] = {}
+        node_count_dict: Dict[str, int] = {}
+        node_store_dict: Dict[str, float] = {}
+        node_rate_dict: Dict[str, float] = {}
+        # order_by -> min heap of (value, sequence, record), holds the top_k records seen so far
+        heap_dict: Dict[str, List[Tuple[float, int, ShardRecord]]] = {order_by: [] for order_by in self.order_by_list}
+
+        for sequence, (index, shard, prirep, state, node, docs, store, index_total) in enumerate(
+            self._iter_shard_row(response)
+        ):
+            state_count_dict[state] = state_count_dict.get(state, 0) + 1
+            if node is None:
+                # unassigned shard
+                continue
+            rate: Optional[float] = None
+            if index_total is not None:
+                # replicas of a shard share index, shard and prirep
+                shard_key: str = f'{index}/{shard}/{prirep}/{node}'
+                index_total_dict[shard_key] = index_total
+                last_index_total: Optional[float] = last_index_total_dict.get(shard_key, None)
+                if last_index_total is not None and duration > 0:
+                    rate = counter_delta(index_total, last_index_total) / duration
+                    node_rate_dict[node] = node_rate_dict.get(node, 0.0) + rate
+            node_count_dict[node] = node_count_dict.get(node, 0) + 1
+            node_store_dict[node] = node_store_dict.get(node, 0.0) + (store or 0.0)
+
+            record: ShardRecord = (index, shard, prirep, node, docs or 0.0, store or 0.0, rate)
+            for order_by, heap in heap_dict.items():
+                value: Optional[float] = record[self.order_by_dict[order_by]]
+                # e.g. a shard without indexing since the last fetch is never a hot shard
+                if not value:
+                    continue
+                if len(heap) < self.top_k:
+                    heapq.heappush(heap, (value, sequence, record))
+                elif value > heap[0][0]:
+                    heapq.heapreplace(heap, (value, sequence, record))
+        self._last_index_total_dict = index_total_dict
+        self._last_timestamp = now
+
+        family_dict: Dict[str, CompactGaugeFamily] = {}
+        shard_label_list: List[str] = ['index', 'shard', 'prirep', 'node']
+        # a shard in more than one top list is emitted once
+        record_dict: Dict[Tuple[str, str, str, str], ShardRecord] = {}
+        for order_by in self.order_by_list:
+            for _, _, record in sorted(heap_dict[order_by], reverse=True):
+                record_dict.setdefault(record[:4], record)
+        for metric, doc, value_index in (
+            ('docs_count', 'docs count of the shard', 4),
+            ('store_size_in_bytes', 'store size of the shard', 5),
+            ('indexing_index_per_second', 'indexed docs per second of the shard since the last fetch', 6),
+        ):
+            metric_name: str = f'{self.key}_{metric}'
+            if self._is_block(metric_name):
+                continue
+            for record in record_dict.values():
+                if record[value_index] is not None:
+                    self.get_family(family_dict, metric_name, doc, shard_label_list).add_metric(
+                        record[:4], record[value_index]
+                    )
+
+        state_metric: str = f'{self.key}_shards'
+        if not self._is_block(state_metric):
+            for state, count in state_count_dict.items():
+                self.get_family(family_dict, state_metric, 'shard count by state', ['state']).add_metric(
+                    (state,), count
+                )
+
+        node_count_mean: float = sum(node_count_dict.values()) / len(node_count_dict) if node_count_dict else 0.0
+        node_store_mean: float = sum(node_store_dict.values()) / len(node_store_dict) if node_store_dict else 0.0
+        for metric, doc, node_value_dict, mean in (
+            ('node_shards', 'shard count of the node', node_count_dict, None),
+            ('node_store_size_in_bytes', 'store size of the shards on the node', node_store_dict, None),
+            ('node_indexing_index_per_second', 'indexed docs per second of the shards on the node', node_rate_dict,
+             None),
+            ('node_shards_skew', 'shard count of the node / mean shard count of the nodes', node_count_dict,
+             node_count_mean),
+            ('node_store_size_skew', 'store size of the node / mean store size of the nodes', node_store_dict,
+             node_store_mean),
+        ):
+            metric_name = f'{self.key}_{metric}'
+            if self._is_block(metric_name):
+                continue
+            for node, value in node_value_dict.items():
+                if mean is not None:
+                    if not mean:
+                        continue
+                    value = value / mean
+                self.get_family(family_dict, metric_name, doc, ['node']).add_metric((node,), value)
+        yield from family_dict.values()
@@ -0,0 +1,261 @@
+import gzip
+import hashlib
+import re
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from prometheus_client.core import Metric
+from prometheus_client.exposition import generate_latest
+from prometheus_client.registry import REGISTRY, CollectorRegistry
+
+
+_family_name_re: 're.Pattern[bytes]' = re.compile(rb'^# HELP (\S+)', re.M)
+
+
+class FamilyBlock(NamedTuple):
+    name: bytes
+    # `# HELP` and `# TYPE` line
+    header: bytes
+    sample: bytes
+
+
+class CachedExposition(object):
+    # The text is compressed into one gzip member, or with `split_family` every family into two gzip members, its
+    # header and its samples. gzip members concatenate into a valid gzip body, so the expositions that share a
+    # family(e.g. the same collector of many clusters) are merged by joining the members of each family without
+    # decompressing anything. One member per text compresses better, it is split when it is merged.
+    # The compressed text is about a tenth of the text of a large snapshot, the text is only kept after a scrape
+    # without gzip asked for it, so it is decompressed once per publish and never for gzip only scrapers
+    __slots__ = ('etag', 'family_name_tuple', 'gzip_text', 'member_offset_tuple', '_text')
+
+    def __init__(
+            self,
+            etag: str,
+            family_name_tuple: Tuple[bytes, ...],
+            gzip_text: bytes,
+            member_offset_tuple: Optional[Tuple[int, ...]] = None,
+            text: Optional[bytes] = None
+    ):
+        self.etag: str = etag
+        self.family_name_tuple: Tuple[bytes, ...] = family_name_tuple
+        self.gzip_text: bytes = gzip_text
+        # family n: header member at [2n, 2n + 1), sample member at [2n + 1, 2n + 2) of gzip_text,
+        # None when the text is one member
+        self.member_offset_tuple: Optional[Tuple[int, ...]] = member_offset_tuple
+        self._text: Optional[bytes] = text
+
+    @property
+    def text(self) -> bytes:
+        text: Optional[bytes] = self._text
+        if text is None:
+            # two scrapes can decompress it at the same time, both get the same text
+            text = gzip.decompress(self.gzip_text)
+            self._text = text
+        return text
+
+
+class _FamilyCollector(object):
+    def __init__(self, family_iterable: Iterable[Metric]):
+        self.family_iterable: Iterable[Metric] = family_iterable
+
+    def collect(self) -> Iterable[Metric]:
+        return self.family_iterable
+
+
+def split_family_block(text: bytes) -> Tuple[FamilyBlock, ...]:
+    # the text format requires all samples of a family in one group under one `# TYPE` line
+    family_block_list: List[FamilyBlock] = []
+    for chunk in text.split(b'\n# HELP ')[0 if text.startswith(b'# HELP ') else 1:]:
+        if not chunk.startswith(b'# HELP '):
+            chunk = b'# HELP ' + chunk
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+        help_line, type_line, sample = chunk.split(b'\n', 2)
+        family_block_list.append(
+            FamilyBlock(help_line.split(b' ', 3)[2], help_line + b'\n' + type_line + b'\n', sample)
+        )
+    return tuple(family_block_list)
+
+
+def block_exposition(
+        etag: str, family_block_iterable: Iterable[FamilyBlock], text: Optional[bytes] = None
+) -> CachedExposition:
+    # the exposition with two members per family
+    family_name_list: List[bytes] = []
+    member_list: List[bytes] = []
+    member_offset_list: List[int] = [0]
+    offset: int = 0
+    for block in family_block_iterable:
+        family_name_list.append(block.name)
+        for part in (block.header, block.sample):
+            if part:
+                member: bytes = gzip.compress(part, compresslevel=6, mtime=0)
+                member_list.append(member)
+                offset += len(member)
+            member_offset_list.append(offset)
+    return CachedExposition(etag, tuple(family_name_list), b''.join(member_list), tuple(member_offset_list), text)
+
+
+def text_exposition(
+        text: bytes, family_name_tuple: Optional[Tuple[bytes, ...]] = None, keep_text: bool = False
+) -> CachedExposition:
+    # searching the names in the text of a large snapshot holds the GIL for as long as rendering it,
+    # so the renderer passes the names it already knows
+    if family_name_tuple is None:
+        family_name_tuple = tuple(_family_name_re.findall(text))
+    return CachedExposition(
+        hashlib.md5(text).hexdigest(),
+        family_name_tuple,
+        gzip.compress(text, compresslevel=6),
+        None,
+        text if keep_text else None
+    )
+
+
+def render_exposition(family_iterable: Iterable[Metric], split_family: bool = False) -> CachedExposition:
+    # family with `render_text`(CompactGaugeFamily) renders itself, the label text of the interned label
+    # tuples is shared by all families of the exposition
+    label_text_cache: Dict[Tuple[int, int], str] = {}
+    text_list: List[bytes] = []
+    family_name_list: List[bytes] = []
+    for family in family_iterable:
+        render_text: Optional[Callable[[Dict[Tuple[int, int], str]], bytes]] = getattr(family, 'render_text', None)
+        if render_text is None:
+            text: bytes = generate_latest(_FamilyCollector((family,)))  # type: ignore
+            family_name_list.extend(_family_name_re.findall(text))
+        else:
+            text = render_text(label_text_cache)
+            # starts with the `# HELP` line of its only family
+            family_name_list.append(_family_name_re.match(text).group(1))
+        text_list.append(text)
+    if not split_family:
+        return text_exposition(b''.join(text_list), tuple(family_name_list))
+    md5: 'hashlib._Hash' = hashlib.md5()
+    family_block_list: List[FamilyBlock] = []
+    for text in text_list:
+        md5.update(text)
+        family_block_list.extend(split_family_block(text))
+    return block_exposition(md5.hexdigest(), family_block_list)
+
+
+def merge_exposition(etag: str, exposition_list: List[CachedExposition]) -> CachedExposition:
+    # the header member of the first exposition with the family and the sample members of all of them
+    header_dict: Dict[bytes, memoryview] = {}
+    sample_dict: Dict[bytes, List[memoryview]] = {}
+    for exposition in exposition_list:
+        if exposition.member_offset_tuple is None:
+            # e.g. the live text, split once here
+            exposition = block_exposition(exposition.etag, split_family_block(exposition.text))
+        gzip_view: memoryview = memoryview(exposition.gzip_text)
+        offset_tuple: Tuple[int, ...] = exposition.member_offset_tuple  # type: ignore
+        for index, name in enumerate(exposition.family_name_tuple):
+            sample: memoryview = gzip_view[offset_tuple[2 * index + 1]:offset_tuple[2 * index + 2]]
+            if name in header_dict:
+                sample_dict[name].append(sample)
+            else:
+                header_dict[name] = gzip_view[offset_tuple[2 * index]:offset_tuple[2 * index + 1]]
+                sample_dict[name] = [sample]
+    member_list: List[memoryview] = []
+    member_offset_list: List[int] = [0]
+    offset: int = 0
+    for name, header in header_dict.items():
+        member_list.append(header)
+        offset += len(header)
+        member_offset_list.append(offset)
+        for sample in sample_dict[name]:
+            member_list.append(sample)
+            offset += len(sample)
+        member_offset_list.append(offset)
+    return CachedExposition(etag, tuple(header_dict), b''.join(member_list), tuple(member_offset_list))
+
+
+def has_duplicate_family(exposition_list: List[CachedExposition]) -> bool:
+    name_set: Set[bytes] = set()
+    block_count: int = 0
+    for exposition in exposition_list:
+        name_set.update(exposition.family_name_tuple)
+        block_count += len(exposition.family_name_tuple)
+    return block_count != len(name_set)
+
+
+class MergedCache(NamedTuple):
+    # etags of the cached parts -> the parts to serve, the parts are merged into one when they share a family
+    key: str
+    exposition_list: List[CachedExposition]
+    family_name_set: FrozenSet[bytes]
+
+
+class ExpositionRegistry(object):
+    # Collector whose data only changes when the scheduler refresh it renders its exposition once per refresh,
+    # a scrape only joins the cached bytes with the live rendered output of `registry`
+    def __init__(self, registry: CollectorRegistry = REGISTRY):
+        self.registry: CollectorRegistry = registry
+        # collector with `exposition_list() -> List[CachedExposition]`
+        self.cached_collector_list: List[Any] = []
+        # the cached parts of the last scrape, reused until any of them is published again. The live text changes
+        # on every scrape, so it is never part of the merge of the cached parts
+        self._merged_cache: Optional[MergedCache] = None
+
+    def register_cached(self, collector: Any) -> None:
+        self.cached_collector_list.append(collector)
+
+    def exposition_list(self) -> List[CachedExposition]:
+        # an ExpositionRegistry can itself be registered as a cached collector of another one,
+        # its live text is joined by `live_text` of the parent
+        return [exposition for collector in self.cached_collector_list for exposition in collector.exposition_list()]
+
+    def live_text(self) -> bytes:
+        text_list: List[bytes] = [generate_latest(self.registry)]
+        for collector in self.cached_collector_list:
+            live_text: Optional[Callable[[], bytes]] = getattr(collector, 'live_text', None)
+            if live_text is not None:
+                text_list.append(live_text())
+        return b''.join(text_list)
+
+    def _merge_cached(self) -> MergedCache:
+        exposition_list: List[CachedExposition] = self.exposition_list()
+        key: str = hashlib.md5(','.join(i.etag for i in exposition_list).encode()).hexdigest()
+        merged_cache: Optional[MergedCache] = self._merged_cache
+        if merged_cache is not None and merged_cache.key == key:
+            return merged_cache
+        if has_duplicate_family(exposition_list):
+            exposition_list = [merge_exposition(key, exposition_list)]
+        merged_cache = MergedCache(
+            key,
+            exposition_list,
+            frozenset(name for exposition in exposition_list for name in exposition.family_name_tuple)
+        )
+        self._merged_cache = merged_cache
+        return merged_cache
+
+    def render(self, if_none_match: Optional[str], accept_gzip: bool) -> Tuple[str, Optional[bytes]]:
+        # return etag and body, body is None when it matches `if_none_match`
+        merged_cache: MergedCache = self._merge_cached()
+        exposition_list: List[CachedExposition] = merged_cache.exposition_list
+        live_text: bytes = self.live_text()
+        if live_text:
+            # rendered for this scrape only, its text is kept for the scrapes without gzip
+            live_exposition: CachedExposition = text_exposition(live_text, keep_text=True)
+            if has_duplicate_family([live_exposition]):
+                # e.g. the transport metrics of every cluster
+                live_exposition = merge_exposition(live_exposition.etag, [live_exposition])
+            if merged_cache.family_name_set.isdisjoint(live_exposition.family_name_tuple):
+                exposition_list = exposition_list + [live_exposition]
+            else:
+                # a family that is both cached and live(e.g. a collector is scheduled in one cluster and
+                # collected per scrape in another one) needs the merge of all parts
+                exposition_list = [merge_exposition(live_exposition.etag, exposition_list + [live_exposition])]
+            etag: str = '"' + hashlib.md5(f'{merged_cache.key},{live_exposition.etag}'.encode()).hexdigest() + '"'
+        else:
+            etag = f'"{merged_cache.key}"'
+        if match_etag(if_none_match, etag):
+            return etag, None
+        if accept_gzip:
+            # an empty body is not a valid gzip stream
+            return etag, b''.join(exposition.gzip_text for exposition in exposition_list) or gzip.compress(b'')
+        return etag, b''.join(exposition.text for exposition in exposition_list)
+
+
+def match_etag(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [i.strip() for i in if_none_match.split(',')]
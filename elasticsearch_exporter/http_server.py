@@ -0,0 +1,109 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple, Type
+from urllib.parse import SplitResult, parse_qs, urlsplit
+
+from prometheus_client.exposition import CONTENT_TYPE_PLAIN_0_0_4
+
+from elasticsearch_exporter.exposition import ExpositionRegistry
+from elasticsearch_exporter.profiler import SamplingProfiler
+
+
+class MetricHandler(BaseHTTPRequestHandler):
+    exposition_registry: ExpositionRegistry = ExpositionRegistry()
+    # cluster name -> exposition of that cluster only, for `/probe?target=<cluster name>`
+    target_dict: Dict[str, ExpositionRegistry] = {}
+    # `/debug/profile?seconds=N`, None disables it
+    profiler: Optional[SamplingProfiler] = None
+    max_profile_seconds: float = 300.0
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_body(self, status: int, content_type: str, body: bytes, header_dict: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for key, value in (header_dict or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_metrics(self, exposition_registry: ExpositionRegistry) -> None:
+        accept_gzip: bool = 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag, body = exposition_registry.render(self.headers.get('If-None-Match', None), accept_gzip)
+        if body is None:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        header_dict: Dict[str, str] = {'ETag': etag}
+        if accept_gzip:
+            header_dict['Content-Encoding'] = 'gzip'
+        # the exposition is always rendered in the 0.0.4 text format
+        self.send_body(200, CONTENT_TYPE_PLAIN_0_0_4, body, header_dict)
+
+    def do_probe(self, query: str) -> None:
+        target_list: List[str] = parse_qs(query).get('target', [])
+        if not target_list:
+            self.send_body(400, 'text/plain', b'missing target parameter')
+            return
+        exposition_registry: Optional[ExpositionRegistry] = self.target_dict.get(target_list[0], None)
+        if exposition_registry is None:
+            self.send_body(404, 'text/plain', f'unknown target: {target_list[0]}'.encode())
+            return
+        self.do_metrics(exposition_registry)
+
+    def do_profile(self, query: str) -> None:
+        if self.profiler is None:
+            self.send_body(404, 'text/plain', b'profile is disabled, start the exporter with --enable_debug_profile')
+            return
+        try:
+            seconds: float = float(parse_qs(query).get('seconds', ['10'])[0])
+        except ValueError:
+            self.send_body(400, 'text/plain', b'seconds must be a number')
+            return
+        if not 0 < seconds <= self.max_profile_seconds:
+            self.send_body(400, 'text/plain', f'seconds must be in (0, {self.max_profile_seconds}]'.encode())
+            return
+        result: Optional[Tuple[bytes, int]] = self.profiler.profile(seconds)
+        if result is None:
+            self.send_body(409, 'text/plain', b'another profile is running')
+            return
+        body, sample_count = result
+        self.send_body(
+            200,
+            'text/plain; charset=utf-8',
+            body,
+            {'X-Profile-Seconds': str(seconds), 'X-Profile-Samples': str(sample_count)}
+        )
+
+    def do_GET(self) -> None:
+        url: SplitResult = urlsplit(self.path)
+        if url.path == '/favicon.ico':
+            self.send_body(200, 'text/plain', b'')
+        elif url.path == '/probe':
+            self.do_probe(url.query)
+        elif url.path == '/debug/profile':
+            self.do_profile(url.query)
+        else:
+            self.do_metrics(self.exposition_registry)
+
+
+def start_http_server(
+        port: int,
+        exposition_registry: ExpositionRegistry,
+        target_dict: Optional[Dict[str, ExpositionRegistry]] = None,
+        addr: str = '0.0.0.0',
+        profiler: Optional[SamplingProfiler] = None
+) -> ThreadingHTTPServer:
+    handler_class: Type[MetricHandler] = type(
+        'ExporterMetricHandler',
+        (MetricHandler,),
+        {'exposition_registry': exposition_registry, 'target_dict': target_dict or {}, 'profiler': profiler}
+    )
+    httpd: ThreadingHTTPServer = ThreadingHTTPServer((addr, port), handler_class)
+    thread: threading.Thread = threading.Thread(target=httpd.serve_forever, name='es_exporter_http_server')
+    thread.daemon = True
+    thread.start()
+    return httpd
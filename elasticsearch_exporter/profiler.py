@@ -0,0 +1,58 @@
+import sys
+import threading
+import time
+from types import CodeType, FrameType
+from typing import Dict, List, Optional, Tuple
+
+
+class SamplingProfiler(object):
+    # Sample the stacks of all threads every `interval` seconds while a profile runs, the result is in the collapsed
+    # stack format(`thread;outer frame;...;inner frame count` per line) that flamegraph.pl and speedscope read.
+    # Sampling only reads the frames, the exporter keeps running at normal speed apart from holding the GIL for the
+    # sample, and only one profile runs at a time
+    def __init__(self, interval: float = 0.01, max_depth: int = 128):
+        self.interval: float = interval
+        self.max_depth: int = max_depth
+        self._lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame: FrameType) -> str:
+        code: CodeType = frame.f_code
+        return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+
+    def _stack(self, frame: Optional[FrameType]) -> List[str]:
+        stack_list: List[str] = []
+        while frame is not None and len(stack_list) < self.max_depth:
+            stack_list.append(self._frame_name(frame))
+            frame = frame.f_back
+        stack_list.reverse()
+        return stack_list
+
+    def profile(self, seconds: float) -> Optional[Tuple[bytes, int]]:
+        # return the collapsed stacks and the sample count, None when another profile is running
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self_ident: int = threading.get_ident()
+            # (thread name, stack) -> count
+            count_dict: Dict[Tuple[str, Tuple[str, ...]], int] = {}
+            sample_count: int = 0
+            end_time: float = time.monotonic() + seconds
+            while time.monotonic() < end_time:
+                thread_name_dict: Dict[int, str] = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == self_ident:
+                        continue
+                    key: Tuple[str, Tuple[str, ...]] = (
+                        thread_name_dict.get(ident, str(ident)), tuple(self._stack(frame))
+                    )
+                    count_dict[key] = count_dict.get(key, 0) + 1
+                sample_count += 1
+                time.sleep(self.interval)
+        finally:
+            self._lock.release()
+        line_list: List[str] = [
+            ';'.join((thread_name,) + stack) + f' {count}'
+            for (thread_name, stack), count in sorted(count_dict.items(), key=lambda item: item[1], reverse=True)
+        ]
+        return '\n'.join(line_list).encode() + b'\n', sample_count
@@ -0,0 +1,144 @@
+import inspect
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from math import floor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from apscheduler.events import (
+    EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobEvent, JobExecutionEvent
+)
+from apscheduler.schedulers.base import BaseScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+from elasticsearch_exporter.collector.base import interval_handle
+from elasticsearch_exporter.self_metric import job_lag_histogram, job_missed_counter, job_run_histogram
+
+job_option_key_tuple: Tuple[str, ...] = ('max_instances', 'coalesce', 'misfire_grace_time')
+
+
+def gen_job_option_dict(config: Dict[str, Any]) -> Dict[str, Any]:
+    # `global.scheduler` or the config of one job -> add_job kwargs
+    option_dict: Dict[str, Any] = {}
+    if 'max_instances' in config:
+        option_dict['max_instances'] = int(config['max_instances'])
+    if 'coalesce' in config:
+        option_dict['coalesce'] = bool(config['coalesce'])
+    if 'misfire_grace_time' in config:
+        option_dict['misfire_grace_time'] = interval_handle(config['misfire_grace_time'])
+    return option_dict
+
+
+def gen_job_default_dict(scheduler_config: Dict[str, Any]) -> Dict[str, Any]:
+    # one run at a time and a late run is merged into the next one, so a slow query never piles up
+    return dict({'max_instances': 1, 'coalesce': True}, **gen_job_option_dict(scheduler_config))
+
+
+class PhaseIntervalTrigger(IntervalTrigger):
+    # IntervalTrigger adds the interval to the previous(jittered) fire time, so the jitter accumulates and the
+    # phase offset drifts away. Here every fire time stays on the grid `start_date + n * interval` plus jitter
+    def get_next_fire_time(self, previous_fire_time: Optional[datetime], now: datetime) -> Optional[datetime]:
+        if previous_fire_time:
+            start_timestamp: float = self.start_date.timestamp()
+            grid_count: int = floor((previous_fire_time.timestamp() - start_timestamp) / self.interval_length)
+            previous_fire_time = datetime.fromtimestamp(
+                start_timestamp + grid_count * self.interval_length, tz=self.timezone
+            )
+        return super().get_next_fire_time(previous_fire_time, now)
+
+
+class JobScheduler(object):
+    # Jobs are collected first and added when `schedule` is called, jobs that share an interval get evenly
+    # spread phase offsets in the order they were added, so they do not hit es at the same moment
+    def __init__(self, scheduler: 'BaseScheduler', scheduler_config: Dict[str, Any]):
+        self.scheduler: 'BaseScheduler' = scheduler
+        self.phase_spread: bool = bool(scheduler_config.get('phase_spread', True))
+        # job id -> (job, job config). The id is `<cluster>/<job name>`(the job name without cluster), a repeated
+        # name(e.g. two queries with the same `name`) gets `#<n>` appended, so every added job is scheduled
+        self._job_dict: 'OrderedDict[str, Tuple[Callable, Dict[str, Any]]]' = OrderedDict()
+        # job id -> label values(cluster, job) of the job metrics
+        self._label_dict: Dict[str, Tuple[str, str]] = {}
+        # job id -> start time of the last run, read by the listener when the run is finished
+        self._start_time_dict: Dict[str, float] = {}
+        scheduler.add_listener(
+            self._listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES
+        )
+
+    def add_job(self, job: Callable, config: Dict[str, Any], name: str, cluster: str = '') -> str:
+        # return the job id
+        prefix: str = f'{cluster}/' if cluster else ''
+        job_name: str = name
+        sequence: int = 1
+        while prefix + job_name in self._job_dict:
+            sequence += 1
+            job_name = f'{name}#{sequence}'
+        job_id: str = prefix + job_name
+        if job_name != name:
+            logging.warning(f'job:{prefix}{name} is added more than once, this one is scheduled as job:{job_id}')
+        self._job_dict[job_id] = (job, config)
+        self._label_dict[job_id] = (cluster, job_name)
+        return job_id
+
+    def _wrap(self, job: Callable, name: str) -> Callable:
+        label_tuple: Tuple[str, str] = self._label_dict[name]
+        if inspect.iscoroutinefunction(job):
+            async def _async_job() -> None:
+                start_time: float = time.time()
+                self._start_time_dict[name] = start_time
+                try:
+                    await job()
+                finally:
+                    job_run_histogram.labels(*label_tuple).observe(time.time() - start_time)
+            return _async_job
+
+        def _job() -> None:
+            start_time: float = time.time()
+            self._start_time_dict[name] = start_time
+            try:
+                job()
+            finally:
+                job_run_histogram.labels(*label_tuple).observe(time.time() - start_time)
+        return _job
+
+    def _listener(self, event: JobEvent) -> None:
+        label_tuple: Optional[Tuple[str, str]] = self._label_dict.get(event.job_id, None)
+        if label_tuple is None:
+            return
+        if event.code == EVENT_JOB_MISSED:
+            job_missed_counter.labels(*label_tuple, 'misfire').inc()
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            job_missed_counter.labels(*label_tuple, 'max_instances').inc()
+        elif isinstance(event, JobExecutionEvent):
+            start_time: Optional[float] = self._start_time_dict.get(event.job_id, None)
+            if start_time is not None:
+                job_lag_histogram.labels(*label_tuple).observe(
+                    max(start_time - event.scheduled_run_time.timestamp(), 0)
+                )
+
+    def schedule(self) -> int:
+        interval_dict: Dict[int, List[str]] = {}
+        for name, (job, config) in self._job_dict.items():
+            interval_dict.setdefault(config['interval'], []).append(name)
+
+        # the first run of every job is within one interval after start
+        start_date: datetime = datetime.now(timezone.utc) + timedelta(seconds=1)
+        for interval, name_list in interval_dict.items():
+            for index, name in enumerate(name_list):
+                job, config = self._job_dict[name]
+                offset: float = interval * index / len(name_list) if self.phase_spread else 0
+                jitter: float = config.get('jitter', 0) or 0
+                if jitter >= interval:
+                    logging.warning(f'jitter of job:{name} is not less than its interval, use {interval / 2}s')
+                    jitter = interval / 2
+                self.scheduler.add_job(
+                    self._wrap(job, name),
+                    PhaseIntervalTrigger(
+                        seconds=interval, start_date=start_date + timedelta(seconds=offset), jitter=jitter or None
+                    ),
+                    id=name,
+                    name=name,
+                    **gen_job_option_dict(config)
+                )
+                logging.debug(f'job:{name} interval:{interval}s phase offset:{offset:.3f}s')
+        return len(self._job_dict)
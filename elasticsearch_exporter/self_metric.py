@@ -0,0 +1,129 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# metrics about the exporter itself, registered to the default registry. `cluster` is the name of the cluster in
+# multi-cluster mode and empty otherwise
+
+es_request_latency_histogram: Histogram = Histogram(
+    'es_exporter_es_request_seconds',
+    'Latency of the requests sent to es',
+    ['cluster', 'endpoint'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+es_request_error_counter: Counter = Counter(
+    'es_exporter_es_request_error',
+    'Count of the requests sent to es that failed',
+    ['cluster', 'endpoint']
+)
+es_request_retry_counter: Counter = Counter(
+    'es_exporter_es_request_retry',
+    'Count of the requests to es that were retried on another connection',
+    ['cluster', 'endpoint']
+)
+job_run_histogram: Histogram = Histogram(
+    'es_exporter_job_run_seconds',
+    'Runtime of the scheduler job',
+    ['cluster', 'job'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+)
+job_lag_histogram: Histogram = Histogram(
+    'es_exporter_job_lag_seconds',
+    'Delay between the scheduled run time of the job and the time it starts running',
+    ['cluster', 'job'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+)
+job_missed_counter: Counter = Counter(
+    'es_exporter_job_missed',
+    'Count of the job runs that were skipped, '
+    'reason is `misfire`(started too late) or `max_instances`(the previous run was still running)',
+    ['cluster', 'job', 'reason']
+)
+cluster_target_up_gauge: Gauge = Gauge(
+    'es_exporter_cluster_target_up',
+    'Are the collectors of the cluster started, 0 when the cluster failed to start(see the log)',
+    ['cluster']
+)
+breaker_trip_counter: Counter = Counter(
+    'es_exporter_breaker_trip',
+    'Count of the pressure signals(timeout, 429, thread pool rejection) that tripped the breaker of a collector',
+    ['name', 'reason']
+)
+collector_stage_histogram: Histogram = Histogram(
+    'es_exporter_collector_stage_seconds',
+    'Seconds spent in each stage of a collector fetch, stage is `request`(es request without decoding), '
+    '`decode`(json decode), `flatten`(flatten and blacklist), `offload`(passing data to and from the offload pool), '
+    '`build`(family build), `derive`(derived metrics) or `render`(exposition render)',
+    ['cluster', 'collector', 'stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+collector_response_bytes_histogram: Histogram = Histogram(
+    'es_exporter_collector_response_bytes',
+    'Size of the es responses of a collector, counted in characters of the text(bytes of an ascii response)',
+    ['cluster', 'collector'],
+    buckets=(1024, 16384, 131072, 1048576, 8388608, 33554432, 134217728, 536870912)
+)
+collector_series_gauge: Gauge = Gauge(
+    'es_exporter_collector_series',
+    'Series count of the last successful fetch of a collector',
+    ['cluster', 'collector']
+)
+
+_stage_timer_context: 'contextvars.ContextVar[Optional[StageTimer]]' = contextvars.ContextVar(
+    'stage_timer', default=None
+)
+
+
+class StageTimer(object):
+    # Seconds spent in the stages of one fetch of a collector, observed together when the fetch is done.
+    # The json decode runs inside the es client, the serializer reports it to the timer of `request`
+    def __init__(self, collector: str, cluster: str = ''):
+        self.collector: str = collector
+        self.cluster: str = cluster
+        self.stage_dict: Dict[str, float] = {}
+        self.response_size_list: List[int] = []
+        self.series_count: Optional[int] = None
+
+    @staticmethod
+    def current() -> 'Optional[StageTimer]':
+        return _stage_timer_context.get()
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stage_dict[stage] = self.stage_dict.get(stage, 0.0) + seconds
+
+    def add_response(self, size: int, decode_seconds: float) -> None:
+        self.response_size_list.append(size)
+        self.add('decode', decode_seconds)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    @contextmanager
+    def request(self) -> Iterator[None]:
+        # the decode inside the request is only counted in `decode`
+        token: contextvars.Token = _stage_timer_context.set(self)
+        decode_seconds: float = self.stage_dict.get('decode', 0.0)
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            _stage_timer_context.reset(token)
+            self.add(
+                'request', time.perf_counter() - start_time - (self.stage_dict.get('decode', 0.0) - decode_seconds)
+            )
+
+    def observe(self) -> None:
+        for stage, seconds in self.stage_dict.items():
+            collector_stage_histogram.labels(self.cluster, self.collector, stage).observe(seconds)
+        for size in self.response_size_list:
+            collector_response_bytes_histogram.labels(self.cluster, self.collector).observe(size)
+        if self.series_count is not None:
+            collector_series_gauge.labels(self.cluster, self.collector).set(self.series_count)
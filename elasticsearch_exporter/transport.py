@@ -0,0 +1,232 @@
+import contextvars
+import logging
+import socket
+import time
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.exceptions import TransportError
+from elasticsearch.transport import Transport
+from prometheus_client.core import GaugeMetricFamily
+from urllib3.connection import HTTPConnection
+
+from elasticsearch_exporter.collector.base import add_const_label, interval_handle
+from elasticsearch_exporter.collector.offload import OffloadJSONSerializer
+from elasticsearch_exporter.self_metric import (
+    es_request_error_counter, es_request_latency_histogram, es_request_retry_counter
+)
+
+_endpoint_context: 'contextvars.ContextVar[str]' = contextvars.ContextVar('endpoint', default='/')
+# failed attempts of the current request that marked their connection dead
+_dead_count_context: 'contextvars.ContextVar[int]' = contextvars.ContextVar('dead_count', default=0)
+_keep_alive_socket_option_list: List[Any] = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+
+
+def get_endpoint(url: str) -> str:
+    # keep the label cardinality bounded, e.g. `/index-*/_search` -> `_search`, `/_nodes/n1/stats/jvm` -> `_nodes/stats`
+    segment_list: List[str] = url.split('?', 1)[0].strip('/').split('/')
+    for index, segment in enumerate(segment_list):
+        if not segment.startswith('_'):
+            continue
+        if segment == '_nodes':
+            return '_nodes/stats' if 'stats' in segment_list else segment
+        if segment in ('_cluster', '_cat') and index + 1 < len(segment_list):
+            return f'{segment}/{segment_list[index + 1]}'
+        return segment
+    return '/'
+
+
+def gen_transport_kwargs(transport_config: Dict[str, Any]) -> Dict[str, Any]:
+    # global.transport config -> kwargs of es client
+    kwargs: Dict[str, Any] = {}
+    for key in ('maxsize', 'max_retries'):
+        if key in transport_config:
+            kwargs[key] = int(transport_config[key])
+    for key in ('http_compress', 'retry_on_timeout', 'sniff_on_start', 'sniff_on_connection_fail'):
+        if key in transport_config:
+            kwargs[key] = bool(transport_config[key])
+    for key in ('timeout', 'sniffer_timeout'):
+        if key in transport_config:
+            kwargs[key] = interval_handle(transport_config[key])
+    return kwargs
+
+
+def gen_auth_kwargs(auth_config: Dict[str, Any]) -> Dict[str, Any]:
+    # credential and tls config of one cluster -> kwargs of es client
+    kwargs: Dict[str, Any] = {'verify_certs': bool(auth_config.get('verify_certs', False))}
+    if auth_config.get('username', None):
+        kwargs['http_auth'] = (auth_config['username'], auth_config.get('password', ''))
+    if auth_config.get('api_key', None):
+        kwargs['api_key'] = auth_config['api_key']
+    for key in ('ca_certs', 'client_cert', 'client_key'):
+        if auth_config.get(key, None):
+            kwargs[key] = auth_config[key]
+    if 'use_ssl' in auth_config:
+        kwargs['use_ssl'] = bool(auth_config['use_ssl'])
+    return kwargs
+
+
+def start_request(url: str) -> None:
+    _endpoint_context.set(get_endpoint(url))
+    _dead_count_context.set(0)
+
+
+def count_retry(cluster: str, max_retries: int) -> None:
+    # The transport marks the connection dead on every retryable failure, also on the last attempt after which
+    # it raises instead of retrying. Attempt n(from 1) is retried when n <= max_retries
+    dead_count: int = _dead_count_context.get() + 1
+    _dead_count_context.set(dead_count)
+    if dead_count <= max_retries:
+        es_request_retry_counter.labels(cluster, _endpoint_context.get()).inc()
+
+
+class InstrumentedConnection(Urllib3HttpConnection):
+    def __init__(self, *args: Any, keep_alive: bool = True, cluster: str = '', **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.cluster: str = cluster
+        if keep_alive:
+            # tcp keepalive stops idle pooled connections from being silently dropped(e.g. by a firewall)
+            self.pool.conn_kw['socket_options'] = _keep_alive_socket_option_list
+
+    def perform_request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+        endpoint: str = get_endpoint(url)
+        start_time: float = time.perf_counter()
+        try:
+            return super().perform_request(method, url, *args, **kwargs)
+        except Exception:
+            es_request_error_counter.labels(self.cluster, endpoint).inc()
+            raise
+        finally:
+            es_request_latency_histogram.labels(self.cluster, endpoint).observe(time.perf_counter() - start_time)
+
+
+class InstrumentedTransport(Transport):
+    def __init__(self, hosts: Any, *args: Any, sniff_on_start: bool = False, **kwargs: Any):
+        # The sniff on start raises in the constructor when the cluster is unreachable, which stopped the whole
+        # exporter. It is deferred to the first request and retried by every request until it succeeds
+        # (the async transport already sniffs in its first request)
+        super().__init__(hosts, *args, **kwargs)
+        self.sniff_pending: bool = sniff_on_start
+
+    def perform_request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+        start_request(url)
+        if self.sniff_pending:
+            try:
+                self.sniff_hosts(True)
+                self.sniff_pending = False
+            except TransportError as e:
+                logging.warning(f'sniff hosts failed, use the configured hosts for now. error:{e}')
+        return super().perform_request(method, url, *args, **kwargs)
+
+    def mark_dead(self, connection: Any) -> None:
+        count_retry(connection.cluster, self.max_retries)
+        super().mark_dead(connection)
+
+
+def gen_es_client(
+        es_cluster_list: List[str],
+        transport_config: Dict[str, Any],
+        auth_config: Optional[Dict[str, Any]] = None,
+        cluster: str = ''
+) -> Elasticsearch:
+    # `cluster` is the label value of the request metrics, passed to the connections by the transport
+    return Elasticsearch(
+        es_cluster_list,
+        transport_class=InstrumentedTransport,
+        connection_class=InstrumentedConnection,
+        serializer=OffloadJSONSerializer(),
+        keep_alive=bool(transport_config.get('keep_alive', True)),
+        cluster=cluster,
+        **gen_auth_kwargs(auth_config or {}),
+        **gen_transport_kwargs(transport_config)
+    )
+
+
+def gen_async_es_client(
+        es_cluster_list: List[str],
+        transport_config: Dict[str, Any],
+        auth_config: Optional[Dict[str, Any]] = None,
+        cluster: str = ''
+) -> Any:
+    from elasticsearch import AsyncElasticsearch, AsyncTransport, AIOHttpConnection
+
+    class InstrumentedAIOHttpConnection(AIOHttpConnection):
+        def __init__(self, *args: Any, cluster: str = '', **kwargs: Any):
+            super().__init__(*args, **kwargs)
+            self.cluster: str = cluster
+
+        async def perform_request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+            endpoint: str = get_endpoint(url)
+            start_time: float = time.perf_counter()
+            try:
+                return await super().perform_request(method, url, *args, **kwargs)
+            except Exception:
+                es_request_error_counter.labels(self.cluster, endpoint).inc()
+                raise
+            finally:
+                es_request_latency_histogram.labels(self.cluster, endpoint).observe(time.perf_counter() - start_time)
+
+    class InstrumentedAsyncTransport(AsyncTransport):
+        async def perform_request(self, method: str, url: str, *args: Any, **kwargs: Any) -> Any:
+            start_request(url)
+            return await super().perform_request(method, url, *args, **kwargs)
+
+        def mark_dead(self, connection: Any) -> None:
+            count_retry(connection.cluster, self.max_retries)
+            super().mark_dead(connection)
+
+    return AsyncElasticsearch(
+        es_cluster_list,
+        transport_class=InstrumentedAsyncTransport,
+        connection_class=InstrumentedAIOHttpConnection,
+        serializer=OffloadJSONSerializer(),
+        cluster=cluster,
+        **gen_auth_kwargs(auth_config or {}),
+        **gen_transport_kwargs(transport_config)
+    )
+
+
+class TransportCollector(object):
+    # connection pool utilization of every es node the clients know, the async client(async mode) sends the
+    # scheduler requests and the sync client the requests of the collectors fetched on scrape
+    def __init__(self, es_client: Elasticsearch, const_label_dict: Optional[Dict[str, str]] = None):
+        self.es_client: Elasticsearch = es_client
+        self.const_label_dict: Dict[str, str] = const_label_dict or {}
+        # set by `ClusterTarget.add_job` in async mode
+        self.async_es_client: Optional[Any] = None
+
+    def collect(self) -> Generator[GaugeMetricFamily, None, None]:
+        labels: List[str] = ['host', 'client']
+        maxsize_g: GaugeMetricFamily = GaugeMetricFamily(
+            'es_exporter_transport_pool_maxsize', 'Max connections of the pool per es node', labels=labels
+        )
+        in_use_g: GaugeMetricFamily = GaugeMetricFamily(
+            'es_exporter_transport_pool_in_use', 'Connections currently checked out of the pool', labels=labels
+        )
+        created_g: GaugeMetricFamily = GaugeMetricFamily(
+            'es_exporter_transport_pool_created',
+            'Connections opened by the pool since start, only the sync client counts them',
+            labels=labels
+        )
+        for connection in self.es_client.transport.connection_pool.connections:
+            pool: Any = getattr(connection, 'pool', None)
+            if pool is None or pool.pool is None:
+                continue
+            maxsize: int = pool.pool.maxsize
+            maxsize_g.add_metric([connection.host, 'sync'], maxsize)
+            in_use_g.add_metric([connection.host, 'sync'], maxsize - pool.pool.qsize())
+            created_g.add_metric([connection.host, 'sync'], pool.num_connections)
+        if self.async_es_client is not None:
+            for connection in self.async_es_client.transport.connection_pool.connections:
+                # the aiohttp session is created by the first request of the connection
+                session: Any = getattr(connection, 'session', None)
+                if session is None or session.connector is None:
+                    continue
+                maxsize_g.add_metric([connection.host, 'async'], session.connector.limit)
+                in_use_g.add_metric([connection.host, 'async'], len(session.connector._acquired))
+        family_tuple: Tuple[GaugeMetricFamily, ...] = (maxsize_g, in_use_g, created_g)
+        add_const_label(family_tuple, self.const_label_dict)
+        yield from family_tuple
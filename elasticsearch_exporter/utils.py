@@ -1,12 +1,13 @@
 import functools
 import logging
+import re
 import time
 import signal
 import sys
 import os
 from enum import Enum
 
-from typing import Callable, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 
 def shutdown(shutdown_signals: Tuple[Enum, ...] = (signal.SIGINT, signal.SIGTERM)):
@@ -42,3 +43,62 @@ def shutdown(shutdown_signals: Tuple[Enum, ...] = (signal.SIGINT, signal.SIGTERM
                     signal.signal(sig, old_handler)
         return wrapper
     return decorator
+
+
+def interval_handle(_interval: str) -> int:
+    try:
+        try:
+            interval: int = int(_interval)
+        except ValueError:
+            interval: int = int(_interval[:-1])
+            unit: str = _interval[-1]
+            if unit == 's':
+                pass
+            elif unit == 'm':
+                interval = interval * 60
+            elif unit == 'h':
+                interval = interval * 60 * 60
+        return interval
+    except Exception:
+        raise RuntimeError('Not support interval:{}'.format(_interval))
+
+
+_global_flag_re: 're.Pattern[str]' = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+def compile_black_re(black_re_list: List[str]) -> 'Optional[re.Pattern[str]]':
+    # merge all pattern into one alternation, global flag(e.g. `(?i)`) is only allowed at the start of
+    # the expression, so it is turned into a scoped flag group
+    if not black_re_list:
+        return None
+    sub_re_list: List[str] = []
+    for black_re in black_re_list:
+        flag_match: 'Optional[re.Match[str]]' = _global_flag_re.match(black_re)
+        if flag_match:
+            sub_re_list.append(f'(?{flag_match.group(1)}:{black_re[flag_match.end():]})')
+        else:
+            sub_re_list.append(f'(?:{black_re})')
+    return re.compile('|'.join(sub_re_list))
+
+
+class BlockFilter(object):
+    # `black_re` check of the metric names, used by the collectors and by the workers of the offload pool.
+    # A metric name is checked for every row of a response, so the decisions(allowed and blocked) are cached,
+    # the cache is cleared when it is full
+    def __init__(self, black_re: 'Optional[re.Pattern[str]]', max_size: int = 65536):
+        self.black_re: 'Optional[re.Pattern[str]]' = black_re
+        self.max_size: int = max_size
+        self._decision_dict: Dict[str, bool] = {}
+
+    @property
+    def pattern(self) -> Optional[str]:
+        return self.black_re.pattern if self.black_re is not None else None
+
+    def __call__(self, metric: str) -> bool:
+        is_block: Optional[bool] = self._decision_dict.get(metric, None)
+        if is_block is None:
+            is_block = self.black_re is not None and self.black_re.match(metric) is not None
+            if len(self._decision_dict) >= self.max_size:
+                self._decision_dict.clear()
+            self._decision_dict[metric] = is_block
+        return is_block
@@ -0,0 +1,108 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from prometheus_client.core import GaugeMetricFamily, Metric
+
+from elasticsearch_exporter.collector.compact import CompactGaugeFamily, LabelInterner
+from elasticsearch_exporter.collector.derive import DerivedMetric
+
+derived_config: Dict[str, object] = {
+    'counter': ['x_query_(total|time_in_millis)'],
+    'rate': ['x_query_total'],
+    'ratio': [
+        {'name': 'x_query_latency_milliseconds', 'numerator': 'x_query_time_in_millis', 'denominator': 'x_query_total'}
+    ]
+}
+
+
+def _derive(
+        derived_metric: DerivedMetric,
+        total_dict: Dict[str, float],
+        time_dict: Dict[str, float],
+        timestamp: float,
+        fetch_time_dict: Optional[Dict[str, float]] = None
+) -> Dict[str, Dict[str, float]]:
+    # `total_dict`: node -> query total, `time_dict`: node -> query time.
+    # Return the derived families, family name -> node -> value
+    interner: LabelInterner = LabelInterner()
+    family_list: List[Metric] = []
+    for name, value_dict in (('x_query_total', total_dict), ('x_query_time_in_millis', time_dict)):
+        family: CompactGaugeFamily = CompactGaugeFamily(name, name, ['node'], interner)
+        for node, value in value_dict.items():
+            family.add_metric((node,), value)
+        family_list.append(family)
+    family_list.append(GaugeMetricFamily('x_up', 'up', value=1))
+    get_fetch_time: Optional[Callable[[Tuple[str, ...]], Optional[float]]] = None
+    if fetch_time_dict is not None:
+        get_fetch_time = lambda label_value_tuple: fetch_time_dict.get(label_value_tuple[0], None)  # noqa: E731
+    result_list: List[Metric] = derived_metric.derive(family_list, timestamp, interner, get_fetch_time)
+    # the input families are passed through
+    assert [family for family in result_list if family in family_list] == family_list
+    return {
+        family.name: dict(zip((i[0] for i in family.label_value_list), family.value_array))
+        for family in result_list if family not in family_list
+    }
+
+
+def test_first_sample() -> None:
+    derived_metric: DerivedMetric = DerivedMetric(True, derived_config)
+    assert _derive(derived_metric, {'a': 10}, {'a': 20}, 100) == {}
+    assert _derive(derived_metric, {'a': 30, 'b': 1}, {'a': 60, 'b': 1}, 110) == {
+        'x_query_per_second': {'a': 2.0},
+        'x_query_latency_milliseconds': {'a': 2.0},
+    }
+
+
+def test_counter() -> None:
+    derived_metric: DerivedMetric = DerivedMetric(True, derived_config)
+    interner: LabelInterner = LabelInterner()
+    family: CompactGaugeFamily = CompactGaugeFamily('x_query_total', 'query', ['node'], interner)
+    other_family: CompactGaugeFamily = CompactGaugeFamily('x_docs_count', 'docs', ['node'], interner)
+    derived_metric.derive([family, other_family], 100, interner)
+    # the rate is named after the gauge name, the counter drops `_total` as prometheus_client requires
+    assert (family.type, family.name, family.sample_name) == ('counter', 'x_query', 'x_query_total')
+    assert (other_family.type, other_family.name) == ('gauge', 'x_docs_count')
+
+
+def test_counter_reset() -> None:
+    derived_metric: DerivedMetric = DerivedMetric(True, derived_config)
+    _derive(derived_metric, {'a': 100}, {'a': 100}, 100)
+    # the node restarted, its counters count from 0
+    assert _derive(derived_metric, {'a': 20}, {'a': 60}, 110) == {
+        'x_query_per_second': {'a': 2.0},
+        'x_query_latency_milliseconds': {'a': 3.0},
+    }
+
+
+def test_no_ratio_without_increase() -> None:
+    derived_metric: DerivedMetric = DerivedMetric(True, derived_config)
+    _derive(derived_metric, {'a': 10}, {'a': 20}, 100)
+    assert _derive(derived_metric, {'a': 10}, {'a': 20}, 110) == {
+        'x_query_per_second': {'a': 0.0},
+        'x_query_latency_milliseconds': {},
+    }
+
+
+def test_stale_row() -> None:
+    derived_metric: DerivedMetric = DerivedMetric(True, derived_config)
+    _derive(derived_metric, {'a': 0, 'b': 0}, {'a': 0, 'b': 0}, 100, {'a': 100, 'b': 100})
+    assert _derive(derived_metric, {'a': 10, 'b': 20}, {'a': 10, 'b': 40}, 110, {'a': 110, 'b': 110}) == {
+        'x_query_per_second': {'a': 1.0, 'b': 2.0},
+        'x_query_latency_milliseconds': {'a': 1.0, 'b': 2.0},
+    }
+    # `b` is reused from the cache, it keeps its last rate and ratio
+    assert _derive(derived_metric, {'a': 20, 'b': 20}, {'a': 40, 'b': 40}, 120, {'a': 120, 'b': 110}) == {
+        'x_query_per_second': {'a': 1.0, 'b': 2.0},
+        'x_query_latency_milliseconds': {'a': 3.0, 'b': 2.0},
+    }
+    # fetched again after 20 seconds, the rate is over the time since its own last fetch
+    assert _derive(derived_metric, {'a': 30, 'b': 80}, {'a': 50, 'b': 100}, 130, {'a': 130, 'b': 130}) == {
+        'x_query_per_second': {'a': 1.0, 'b': 3.0},
+        'x_query_latency_milliseconds': {'a': 1.0, 'b': 1.0},
+    }
+
+
+def test_disabled_rule() -> None:
+    # an empty list disables the default of the collector
+    derived_metric: DerivedMetric = DerivedMetric({'rate': []}, derived_config)
+    _derive(derived_metric, {'a': 10}, {'a': 20}, 100)
+    assert _derive(derived_metric, {'a': 30}, {'a': 60}, 110) == {'x_query_latency_milliseconds': {'a': 2.0}}
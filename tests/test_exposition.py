@@ -0,0 +1,98 @@
+import gzip
+from typing import List
+
+import pytest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+
+from elasticsearch_exporter.collector.compact import CompactGaugeFamily, LabelInterner
+from elasticsearch_exporter.exposition import (
+    CachedExposition, has_duplicate_family, match_etag, merge_exposition, render_exposition, text_exposition
+)
+
+
+def _family_list(cluster: str) -> List[Metric]:
+    interner: LabelInterner = LabelInterner()
+    node_family: CompactGaugeFamily = CompactGaugeFamily('es_node_docs', 'docs', ['node', 'cluster'], interner)
+    node_family.add_metric(('node-1', cluster), 1)
+    node_family.add_metric(('node-2', cluster), 2)
+    query_family: CompactGaugeFamily = CompactGaugeFamily('es_node_query_total', 'query', ['cluster'], interner)
+    query_family.add_metric((cluster,), 3)
+    query_family.as_counter()
+    up_family: GaugeMetricFamily = GaugeMetricFamily('es_node_up', 'up', labels=['cluster'])
+    up_family.add_metric([cluster], 1)
+    return [node_family, query_family, up_family]
+
+
+@pytest.mark.parametrize('split_family', [False, True])
+def test_render(split_family: bool) -> None:
+    exposition: CachedExposition = render_exposition(_family_list('a'), split_family=split_family)
+    assert exposition.family_name_tuple == (b'es_node_docs', b'es_node_query_total', b'es_node_up')
+    assert gzip.decompress(exposition.gzip_text) == exposition.text
+    assert exposition.text == (
+        b'# HELP es_node_docs docs\n'
+        b'# TYPE es_node_docs gauge\n'
+        b'es_node_docs{cluster="a",node="node-1"} 1.0\n'
+        b'es_node_docs{cluster="a",node="node-2"} 2.0\n'
+        b'# HELP es_node_query_total query\n'
+        b'# TYPE es_node_query_total counter\n'
+        b'es_node_query_total{cluster="a"} 3.0\n'
+        b'# HELP es_node_up up\n'
+        b'# TYPE es_node_up gauge\n'
+        b'es_node_up{cluster="a"} 1.0\n'
+    )
+    # the etag only depends on the text
+    assert exposition.etag == render_exposition(_family_list('a'), split_family=not split_family).etag
+    assert exposition.etag != render_exposition(_family_list('b'), split_family=split_family).etag
+
+
+@pytest.mark.parametrize('split_family', [False, True])
+def test_merge(split_family: bool) -> None:
+    a_exposition: CachedExposition = render_exposition(_family_list('a'), split_family=split_family)
+    b_exposition: CachedExposition = render_exposition(_family_list('b'), split_family=split_family)
+    other_exposition: CachedExposition = text_exposition(
+        b'# HELP es_other other\n# TYPE es_other gauge\nes_other 1.0\n'
+    )
+    exposition_list: List[CachedExposition] = [a_exposition, other_exposition, b_exposition]
+    assert has_duplicate_family(exposition_list)
+    assert not has_duplicate_family([a_exposition, other_exposition])
+
+    merged: CachedExposition = merge_exposition('etag', exposition_list)
+    assert merged.etag == 'etag'
+    assert merged.family_name_tuple == (b'es_node_docs', b'es_node_query_total', b'es_node_up', b'es_other')
+    # the samples of a family are in one group under its only `# TYPE` line
+    assert merged.text == (
+        b'# HELP es_node_docs docs\n'
+        b'# TYPE es_node_docs gauge\n'
+        b'es_node_docs{cluster="a",node="node-1"} 1.0\n'
+        b'es_node_docs{cluster="a",node="node-2"} 2.0\n'
+        b'es_node_docs{cluster="b",node="node-1"} 1.0\n'
+        b'es_node_docs{cluster="b",node="node-2"} 2.0\n'
+        b'# HELP es_node_query_total query\n'
+        b'# TYPE es_node_query_total counter\n'
+        b'es_node_query_total{cluster="a"} 3.0\n'
+        b'es_node_query_total{cluster="b"} 3.0\n'
+        b'# HELP es_node_up up\n'
+        b'# TYPE es_node_up gauge\n'
+        b'es_node_up{cluster="a"} 1.0\n'
+        b'es_node_up{cluster="b"} 1.0\n'
+        b'# HELP es_other other\n'
+        b'# TYPE es_other gauge\n'
+        b'es_other 1.0\n'
+    )
+    # the merged exposition is merged again by the registry
+    assert merge_exposition('etag', [merged]).gzip_text == merged.gzip_text
+
+
+@pytest.mark.parametrize(
+    'if_none_match, result',
+    [
+        (None, False),
+        ('', False),
+        ('"other"', False),
+        ('etag', True),
+        ('other, etag', True),
+        (' * ', True),
+    ]
+)
+def test_match_etag(if_none_match: str, result: bool) -> None:
+    assert match_etag(if_none_match, 'etag') is result
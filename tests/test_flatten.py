@@ -0,0 +1,89 @@
+from typing import Any, Dict
+
+import pytest
+
+from elasticsearch_exporter.collector.flatten import FlattenPlan, FlattenRow, FlattenSchema, ShapeMismatch
+
+
+def _response(query_total: int = 1) -> Dict[str, Any]:
+    return {
+        'docs': {'count': 10, 'deleted': 2},
+        'search': {'query_total': query_total, 'query_time_in_millis': 3, 'groups': {'a.b': {'query_total': 4}}},
+        'fs': {'data': [{'total': 5}], 'total': {'total_in_bytes': 6}},
+        'timestamp': 7,
+        'name': 'node-1',
+    }
+
+
+def test_extract() -> None:
+    plan: FlattenPlan = FlattenPlan('x_', _response(), lambda name: False)
+    row: FlattenRow = plan.extract(_response(query_total=9))
+    assert dict(zip(row.name_tuple, row.value_array)) == {
+        'x_docs_count': 10,
+        'x_docs_deleted': 2,
+        'x_search_query_total': 9,
+        'x_search_query_time_in_millis': 3,
+        'x_search_groups_a_b_query_total': 4,
+        'x_fs_total_total_in_bytes': 6,
+    }
+    assert row.doc_tuple[row.name_tuple.index('x_docs_count')] == 'docs count'
+    # the rows of one plan share the name tuple
+    assert plan.extract(_response()).name_tuple is row.name_tuple
+
+
+def test_extract_blocked_leaf() -> None:
+    plan: FlattenPlan = FlattenPlan('x_', _response(), lambda name: name.startswith('x_search_'))
+    row: FlattenRow = plan.extract(_response())
+    assert row.name_tuple == ('x_docs_count', 'x_docs_deleted', 'x_fs_total_total_in_bytes')
+    assert list(row.value_array) == [10, 2, 6]
+
+
+@pytest.mark.parametrize(
+    'data',
+    [
+        {'docs': {'count': 10}, 'search': {}},
+        dict(_response(), extra={'a': 1}),
+        dict(_response(), docs={'count': 'many', 'deleted': 2}),
+        dict(_response(), docs=[10, 2]),
+    ]
+)
+def test_extract_shape_mismatch(data: Dict[str, Any]) -> None:
+    plan: FlattenPlan = FlattenPlan('x_', _response(), lambda name: False)
+    with pytest.raises(ShapeMismatch):
+        plan.extract(data)
+
+
+def test_filter_path_list() -> None:
+    plan: FlattenPlan = FlattenPlan('x_', _response(), lambda name: name == 'x_docs_deleted')
+    assert plan.filter_path_list(max_depth=3) == ['docs.count', 'search.**', 'fs.**']
+    # deeper than max_depth is matched by `**`
+    assert plan.filter_path_list(max_depth=0) == ['**']
+    plan = FlattenPlan('x_', _response(), lambda name: name == 'x_search_query_total')
+    assert plan.filter_path_list(max_depth=3) == [
+        'docs.**', 'search.query_time_in_millis', 'search.groups.**', 'fs.**'
+    ]
+    plan = FlattenPlan('x_', _response(), lambda name: name == 'x_docs_count' or name.endswith('_time_in_millis'))
+    assert plan.filter_path_list(max_depth=3) == [
+        'docs.deleted', 'search.query_total', 'search.groups.**', 'fs.**'
+    ]
+
+
+def test_filter_path_list_special_char() -> None:
+    # a key with special char can only be matched by `*`
+    data: Dict[str, Any] = {'groups': {'a.b': {'query_total': 1, 'query_current': 2}}}
+    plan: FlattenPlan = FlattenPlan('x_', data, lambda name: name.endswith('_query_current'))
+    assert plan.filter_path_list(max_depth=3) == ['groups.a*b.query_total']
+
+
+def test_schema() -> None:
+    schema: FlattenSchema = FlattenSchema('x_', lambda name: False, max_plan_size=2)
+    schema.flatten(_response())
+    schema.flatten({'docs': {'count': 1}})
+    assert len(schema.plan_list) == 2
+    # a known shape moves its plan to the front instead of compiling a new one
+    row: FlattenRow = schema.flatten(_response(query_total=5))
+    assert len(schema.plan_list) == 2
+    assert schema.plan_list[0].name_tuple is row.name_tuple
+    schema.flatten({'store': {'size_in_bytes': 1}})
+    assert len(schema.plan_list) == 2
+    assert schema.plan_list[1].name_tuple is row.name_tuple
@@ -0,0 +1,96 @@
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+from elasticsearch_exporter.collector.compact import CompactGaugeFamily, LabelInterner
+from elasticsearch_exporter.collector.limit import SeriesLimiter
+
+
+def _family(name: str, value_dict: Dict[Tuple[str, ...], float], interner: LabelInterner) -> CompactGaugeFamily:
+    family: CompactGaugeFamily = CompactGaugeFamily(name, name, ['index', 'context'], interner)
+    for label_value_tuple, value in value_dict.items():
+        family.add_metric(label_value_tuple, value)
+    return family
+
+
+def _as_dict(family: CompactGaugeFamily) -> Dict[Tuple[str, ...], float]:
+    return dict(zip(family.label_value_list, family.value_array))
+
+
+def _family_list() -> List[CompactGaugeFamily]:
+    interner: LabelInterner = LabelInterner()
+    return [
+        _family(
+            'size',
+            {
+                ('a', 'total'): 30, ('a', 'primaries'): 15,
+                ('b', 'total'): 10, ('b', 'primaries'): 100,
+                ('c', 'total'): 20, ('c', 'primaries'): 10,
+                ('_all', 'total'): 60, ('_all', 'primaries'): 125,
+            },
+            interner
+        ),
+        _family('health', {('a', 'total'): 0, ('b', 'total'): 2, ('c', 'total'): 1}, interner),
+    ]
+
+
+def _limiter(config: Dict[str, Any]) -> SeriesLimiter:
+    return SeriesLimiter(
+        config,
+        'size',
+        order_label_dict={'context': 'total'},
+        key_label_tuple=('index',),
+        no_fold_family_set={'health'},
+        pinned_key_set={('_all',)}
+    )
+
+
+def test_top_n() -> None:
+    family_list: List[CompactGaugeFamily] = _family_list()
+    limiter: SeriesLimiter = _limiter({'top_n': 2})
+    limiter.limit(family_list)
+    size_family, health_family = family_list
+    # ranked by the `total` context only, `_all` is pinned and the dropped index is folded into `__other__`
+    assert _as_dict(size_family) == {
+        ('a', 'total'): 30, ('a', 'primaries'): 15,
+        ('c', 'total'): 20, ('c', 'primaries'): 10,
+        ('_all', 'total'): 60, ('_all', 'primaries'): 125,
+        ('__other__', 'total'): 10, ('__other__', 'primaries'): 100,
+    }
+    assert _as_dict(health_family) == {('a', 'total'): 0, ('c', 'total'): 1}
+    assert limiter.dropped_count == 3
+    assert limiter.metric('indices_stats').samples[0].value == 3
+    limiter.reset()
+    assert limiter.dropped_count == 0
+
+
+def test_not_limited() -> None:
+    family_list: List[CompactGaugeFamily] = _family_list()
+    limiter: SeriesLimiter = _limiter({'top_n': 3})
+    limiter.limit(family_list)
+    assert _as_dict(family_list[0]) == _as_dict(_family_list()[0])
+    assert limiter.dropped_count == 0
+    # lazy only limits more than 2 * top_n keys
+    family_list = _family_list()
+    _limiter({'top_n': 2}).limit(family_list, lazy=True)
+    assert _as_dict(family_list[0]) == _as_dict(_family_list()[0])
+
+
+def test_max_series() -> None:
+    family_list: List[CompactGaugeFamily] = _family_list()
+    # 9 series of 3 keys, about 3 series per key
+    _limiter({'max_series': 4}).limit(family_list)
+    assert {label_value_tuple[0] for label_value_tuple in family_list[0].label_value_list} == {
+        'a', '_all', '__other__'
+    }
+
+
+def test_without_other() -> None:
+    family_list: List[CompactGaugeFamily] = _family_list()
+    _limiter({'top_n': 1, 'other': False}).limit(family_list)
+    assert {label_value_tuple[0] for label_value_tuple in family_list[0].label_value_list} == {'a', '_all'}
+
+
+def test_config_error() -> None:
+    with pytest.raises(RuntimeError):
+        _limiter({})